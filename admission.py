@@ -0,0 +1,225 @@
+"""Admission control for Warbler: shed low-priority requests under load.
+
+When Postgres slows down, requests hold their pooled connections longer,
+and the requests behind them queue for one. Left alone, every route slows
+down together until checkouts time out. Instead, each worker keeps track
+of:
+
+- how many requests it has in flight, and
+- how long checkouts from the connection pool have been waiting lately:
+  an average that decays over ADMISSION_WAIT_DECAY_SECONDS, so it recovers
+  once the waits stop.
+
+Both only build up with threaded workers (the Procfile runs gunicorn's
+gthread workers, `--threads 8`): a sync worker serves one request at a
+time, never waits for its own pool, and so never sheds anything.
+
+Every route has a class (ADMISSION_ROUTE_CLASSES, by endpoint): CRITICAL
+(logging in, signing up, posting), LOW (the user list and follow lists) or
+NORMAL, the rest. Anonymous requests to NORMAL routes count as LOW.
+Static files, built assets and proxied images are EXEMPT: they don't use
+the database, so they're neither shed nor counted.
+ADMISSION_LIMITS gives each class the most requests in flight and the
+longest recent pool wait it's let in at. Past either, the request is
+turned away before it touches the database, with a 503 and Retry-After.
+CRITICAL routes are never shed.
+
+Checkouts give up after ADMISSION_POOL_TIMEOUT seconds rather than
+SQLAlchemy's 30, and a request whose checkout times out gets the same 503.
+Shed requests are counted in `warbler_requests_shed_total`, by class and
+reason.
+"""
+
+import math
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request, session
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from metrics import counter
+
+EXEMPT = 'exempt'
+CRITICAL = 'critical'
+NORMAL = 'normal'
+LOW = 'low'
+
+# How much each checkout moves the average pool wait.
+WAIT_WEIGHT = 0.2
+
+REQUESTS_SHED = counter(
+    'warbler_requests_shed_total',
+    "Requests turned away with a 503, by route class and why.",
+    labels=('route_class', 'reason'))
+
+POOL_WAIT_SECONDS = counter(
+    'warbler_pool_wait_seconds_total',
+    "Time spent waiting to check out a database connection.")
+
+POOL_CHECKOUTS = counter(
+    'warbler_pool_checkouts_total',
+    "Database connections checked out of the pool.")
+
+
+class Load:
+    """A worker's requests in flight and recent pool wait."""
+
+    def __init__(self, decay_seconds):
+        self.decay_seconds = decay_seconds
+        self.in_flight = 0
+        self._wait = 0.0
+        self._waited_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def pool_wait(self, now=None):
+        """The recent average pool wait, in seconds."""
+
+        now = time.monotonic() if now is None else now
+        # Never grown: `now` may be from before the last wait was recorded.
+        elapsed = max(now - self._waited_at, 0)
+        return self._wait * math.exp(-elapsed / self.decay_seconds)
+
+    def record_wait(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._wait = (self.pool_wait(now) * (1 - WAIT_WEIGHT)
+                          + seconds * WAIT_WEIGHT)
+            self._waited_at = now
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self._wait = 0.0
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout waited."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            POOL_CHECKOUTS.inc()
+            POOL_WAIT_SECONDS.inc(waited)
+            if has_app_context():
+                get_load().record_wait(waited)
+
+
+def get_load():
+    """The load of the current app's worker."""
+
+    return current_app.extensions['admission']
+
+
+def route_class(endpoint, logged_in):
+    """EXEMPT, CRITICAL, NORMAL or LOW, for a request to `endpoint`."""
+
+    assigned = current_app.config['ADMISSION_ROUTE_CLASSES'].get(
+        endpoint, NORMAL)
+    if assigned == NORMAL and not logged_in:
+        return LOW
+    return assigned
+
+
+def shed_reason(route_class, load):
+    """Why a `route_class` request should be shed under `load`, or None."""
+
+    max_in_flight, max_wait = current_app.config['ADMISSION_LIMITS'].get(
+        route_class, (None, None))
+    if max_in_flight is not None and load.in_flight >= max_in_flight:
+        return 'in_flight'
+    if max_wait is not None and load.pool_wait() > max_wait:
+        return 'pool_wait'
+    return None
+
+
+def _unavailable(route_class, reason):
+    REQUESTS_SHED.inc(route_class=route_class, reason=reason)
+    wait = current_app.config['ADMISSION_RETRY_AFTER']
+    return (f"<p>Warbler is busy right now. "
+            f"Please try again in {wait} seconds.</p>", 503,
+            {'Retry-After': str(wait), 'Cache-Control': 'no-store'})
+
+
+def _admit(user_key):
+    if not current_app.config['ADMISSION_ENABLED']:
+        return None
+
+    # The session cookie says who's logged in without a query.
+    g.route_class = route_class(request.endpoint, user_key in session)
+    if g.route_class == EXEMPT:
+        return None
+    load = get_load()
+    reason = shed_reason(g.route_class, load)
+    if reason:
+        return _unavailable(g.route_class, reason)
+
+    load.enter()
+    g.admitted = True
+    return None
+
+
+def _release(error):
+    if g.pop('admitted', False):
+        get_load().leave()
+
+
+def _pool_timeout(e):
+    return _unavailable(g.get('route_class', NORMAL), 'pool_timeout')
+
+
+def connect_admission(app, user_key):
+    """Add admission control to the provided Flask app.
+
+    `user_key` is the session key of the logged-in user's id. Call this
+    before anything that registers request hooks using the database, so
+    shed requests never reach it.
+    """
+
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_ROUTE_CLASSES', {
+        'static': EXEMPT,
+        'assets.serve_asset': EXEMPT,
+        'images.image_proxy': EXEMPT,
+        'metrics.show_metrics': CRITICAL,
+        'warbler.login': CRITICAL,
+        'warbler.logout': CRITICAL,
+        'warbler.signup': CRITICAL,
+        'warbler.messages_add': CRITICAL,
+        'warbler.list_users': LOW,
+        'warbler.show_following': LOW,
+        'warbler.users_followers': LOW,
+    })
+    # Per class: (most requests in flight in this worker, longest recent
+    # pool wait in seconds) it's admitted at; None for no limit.
+    app.config.setdefault('ADMISSION_LIMITS', {
+        CRITICAL: (None, None),
+        NORMAL: (32, 1.0),
+        LOW: (8, 0.1),
+    })
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 10)
+    app.config.setdefault('ADMISSION_POOL_TIMEOUT', 5)
+    app.config.setdefault('ADMISSION_WAIT_DECAY_SECONDS', 10)
+
+    engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    engine_options.setdefault('poolclass', TimedQueuePool)
+    engine_options.setdefault('pool_timeout',
+                              app.config['ADMISSION_POOL_TIMEOUT'])
+
+    app.extensions['admission'] = Load(
+        app.config['ADMISSION_WAIT_DECAY_SECONDS'])
+
+    app.before_request(lambda: _admit(user_key))
+    app.teardown_request(_release)
+    app.register_error_handler(exc.TimeoutError, _pool_timeout)
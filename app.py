@@ -1,40 +1,122 @@
+import functools
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Blueprint, Flask, Response, render_template, request,
+                   flash, redirect, session, g, abort, current_app,
+                   stream_with_context)
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from models import (db, bakery, connect_db, User, Message, MessageTag,
+                    Follows, Like, Notification)
+from images import connect_images
+from assets import connect_assets
+from compression import connect_compression
+from templating import connect_templating
+from pagination import connect_pagination, paginate, render_list
+from metrics import connect_metrics
+from admission import connect_admission
+from slow_queries import connect_slow_queries
+from cache import connect_cache, cache
+from recommend import connect_recommendations, recommended_users
+from throttle import connect_throttle, check_login, check_signup
+from follow_graph import connect_follow_graph
+from archive import connect_archive, archived_message, archived_messages
+from export import connect_export, export_chunks
+from like_counts import connect_like_counts, count_like, flush_if_due
+from profiler import connect_profiler
+from availability import (connect_availability, get_availability_index,
+                          taken_fields)
+from tags import (connect_tags, extract_tags, get_trending, tag_from_url,
+                  trending_tags)
+from notifications import (FOLLOW, LIKE, connect_notifications,
+                           flush_notifications_if_due, mark_seen, notify)
+from view_models import message_items, notification_items, user_cards
+from shards import (connect_shards, copy_user, every_shard, home_session,
+                    remove_user, scatter, shard_count, users_by_shard)
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+TAKEN_MESSAGES = {
+    'username': "Username already taken",
+    'email': "E-mail already registered",
+}
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+warbler = Blueprint('warbler', __name__)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+def create_app(config=None):
+    """Create and configure a Warbler app.
+
+    `config` overrides the defaults below (e.g. a test database). Nothing
+    here connects to the database: the engine is created on first use, so
+    this is cheap enough to call in every worker, or once before forking
+    (gunicorn --preload; see gunicorn.conf.py).
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_ENABLED'] = bool(os.environ.get('DEBUG_TB_ENABLED'))
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    app.config.update(config or {})
+
+    # Optional extensions are only imported when turned on, so workers
+    # don't pay for them at boot.
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    connect_images(app)
+    connect_assets(app)
+    connect_templating(app)
+    connect_pagination(app)
+    connect_metrics(app)
+    connect_admission(app, CURR_USER_KEY)
+    connect_slow_queries(app)
+    connect_shards(app)
+    connect_cache(app)
+    connect_recommendations(app)
+    connect_follow_graph(app)
+    connect_tags(app)
+    connect_archive(app)
+    connect_export(app)
+    connect_like_counts(app)
+    connect_notifications(app)
+    connect_availability(app)
+    connect_throttle(app)
+
+    app.register_blueprint(warbler)
+    connect_profiler(app)
+
+    connect_compression(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@warbler.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.by_id(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -46,6 +128,145 @@ def do_login(user):
     session[CURR_USER_KEY] = user.id
 
 
+def following_ids(user_id):
+    """Ids of the users this user follows (cached until they (un)follow)."""
+
+    def query():
+        return [followed_id for (followed_id,) in (
+            home_session(user_id)
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))]
+
+    return cache.get_or_set(f"following-ids:{user_id}", query,
+                            tags=[f"follows:{user_id}"])
+
+
+def message_list(query):
+    """`query` for messages, loading their authors in the same query.
+
+    For full Messages; list pages read MessageItems instead (see
+    view_models.py). Only the author columns a message shows are read.
+    """
+
+    return query.options(
+        joinedload(Message.user, innerjoin=True)
+        .load_only(User.id, User.username, User.image_url))
+
+
+def messages_by(user_ids):
+    """A baked query for MessageItems by any of `user_ids`, for
+    paginate(), and the shards to scatter it to, with their params."""
+
+    query = bakery(lambda s: message_items(s))
+    query += lambda q: q.filter(
+        Message.user_id.in_(bindparam('user_ids', expanding=True)))
+    return query, {shard: {'user_ids': ids}
+                   for shard, ids in users_by_shard(user_ids).items()}
+
+
+def message_by_id(message_id):
+    """The message with `message_id` and its author, or None (baked).
+
+    Read from its author's shard.
+    """
+
+    author_id = message_author(message_id)
+    if author_id is None:
+        return None
+    query = bakery(lambda s: message_list(s.query(Message)))
+    query += lambda q: q.filter(Message.id == bindparam('message_id'))
+    return (query.for_session(home_session(author_id))
+            .params(message_id=message_id).first())
+
+
+def message_author(message_id):
+    """The id of the author of the message with `message_id`, or None.
+
+    Looked for on every shard, and cached until the message is deleted.
+    """
+
+    def query():
+        found = scatter(
+            lambda session, _: (session.query(Message.user_id)
+                                .filter(Message.id == message_id).scalar()),
+            every_shard())
+        return next((user_id for user_id in found if user_id is not None),
+                    None)
+
+    return cache.get_or_set(f"message-author:{message_id}", query,
+                            tags=[f"message:{message_id}"], cache_none=False)
+
+
+def messages_in(message_ids):
+    """MessageItems for `message_ids`, from every shard, in that order.
+
+    Those since deleted are left out.
+    """
+
+    if not message_ids:
+        return []
+
+    found = {}
+    for items in scatter(
+            lambda session, _: (message_items(session)
+                                .filter(Message.id.in_(message_ids)).all()),
+            every_shard()):
+        found.update((item.id, item) for item in items)
+    return [found[message_id] for message_id in message_ids
+            if message_id in found]
+
+
+def notification_texts(user_id):
+    """A Page `load` filling in the liked messages' text for `user_id`'s
+    notifications, from their shard: the messages are all theirs."""
+
+    def load(items):
+        ids = [item.subject_id for item in items if item.kind == LIKE]
+        if not ids:
+            return items
+        texts = dict(home_session(user_id).query(Message.id, Message.text)
+                     .filter(Message.id.in_(ids)))
+        return [item._replace(text=texts.get(item.subject_id))
+                if item.kind == LIKE else item for item in items]
+    return load
+
+
+def liked_ids(messages):
+    """Ids of those of `messages` the current user likes, in one query."""
+
+    ids = [msg.id for msg in messages]
+    if not g.user or not ids:
+        return set()
+
+    return {message_id for (message_id,) in (
+        home_session(g.user.id)
+        .query(Like.message_id)
+        .filter(Like.user_id == g.user.id, Like.message_id.in_(ids)))}
+
+
+def followers_count(user_id):
+    """How many users follow `user_id`, on every shard."""
+
+    return sum(scatter(
+        lambda session, _: (session.query(func.count())
+                            .filter(Follows.user_being_followed_id == user_id)
+                            .scalar()),
+        every_shard()))
+
+
+def load_profile(user_id):
+    """The user with `user_id`, for their profile, or None.
+
+    Read from their shard, so the counts of their own messages, follows
+    and likes are right; followers are counted on every shard.
+    """
+
+    user = User.by_id(user_id, home_session(user_id))
+    if user is not None and shard_count() > 1:
+        set_committed_value(user, 'followers_count', followers_count(user_id))
+    return user
+
+
 def do_logout():
     """Logout user."""
 
@@ -53,7 +274,15 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def throttled(template, form, wait):
+    """Re-present a form refused by the rate limiter."""
+
+    flash(f"Too many attempts. Please try again in {wait} seconds.", 'danger')
+    return (render_template(template, form=form), 429,
+            {'Retry-After': str(wait)})
+
+
+@warbler.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -69,6 +298,17 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        wait = check_signup()
+        if wait:
+            return throttled('users/signup.html', form, wait)
+
+        # Before hashing the password, which is the expensive part.
+        taken = taken_fields(form.username.data, form.email.data)
+        if taken:
+            for field in taken:
+                getattr(form, field).errors.append(TAKEN_MESSAGES[field])
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -78,10 +318,13 @@ def signup():
             )
             db.session.commit()
 
-        except IntegrityError as e:
-            flash("Username already taken", 'danger')
+        except IntegrityError:
+            # Taken by a signup that raced this one.
+            flash("Username or e-mail already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        copy_user(user)
+        get_availability_index().add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -90,13 +333,17 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@warbler.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        wait = check_login(form.username.data)
+        if wait:
+            return throttled('users/login.html', form, wait)
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
@@ -110,7 +357,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@warbler.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -123,7 +370,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@warbler.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -132,24 +379,29 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = user_cards(db.session)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html', users=users)
+    return render_list('users/index.html',
+                       users=paginate(users, User.id, descending=False))
 
 
-@app.route('/users/<int:user_id>')
+@warbler.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = load_profile(user_id) or abort(404)
+    query, shards = messages_by([user_id])
+    messages = paginate(
+        query, Message.timestamp, Message.id, scatter=shards,
+        archive=functools.partial(archived_messages, [user_id]))
 
-    return render_template('users/show.html', user=user)
+    return render_list('users/show.html', user=user, messages=messages,
+                       liked=liked_ids(messages))
 
 
-@app.route('/users/<int:user_id>/following')
+@warbler.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -157,11 +409,18 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = load_profile(user_id) or abort(404)
+    following = (user_cards(home_session(user_id))
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+
+    return render_list(
+        'users/following.html', user=user,
+        following=paginate(following, Follows.user_being_followed_id,
+                           descending=False))
 
 
-@app.route('/users/<int:user_id>/followers')
+@warbler.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -169,11 +428,19 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = load_profile(user_id) or abort(404)
+    followers = (user_cards(db.session)
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
 
+    # Each follower's follow is on their own shard.
+    return render_list(
+        'users/followers.html', user=user,
+        followers=paginate(followers, Follows.user_following_id,
+                           descending=False, scatter=every_shard()))
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+
+@warbler.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -181,14 +448,24 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    User.query.get_or_404(follow_id)
+    session = home_session(g.user.id, write=True)
+    added = session.execute(
+        postgresql.insert(Follows.__table__)
+        .values(user_being_followed_id=follow_id,
+                user_following_id=g.user.id)
+        .on_conflict_do_nothing()).rowcount
+    session.commit()
+    cache.invalidate(f"follows:{g.user.id}")
+    # Following again isn't news.
+    if added:
+        notify(follow_id, FOLLOW, follow_id, g.user.id)
+    flush_notifications_if_due()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@warbler.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -196,24 +473,61 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    session = home_session(g.user.id, write=True)
+    session.query(Follows).filter(
+        Follows.user_following_id == g.user.id,
+        Follows.user_being_followed_id == follow_id).delete()
+    session.commit()
+    cache.invalidate(f"follows:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/<int:user_id>/likes', methods=["GET"])
+@warbler.route('/users/<int:user_id>/likes', methods=["GET"])
 def show_likes(user_id):
+    """Show list of messages this user likes."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = load_profile(user_id) or abort(404)
+    # The likes are on the user's shard; the messages, on their authors'.
+    likes = (home_session(user_id)
+             .query(Like.message_id)
+             .filter(Like.user_id == user_id))
+
+    return render_list('users/likes.html', user=user,
+                       messages=paginate(likes, Like.id, load=messages_in))
+
+
+@warbler.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications, newest first.
+
+    Opening the first page marks them all seen; those with news since the
+    last time are highlighted.
+    """
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    seen_at = g.user.notifications_seen_at
+    if not (request.args.get('after') or request.args.get('before')):
+        mark_seen(g.user)
 
+    notifications = (notification_items(db.session)
+                     .filter(Notification.user_id == g.user.id))
 
-@app.route('/messages/<int:message_id>/like', methods=['POST'])
+    return render_list('users/notifications.html', seen_at=seen_at,
+                       notifications=paginate(
+                           notifications, Notification.updated_at,
+                           Notification.id,
+                           load=notification_texts(g.user.id)))
+
+
+@warbler.route('/messages/<int:message_id>/like', methods=['POST'])
 def add_like(message_id):
     """Toggle a liked message for the currently-logged-in user."""
 
@@ -221,21 +535,34 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id == g.user.id:
+    author_id = message_author(message_id)
+    if author_id is None:
+        return abort(404)
+    if author_id == g.user.id:
         return abort(403)
 
-    if liked_message in g.user.liked_messages:
-        g.user.liked_messages.remove(liked_message)
+    session = home_session(g.user.id, write=True)
+    like = (session.query(Like)
+            .filter(Like.user_id == g.user.id, Like.message_id == message_id)
+            .first())
+    if like:
+        session.delete(like)
+        delta = -1
     else:
-        g.user.liked_messages.append(liked_message)
+        session.add(Like(user_id=g.user.id, message_id=message_id))
+        delta = 1
 
-    db.session.commit()
+    session.commit()
+    count_like(message_id, delta)
+    if delta > 0:
+        notify(author_id, LIKE, message_id, g.user.id)
+    flush_if_due()
+    flush_notifications_if_due()
 
     return redirect("/")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@warbler.route('/users/profile', methods=["GET", "POST"])
 def edit_profile():
     """Update profile for current user."""
 
@@ -255,6 +582,8 @@ def edit_profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            copy_user(user)
+            get_availability_index().add(user.username, user.email)
             return redirect(f"/users/{user.id}")
 
         flash("Wrong password, please try again.", 'danger')
@@ -262,7 +591,26 @@ def edit_profile():
     return render_template('users/edit.html', form=form, user_id=user.id)
 
 
-@app.route('/users/delete', methods=["POST"])
+@warbler.route('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Download all of the current user's data as NDJSON, streamed.
+
+    With ?gzip=1, as a gzipped file.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    compress = bool(request.args.get('gzip'))
+    filename = f"warbler-{g.user.username}.ndjson" + (".gz" if compress else "")
+    return Response(
+        stream_with_context(export_chunks(user_id, compress)),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@warbler.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -274,6 +622,8 @@ def delete_user():
 
     db.session.delete(g.user)
     db.session.commit()
+    remove_user(g.user.id)
+    cache.invalidate(f"follows:{g.user.id}")
 
     return redirect("/signup")
 
@@ -281,7 +631,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@warbler.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -295,24 +645,34 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        session = home_session(g.user.id, write=True)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        session.add(msg)
+        session.flush()
+
+        tags = extract_tags(msg.text)
+        session.add_all([MessageTag(message_id=msg.id, tag=tag)
+                         for tag in tags])
+        session.commit()
+        get_trending().add(tags)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@warbler.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, from the archive if it's old enough to be there."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = message_by_id(message_id) or archived_message(message_id)
+    if msg is None:
+        abort(404)
+    return render_template('messages/show.html', message=msg,
+                           liked=liked_ids([msg]))
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@warbler.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -320,56 +680,92 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    if msg.user_id != g.user.id:
+    author_id = message_author(message_id)
+    if author_id is None:
+        abort(404)
+    if author_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
-    db.session.commit()
+    session = home_session(g.user.id, write=True)
+    session.query(Message).filter(Message.id == message_id).delete()
+    session.commit()
+    cache.invalidate(f"message:{message_id}")
+    if shard_count() > 1:
+        # Likes are on the likers' shards, with no foreign key to cascade.
+        def delete_likes(session, _):
+            session.query(Like).filter(Like.message_id == message_id).delete()
+            session.commit()
+
+        scatter(delete_likes, every_shard())
 
     return redirect(f"/users/{g.user.id}")
 
 
+@warbler.route('/tags/<tag>')
+def tag_feed(tag):
+    """Show the newest messages with a hashtag, or mentioning @someone."""
+
+    tag = tag_from_url(tag)
+    messages = (message_items(db.session)
+                .join(MessageTag, MessageTag.message_id == Message.id)
+                .filter(MessageTag.tag == tag))
+
+    return render_list('messages/tag.html', tag=tag,
+                       messages=paginate(messages, MessageTag.message_id,
+                                         scatter=every_shard()),
+                       recent_count=get_trending().count(tag),
+                       trending=trending_tags())
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@warbler.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        followed = following_ids(g.user.id)
+        user_ids = followed + [g.user.id]
+
+        query, shards = messages_by(user_ids)
+        messages = paginate(
+            query, Message.timestamp, Message.id, scatter=shards,
+            archive=functools.partial(archived_messages, user_ids))
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        # People followed since the last build aren't suggested again.
+        recommendations = recommended_users(
+            g.user.id, exclude=followed,
+            limit=current_app.config['RECOMMENDATIONS_SHOWN'])
 
-        return render_template('home.html', messages=messages)
+        return render_list('home.html', profile=load_profile(g.user.id),
+                           messages=messages,
+                           liked=liked_ids(messages),
+                           recommendations=recommendations,
+                           trending=trending_tags())
 
     else:
         return render_template('home-anon.html')
 
 
-@app.errorhandler(404)
+@warbler.app_errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
     return render_template('404.html'), 404
 
 
-@app.after_request
+@warbler.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses that don't set their own."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
     return response
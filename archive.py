@@ -0,0 +1,560 @@
+"""Hot and cold storage for Warbler messages.
+
+`messages` is range-partitioned by id, MESSAGE_PARTITION_SIZE ids to a
+partition (models.py), and ids grow with time. Nearly every read is of the
+newest partitions, whose indexes stay small enough to live in memory.
+`flask messages maintain` (run it daily) keeps it that way:
+
+- it creates partitions ahead of the id sequence
+  (MESSAGES_PARTITIONS_AHEAD). Should it fall behind, new messages go to
+  the DEFAULT partition, messages_default, and stay there: moving them to
+  a range would delete their likes and tags, which cascade. New ranges
+  start above them, and messages_default isn't archived;
+- it archives every full partition whose newest message is older than
+  MESSAGES_RETENTION_DAYS. The partition's messages, with their likes and
+  tags, are written column by column to a directory of .npy files in
+  MESSAGES_ARCHIVE_DIR and then removed: the likes and tags are deleted,
+  and the partition is detached and dropped.
+
+The columns are stored uncompressed so that readers can np.load() them
+with mmap_mode='r': workers share them through the page cache, and only
+the pages a read touches are loaded. (Archives from before were single
+compressed .npz files; those are still read, decompressed.)
+
+Each shard (shards.py) has its own partitions, and maintain runs on each;
+their archive files share MESSAGES_ARCHIVE_DIR and its index. A
+partition's likes on other shards are deleted once its archive is written
+and the partition dropped, a shard at a time, each in a transaction; the
+index entry lists the shards still to do (`likes_left_on`), so a run that
+fails partway is finished by the next.
+
+Archived messages stay readable, but can't be liked or deleted:
+messages_show() falls back to the archive for ids it can't find, and the
+home feed and profiles page on into it past their oldest hot message. The
+archive never changes once written, so messages of since-deleted users
+are filtered out as they're read.
+
+NumPy is imported on first use.
+"""
+
+import datetime
+import functools
+import json
+import os
+import shutil
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Message, User, MESSAGE_PARTITION_SIZE
+
+messages_cli = AppGroup('messages', help="Partition and archive messages.")
+
+INDEX = 'index.json'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_micros(np, timestamps):
+    return np.array([(t - EPOCH) // datetime.timedelta(microseconds=1)
+                     for t in timestamps], dtype=np.int64)
+
+
+def _from_micros(micros):
+    return EPOCH + datetime.timedelta(microseconds=int(micros))
+
+
+def _pack_strings(np, strings):
+    """(offsets, utf-8 bytes) for a column of strings."""
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def _unpack_string(offsets, data, i):
+    return bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+
+##############################################################################
+# Partitions
+
+
+def partitions(conn):
+    """Numbers of the range partitions of `messages`, lowest ids first."""
+
+    rows = conn.execute(db.text("""
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """))
+    return sorted(int(name[len('messages_p'):]) for (name,) in rows
+                  if name.startswith('messages_p'))
+
+
+def ensure_partitions(conn, ahead=2, upto_id=None):
+    """Create partitions through `ahead` past the one for the newest id.
+
+    Only partitions above the highest existing one are created: those
+    below it have been archived. Nor are any created for ids the DEFAULT
+    partition holds (it's created if missing). Returns the numbers of
+    those created.
+    """
+
+    conn.execute("CREATE TABLE IF NOT EXISTS messages_default "
+                 "PARTITION OF messages DEFAULT")
+    overflow = conn.execute(
+        "SELECT max(id) FROM messages_default").scalar()
+
+    if upto_id is None:
+        upto_id = conn.execute(db.text("""
+            SELECT greatest(
+                (SELECT coalesce(max(id), 0) FROM messages),
+                (SELECT last_value FROM messages_id_seq))
+        """)).scalar()
+
+    highest = max(partitions(conn), default=-1)
+    if overflow is not None:
+        highest = max(highest, overflow // MESSAGE_PARTITION_SIZE)
+    created = []
+    for number in range(highest + 1,
+                        upto_id // MESSAGE_PARTITION_SIZE + ahead + 1):
+        conn.execute(
+            f"CREATE TABLE messages_p{number} PARTITION OF messages "
+            f"FOR VALUES FROM ({number * MESSAGE_PARTITION_SIZE}) "
+            f"TO ({(number + 1) * MESSAGE_PARTITION_SIZE})")
+        created.append(number)
+    return created
+
+
+def archivable_partitions(conn, retention_days):
+    """Full partitions whose messages are all older than the retention."""
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=retention_days)
+    top = conn.execute(db.text(
+        "SELECT last_value FROM messages_id_seq")).scalar()
+    newest_id = conn.execute(db.text(
+        "SELECT coalesce(max(id), 0) FROM messages")).scalar()
+    top = max(top, newest_id)
+
+    found = []
+    for number in partitions(conn):
+        # Ids are still being handed out in the newest partitions.
+        if (number + 1) * MESSAGE_PARTITION_SIZE > top:
+            break
+        newest = conn.execute(
+            f"SELECT max(timestamp) FROM messages_p{number}").scalar()
+        if newest is not None and newest >= cutoff:
+            break
+        found.append(number)
+    return found
+
+
+##############################################################################
+# Writing the archive
+
+
+def read_index(directory):
+    """The archive files in `directory`, oldest ids first."""
+
+    if directory is None:
+        return []
+    try:
+        with open(os.path.join(directory, INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _write_index(directory, entries):
+    path = os.path.join(directory, INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(sorted(entries, key=lambda e: e['min_id']), f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_columns(np, path, columns):
+    """Save `columns` as .npy files in a new directory at `path`."""
+
+    building = path + '.tmp'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for name, values in columns.items():
+        with open(os.path.join(building, f'{name}.npy'), 'wb') as f:
+            np.save(f, values)
+            f.flush()
+            os.fsync(f.fileno())
+    # Archived again (an earlier run died before dropping the partition).
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(building, path)
+
+
+def archive_partition(conn, number, directory, shard=0, others=None):
+    """Move partition `number` of `messages` on `shard` to an archive file.
+
+    The messages' likes on the `others` shards ({shard: connection}) are
+    archived and deleted too. Returns the number of messages archived.
+    """
+
+    import numpy as np
+
+    low = number * MESSAGE_PARTITION_SIZE
+    high = low + MESSAGE_PARTITION_SIZE
+    bounds = {'low': low, 'high': high}
+    # Likes of other shards' messages share the id range.
+    own_likes = (f"message_id >= :low AND message_id < :high "
+                 f"AND message_id IN (SELECT id FROM messages_p{number})")
+
+    with conn.begin():
+        messages = conn.execute(
+            f"SELECT id, user_id, timestamp, text FROM messages_p{number} "
+            f"ORDER BY id").fetchall()
+        likes = conn.execute(db.text(
+            f"SELECT message_id, user_id FROM likes WHERE {own_likes} "
+            f"ORDER BY message_id"), bounds).fetchall()
+        others = others or {}
+        message_ids = {'ids': [m[0] for m in messages]}
+        for other in others.values():
+            likes += other.execute(db.text(
+                "SELECT message_id, user_id FROM likes "
+                "WHERE message_id = ANY(:ids)"), message_ids).fetchall()
+        likes.sort(key=lambda like: like[0])
+        tags = conn.execute(db.text(
+            "SELECT message_id, tag FROM message_tags "
+            "WHERE message_id >= :low AND message_id < :high "
+            "ORDER BY message_id"), bounds).fetchall()
+
+        name = f'messages-{number}' if shard == 0 else (
+            f'messages-s{shard}-{number}')
+        entry = {'file': name, 'shard': shard, 'partition': number,
+                 'rows': len(messages), 'min_id': low, 'max_id': high - 1,
+                 'min_timestamp': None, 'max_timestamp': None,
+                 'likes_left_on': sorted(others)}
+
+        if messages:
+            ids, user_ids, timestamps, texts = zip(*messages)
+            micros = _to_micros(np, timestamps)
+            text_offsets, text = _pack_strings(np, texts)
+            tag_offsets, tag_text = _pack_strings(np, [t for _, t in tags])
+
+            columns = {
+                'id': np.array(ids, dtype=np.int64),
+                'user_id': np.array(user_ids, dtype=np.int32),
+                'timestamp': micros,
+                'text_offsets': text_offsets, 'text': text,
+                'like_message_id': np.array([m for m, _ in likes],
+                                            dtype=np.int64),
+                'like_user_id': np.array([u for _, u in likes],
+                                         dtype=np.int32),
+                'tag_message_id': np.array([m for m, _ in tags],
+                                           dtype=np.int64),
+                'tag_offsets': tag_offsets, 'tag': tag_text,
+            }
+            path = os.path.join(directory, entry['file'])
+            _write_columns(np, path, columns)
+
+            entry['min_timestamp'] = int(micros.min())
+            entry['max_timestamp'] = int(micros.max())
+            entries = [e for e in read_index(directory)
+                       if (e.get('shard', 0), e['partition'])
+                       != (shard, number)]
+            _write_index(directory, entries + [entry])
+
+        # Written and synced; now the rows can go.
+        conn.execute(db.text(f"DELETE FROM likes WHERE {own_likes}"), bounds)
+        conn.execute(db.text(
+            "DELETE FROM message_tags "
+            "WHERE message_id >= :low AND message_id < :high"), bounds)
+        conn.execute(f"ALTER TABLE messages DETACH PARTITION "
+                     f"messages_p{number}")
+        conn.execute(f"DROP TABLE messages_p{number}")
+
+    if messages:
+        _delete_other_likes(directory, entry, others, message_ids['ids'])
+    return len(messages)
+
+
+def _delete_other_likes(directory, entry, others, message_ids):
+    """Delete the likes of `entry`'s messages on the shards it has left,
+    noting each in the index as it's done."""
+
+    for number in list(entry['likes_left_on']):
+        if number not in others:
+            continue
+        with others[number].begin():
+            others[number].execute(db.text(
+                "DELETE FROM likes WHERE message_id = ANY(:ids)"),
+                {'ids': message_ids})
+        entry['likes_left_on'].remove(number)
+        entries = [e for e in read_index(directory)
+                   if (e.get('shard', 0), e['partition'])
+                   != (entry['shard'], entry['partition'])]
+        _write_index(directory, entries + [entry])
+
+
+def finish_archiving(conn, directory, shard=0, others=None):
+    """Delete other shards' likes that an earlier archive_partition() of a
+    partition on `shard` didn't get to; returns how many partitions."""
+
+    existing = set(partitions(conn))
+    finished = 0
+    for entry in read_index(directory):
+        if (entry.get('shard', 0) != shard or not entry.get('likes_left_on')
+                # Still there: that run failed before dropping it, and
+                # will archive it again.
+                or entry['partition'] in existing):
+            continue
+        ids = _columns(directory, entry)['id'].tolist()
+        _delete_other_likes(directory, entry, others or {}, ids)
+        finished += 1
+    return finished
+
+
+##############################################################################
+# Reading the archive
+
+
+@functools.lru_cache(maxsize=256)
+def _load(path, mtime):
+    """The columns of an archive, memory-mapped (cheap to keep open)."""
+
+    import numpy as np
+
+    return {name[:-len('.npy')]: np.load(os.path.join(path, name),
+                                         mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+@functools.lru_cache(maxsize=4)
+def _load_npz(path, mtime):
+    """The columns of an old archive file, decompressed (a few kept)."""
+
+    import numpy as np
+
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def _columns(directory, entry):
+    path = os.path.join(directory, entry['file'])
+    load = _load_npz if path.endswith('.npz') else _load
+    return load(path, os.stat(path).st_mtime)
+
+
+def _archive_dir():
+    return current_app.config['MESSAGES_ARCHIVE_DIR']
+
+
+def _messages(columns, indexes, users=None):
+    """Transient Messages for rows `indexes`, skipping deleted users."""
+
+    user_ids = {int(columns['user_id'][i]) for i in indexes}
+    if users is None:
+        users = {user.id: user for user in
+                 User.query.filter(User.id.in_(user_ids))} if user_ids else {}
+
+    messages = []
+    for i in indexes:
+        user = users.get(int(columns['user_id'][i]))
+        if user is None:
+            continue
+        message_id = columns['id'][i]
+        likes = columns['like_message_id']
+        msg = Message(id=int(message_id),
+                      user_id=user.id,
+                      timestamp=_from_micros(columns['timestamp'][i]),
+                      text=_unpack_string(columns['text_offsets'],
+                                          columns['text'], i),
+                      like_count=int(
+                          likes.searchsorted(message_id, 'right')
+                          - likes.searchsorted(message_id, 'left')))
+        msg.user = user
+        msg.archived = True
+        messages.append(msg)
+    return messages
+
+
+def archived_message(message_id):
+    """The archived message with this id, or None."""
+
+    directory = _archive_dir()
+    for entry in read_index(directory):
+        if entry['min_id'] <= message_id <= entry['max_id']:
+            columns = _columns(directory, entry)
+            i = columns['id'].searchsorted(message_id)
+            if i < len(columns['id']) and columns['id'][i] == message_id:
+                found = _messages(columns, [i])
+                return found[0] if found else None
+    return None
+
+
+def archived_messages(user_ids, cursor, ascending, limit):
+    """Archived messages by `user_ids`, in (timestamp, id) order from `cursor`.
+
+    For pagination.paginate(): returns up to `limit` (message, timestamp,
+    id) rows past the (timestamp, id) `cursor` (None for the start),
+    going up when `ascending` and down otherwise.
+    """
+
+    import numpy as np
+
+    directory = _archive_dir()
+    entries = [e for e in read_index(directory) if e['rows']]
+    if not entries:
+        return []
+
+    user_ids = np.array(sorted(user_ids), dtype=np.int64)
+    if cursor is not None:
+        cursor_micros = int(_to_micros(np, [cursor[0]])[0])
+        cursor_id = cursor[1]
+        # Files wholly on the wrong side of the cursor aren't opened.
+        entries = [e for e in entries
+                   if (e['max_timestamp'] >= cursor_micros if ascending
+                       else e['min_timestamp'] <= cursor_micros)]
+
+    # Nearest files to the cursor first; stop once the rows found are all
+    # nearer than anything the next file could hold.
+    entries.sort(key=lambda e: e['min_timestamp'] if ascending
+                 else -e['max_timestamp'])
+    found = []
+    for entry in entries:
+        if len(found) >= limit:
+            worst = found[limit - 1][0]
+            if (entry['min_timestamp'] > worst if ascending
+                    else entry['max_timestamp'] < worst):
+                break
+
+        columns = _columns(directory, entry)
+        micros, ids = columns['timestamp'], columns['id']
+        mask = np.isin(columns['user_id'], user_ids)
+        if cursor is not None:
+            if ascending:
+                mask &= (micros > cursor_micros) | (
+                    (micros == cursor_micros) & (ids > cursor_id))
+            else:
+                mask &= (micros < cursor_micros) | (
+                    (micros == cursor_micros) & (ids < cursor_id))
+
+        rows = np.flatnonzero(mask)
+        order = np.lexsort((ids[rows], micros[rows]))
+        rows = rows[order][:limit] if ascending else rows[order][::-1][:limit]
+
+        found += [(int(micros[i]), int(ids[i]), entry, i) for i in rows]
+        found.sort(key=lambda r: (r[0], r[1]), reverse=not ascending)
+        found = found[:limit]
+
+    # One users query for the page, and one pass over each file's rows.
+    user_ids = {int(_columns(directory, entry)['user_id'][i])
+                for _micros, _id, entry, i in found}
+    users = {user.id: user for user in
+             User.query.filter(User.id.in_(user_ids))} if user_ids else {}
+    rows = {}
+    for _micros, _id, entry, i in found:
+        rows.setdefault(entry['file'], (entry, []))[1].append(i)
+    messages = {}
+    for entry, indexes in rows.values():
+        for msg in _messages(_columns(directory, entry), indexes, users):
+            messages[msg.id] = msg
+
+    return [(messages[message_id], messages[message_id].timestamp, message_id)
+            for _micros, message_id, _entry, _i in found
+            if message_id in messages]
+
+
+def archived_user_messages(user_id):
+    """(id, timestamp, text) of a user's archived messages, oldest first.
+
+    Archive files are read one at a time.
+    """
+
+    import numpy as np
+
+    directory = _archive_dir()
+    for entry in read_index(directory):
+        if entry['rows']:
+            columns = _columns(directory, entry)
+            for i in np.flatnonzero(columns['user_id'] == user_id):
+                yield (int(columns['id'][i]),
+                       _from_micros(columns['timestamp'][i]),
+                       _unpack_string(columns['text_offsets'],
+                                      columns['text'], i))
+
+
+def archived_user_likes(user_id):
+    """Ids of the archived messages a user liked, oldest first."""
+
+    import numpy as np
+
+    directory = _archive_dir()
+    for entry in read_index(directory):
+        if entry['rows']:
+            columns = _columns(directory, entry)
+            for i in np.flatnonzero(columns['like_user_id'] == user_id):
+                yield int(columns['like_message_id'][i])
+
+
+##############################################################################
+# CLI
+
+
+def maintain(conn, directory, retention_days, ahead, shard=0, others=None):
+    """Create partitions ahead, archive expired ones; return a summary.
+
+    `others` are connections to the other shards, {shard: connection},
+    for the likes.
+    """
+
+    finish_archiving(conn, directory, shard, others)
+    with conn.begin():
+        created = ensure_partitions(conn, ahead)
+        expired = archivable_partitions(conn, retention_days)
+
+    archived = {number: archive_partition(conn, number, directory, shard,
+                                          others)
+                for number in expired}
+    return created, archived
+
+
+@messages_cli.command('maintain')
+def maintain_command():
+    """Create upcoming message partitions and archive expired ones."""
+
+    from shards import shard_connections
+
+    config = current_app.config
+    start = time.perf_counter()
+
+    with shard_connections() as conns:
+        for shard, conn in enumerate(conns):
+            created, archived = maintain(
+                conn, config['MESSAGES_ARCHIVE_DIR'],
+                config['MESSAGES_RETENTION_DAYS'],
+                config['MESSAGES_PARTITIONS_AHEAD'], shard,
+                {number: other for number, other in enumerate(conns)
+                 if number != shard})
+
+            where = f" on shard {shard}" if len(conns) > 1 else ""
+            for number in created:
+                click.echo(f"Created partition messages_p{number}{where}.")
+            for number, rows in archived.items():
+                click.echo(f"Archived partition messages_p{number}{where} "
+                           f"({rows} messages).")
+    click.echo(f"Done in {time.perf_counter() - start:.1f}s.")
+
+
+def connect_archive(app):
+    """Add message partitioning and archiving to the provided Flask app.
+
+    With MESSAGES_ARCHIVE_DIR set to None, archived messages aren't read.
+    """
+
+    app.config.setdefault(
+        'MESSAGES_ARCHIVE_DIR', os.path.join(app.instance_path,
+                                             'message-archive'))
+    app.config.setdefault('MESSAGES_RETENTION_DAYS', 365)
+    app.config.setdefault('MESSAGES_PARTITIONS_AHEAD', 2)
+
+    app.cli.add_command(messages_cli)
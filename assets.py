@@ -0,0 +1,196 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+``flask assets build`` copies everything in ``static/`` to ASSETS_BUILD_DIR
+under content-hashed names (``style.css`` -> ``style.1a2b3c4d5e6f.css``),
+writes ``.gz`` and ``.br`` siblings for text assets, and records the mapping
+in ``manifest.json``. Templates resolve asset URLs through the manifest with
+``{{ asset('stylesheets/style.css') }}``; built assets are served from
+``/assets/`` as immutable, picking the precompressed sibling the client's
+Accept-Encoding allows.
+
+Without a build, ``asset()`` falls back to the plain ``/static/`` URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import Blueprint, abort, current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+assets = Blueprint('assets', __name__)
+assets_cli = AppGroup('assets', help="Build fingerprinted static assets.")
+
+MANIFEST = 'manifest.json'
+
+ONE_YEAR = 60 * 60 * 24 * 365
+
+# Only these are worth compressing; images are already compressed.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+# Encodings in order of preference, with the suffix of their sibling file.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")?#]+)([^'")]*)\1\)""")
+
+# manifest path -> (mtime, manifest)
+_manifests = {}
+
+
+def _fingerprint(relpath, data):
+    base, ext = os.path.splitext(relpath)
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _rewrite_css(data, manifest):
+    """Point url(/static/...) references in a stylesheet at built assets."""
+
+    def replace(match):
+        quote, path, rest = match.groups()
+        if path not in manifest:
+            return match.group(0)
+        return f"url({quote}/assets/{manifest[path]}{rest}{quote})"
+
+    return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_assets(static_dir, build_dir):
+    """Build fingerprinted, precompressed copies of `static_dir`.
+
+    Returns the manifest mapping source paths (relative to `static_dir`) to
+    built paths (relative to `build_dir`).
+    """
+
+    # Only the build needs brotli; serving uses the files it wrote.
+    import brotli
+
+    sources = []
+    for root, _dirs, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            sources.append(os.path.relpath(path, static_dir).replace(os.sep, '/'))
+
+    # Stylesheets go last so the files they reference are already hashed.
+    sources.sort(key=lambda relpath: (relpath.endswith('.css'), relpath))
+
+    manifest = {}
+    for relpath in sources:
+        with open(os.path.join(static_dir, relpath), 'rb') as f:
+            data = f.read()
+
+        ext = os.path.splitext(relpath)[1].lower()
+        if ext == '.css':
+            data = _rewrite_css(data, manifest)
+
+        built = _fingerprint(relpath, data)
+        out = os.path.join(build_dir, built)
+        _write(out, data)
+
+        if ext in COMPRESSIBLE:
+            gz = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gz) < len(data):
+                _write(out + '.gz', gz)
+            br = brotli.compress(data, quality=11)
+            if len(br) < len(data):
+                _write(out + '.br', br)
+
+        manifest[relpath] = built
+
+    # Files from earlier builds are left in place for pages that still
+    # reference them; swapping the manifest in last switches new pages over.
+    tmp = os.path.join(build_dir, MANIFEST + '.tmp')
+    _write(tmp, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    os.replace(tmp, os.path.join(build_dir, MANIFEST))
+
+    return manifest
+
+
+def load_manifest(build_dir):
+    """Return the manifest in `build_dir` ({} if assets weren't built)."""
+
+    path = os.path.join(build_dir, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return {}
+
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = (mtime, json.load(f))
+        _manifests[path] = cached
+
+    return cached[1]
+
+
+def asset_url(relpath):
+    """Template global: URL for a static asset, fingerprinted if built."""
+
+    manifest = load_manifest(current_app.config['ASSETS_BUILD_DIR'])
+    built = manifest.get(relpath)
+
+    if built is None:
+        return f"/static/{relpath}"
+
+    return f"/assets/{built}"
+
+
+@assets.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """Serve a built asset, precompressed if the client accepts it."""
+
+    build_dir = current_app.config['ASSETS_BUILD_DIR']
+
+    if filename == MANIFEST or filename.endswith(('.gz', '.br')):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if (request.accept_encodings[name]
+                and os.path.isfile(os.path.join(build_dir, filename + suffix))):
+            encoding = name
+            filename += suffix
+            break
+
+    response = send_from_directory(build_dir, filename, mimetype=mimetype)
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = (
+        f"public, max-age={ONE_YEAR}, immutable")
+
+    return response
+
+
+@assets_cli.command('build')
+def build_command():
+    """Fingerprint and precompress everything in static/."""
+
+    manifest = build_assets(current_app.static_folder,
+                            current_app.config['ASSETS_BUILD_DIR'])
+    click.echo(f"Built {len(manifest)} assets into "
+               f"{current_app.config['ASSETS_BUILD_DIR']}")
+
+
+def connect_assets(app):
+    """Set up fingerprinted static assets on the provided Flask app."""
+
+    app.config.setdefault(
+        'ASSETS_BUILD_DIR', os.path.join(app.root_path, 'build', 'assets'))
+
+    app.add_template_global(asset_url, 'asset')
+    app.register_blueprint(assets)
+    app.cli.add_command(assets_cli)
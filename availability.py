@@ -0,0 +1,260 @@
+"""Username and email availability for Warbler signups.
+
+Signing up hashes the password with bcrypt, which is slow on purpose, so a
+taken username or email should be caught before that. Each worker keeps a
+Bloom filter of every username and email: a name that isn't in it is free
+without asking the database, and one that is (or is a false positive, about
+AVAILABILITY_FALSE_POSITIVES of the time) is checked exactly, on the
+unique index.
+
+Each worker builds its filter from `users` in a daemon thread, started by
+the first check, so no request waits for the build; until it's done,
+every check goes to the database. The thread picks up users who signed up
+since every AVAILABILITY_REFRESH_SECONDS, and rebuilds the filter from
+scratch every AVAILABILITY_REBUILD_SECONDS (which also drops names that
+are no longer used). With AVAILABILITY_BUILD_THREAD off, the request that
+finds the filter missing or stale does this itself.
+
+Between refreshes another worker's signup can be missed, so "available"
+is a strong hint rather than a promise. signup() doesn't check again: a
+name the filter has never seen goes straight to hashing, and the unique
+constraints on `users` are what turn away the second of two signups for
+it.
+
+GET /api/availability?username=...&email=... answers the signup form as
+it's filled in.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import or_
+
+from metrics import counter
+from models import db, User
+from throttle import check_availability
+
+availability = Blueprint('availability', __name__)
+
+FIELDS = ('username', 'email')
+
+AVAILABILITY_CHECKS = counter(
+    'warbler_availability_checks_total',
+    "Username/email checks, by how they were answered.",
+    labels=('answer',))
+
+
+class BloomFilter:
+    """A Bloom filter sized for `capacity` items at `error_rate`."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate)
+                               / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: h1 + i * h2 stands in for k independent hashes.
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+def _key(field, value):
+    return f"{field}:{value}"
+
+
+class AvailabilityIndex:
+    """A worker's Bloom filter of usernames and emails, kept fresh."""
+
+    def __init__(self, app, error_rate, refresh_seconds, rebuild_seconds,
+                 thread=True):
+        self.app = app
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.thread = thread
+        self._filter = None
+        self._max_id = 0
+        self._refreshed_at = self._built_at = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def _add_users(self, conn, bloom, after_id=0):
+        users = User.__table__
+        rows = conn.execution_options(stream_results=True).execute(
+            db.select([users.c.id, users.c.username, users.c.email])
+            .where(users.c.id > after_id))
+        max_id = after_id
+        for user_id, username, email in rows:
+            bloom.add(_key('username', username))
+            bloom.add(_key('email', email))
+            max_id = max(max_id, user_id)
+        return max_id
+
+    def build(self, conn):
+        """Read every username and email on `conn` into a fresh filter."""
+
+        count = conn.execute(
+            db.select([db.func.count()]).select_from(User.__table__)
+        ).scalar()
+        # Two keys a user, and room for as many again before the rebuild.
+        bloom = BloomFilter(2 * 2 * count + 1000, self.error_rate)
+        max_id = self._add_users(conn, bloom)
+        with self._lock:
+            self._filter, self._max_id = bloom, max_id
+            self._built_at = self._refreshed_at = time.monotonic()
+
+    def update(self, conn):
+        """Build, rebuild or refresh the filter on `conn`, if it's due."""
+
+        with self._update_lock:
+            now = time.monotonic()
+            if (self._filter is None
+                    or now - self._built_at >= self.rebuild_seconds):
+                self.build(conn)
+            elif now - self._refreshed_at >= self.refresh_seconds:
+                with self._lock:
+                    self._max_id = self._add_users(conn, self._filter,
+                                                   self._max_id)
+                    self._refreshed_at = now
+
+    def start(self):
+        """Start this process's thread that keeps the filter fresh."""
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's filter goes stale with its thread.
+                self._pid, self._filter = os.getpid(), None
+                threading.Thread(target=self._run, daemon=True,
+                                 name='warbler-availability').start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context(), db.engine.connect() as conn:
+                    self.update(conn)
+            except Exception:
+                self.app.logger.exception("availability filter update failed")
+            # A floor, so a setting of 0 doesn't spin.
+            time.sleep(max(min(self.refresh_seconds, self.rebuild_seconds),
+                           0.01))
+
+    def _fresh(self):
+        """The filter, or None while it's being built."""
+
+        if self.thread:
+            self.start()
+        else:
+            self.update(db.session.connection())
+        return self._filter
+
+    def add(self, username, email):
+        """Note a signup (or rename) made by this worker."""
+
+        if self._filter is not None:
+            with self._lock:
+                self._filter.add(_key('username', username))
+                self._filter.add(_key('email', email))
+
+    def maybe_taken(self, field, value):
+        bloom = self._fresh()
+        return bloom is None or _key(field, value) in bloom
+
+    def clear(self):
+        with self._lock:
+            self._filter = None
+            self._max_id = 0
+
+
+def get_availability_index():
+    """The availability filter of the current app."""
+
+    return current_app.extensions['availability']
+
+
+def taken_fields(username=None, email=None):
+    """Which of `username` and `email` belong to an existing user.
+
+    Values the filter has never seen are free without a query; the rest,
+    and every value while the filter is being built, are looked up
+    together, in one query on the unique indexes.
+    """
+
+    index = get_availability_index()
+    wanted = {field: value for field, value in
+              (('username', username), ('email', email)) if value}
+
+    maybe = {field: value for field, value in wanted.items()
+             if index.maybe_taken(field, value)}
+    AVAILABILITY_CHECKS.inc(len(wanted) - len(maybe), answer='filter')
+    if not maybe:
+        return set()
+
+    AVAILABILITY_CHECKS.inc(len(maybe), answer='database')
+    rows = (db.session.query(User.username, User.email)
+            .filter(or_(*[getattr(User, field) == value
+                          for field, value in maybe.items()]))
+            .all())
+    return {field for field, value in maybe.items()
+            if any(getattr(row, field) == value for row in rows)}
+
+
+@availability.route('/api/availability')
+def check_availability_view():
+    """Is a username and/or email free? For the signup form, as it's typed.
+
+    Returns {"username": {"value": ..., "available": true}, ...} for each
+    field asked about.
+    """
+
+    values = {field: request.args.get(field, '').strip() for field in FIELDS}
+    values = {field: value for field, value in values.items() if value}
+    if not values:
+        return jsonify(error="Ask about a username or an email."), 400
+
+    wait = check_availability()
+    if wait:
+        response = jsonify(error="Too many checks; try again later.")
+        response.headers['Retry-After'] = str(wait)
+        return response, 429
+
+    taken = taken_fields(**values)
+    return jsonify({field: {'value': value, 'available': field not in taken}
+                    for field, value in values.items()})
+
+
+def connect_availability(app):
+    """Add username/email availability checks to the provided Flask app."""
+
+    app.config.setdefault('AVAILABILITY_FALSE_POSITIVES', 0.01)
+    app.config.setdefault('AVAILABILITY_REFRESH_SECONDS', 10)
+    app.config.setdefault('AVAILABILITY_REBUILD_SECONDS', 3600)
+    app.config.setdefault('AVAILABILITY_BUILD_THREAD', True)
+
+    app.extensions['availability'] = AvailabilityIndex(
+        app, app.config['AVAILABILITY_FALSE_POSITIVES'],
+        refresh_seconds=app.config['AVAILABILITY_REFRESH_SECONDS'],
+        rebuild_seconds=app.config['AVAILABILITY_REBUILD_SECONDS'],
+        thread=app.config['AVAILABILITY_BUILD_THREAD'])
+
+    app.register_blueprint(availability)
@@ -0,0 +1,7 @@
+"""Performance benchmarks for Warbler.
+
+These are scripts, not tests: run them from the project root against a
+database seeded with seed.py, like:
+
+    python -m benchmarks.bench_compression
+"""
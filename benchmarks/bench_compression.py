@@ -0,0 +1,89 @@
+"""Benchmark response compression: bytes saved and CPU cost per route.
+
+Every route is requested with no Accept-Encoding, with gzip and with brotli.
+CPU cost is the extra process time per request over the uncompressed
+request, so it covers exactly the work the middleware adds.
+
+    python -m benchmarks.bench_compression [--repeat N]
+"""
+
+import argparse
+import time
+
+from sqlalchemy import func
+
+from app import create_app, CURR_USER_KEY
+from models import db, Follows
+
+ENCODINGS = (None, 'gzip', 'br')
+
+
+def busiest_user_id():
+    """The user following the most people: the heaviest home feed."""
+
+    return (db.session
+            .query(Follows.user_following_id)
+            .group_by(Follows.user_following_id)
+            .order_by(func.count().desc())
+            .limit(1)
+            .scalar())
+
+
+def measure(client, url, encoding, repeat):
+    """Return (body bytes, CPU seconds per request) for one route."""
+
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+
+    # Warm up template and query caches before timing.
+    client.get(url, headers=headers)
+
+    start = time.process_time()
+    for _ in range(repeat):
+        resp = client.get(url, headers=headers)
+        size = len(resp.data)
+    elapsed = time.process_time() - start
+
+    return size, elapsed / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+
+    user_id = busiest_user_id()
+    routes = [
+        '/',
+        '/users',
+        f'/users/{user_id}',
+        f'/users/{user_id}/following',
+        f'/users/{user_id}/followers',
+        f'/users/{user_id}/likes',
+    ]
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    print(f"{'route':<28}{'raw':>9}"
+          f"{'gzip':>9}{'saved':>7}{'+cpu ms':>9}"
+          f"{'br':>9}{'saved':>7}{'+cpu ms':>9}")
+
+    for url in routes:
+        results = {enc: measure(client, url, enc, args.repeat)
+                   for enc in ENCODINGS}
+        raw_size, raw_cpu = results[None]
+
+        row = f"{url:<28}{raw_size:>9}"
+        for enc in ENCODINGS[1:]:
+            size, cpu = results[enc]
+            row += (f"{size:>9}{1 - size / raw_size:>7.0%}"
+                    f"{(cpu - raw_cpu) * 1000:>9.2f}")
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark exporting a heavy user's data: throughput and peak memory.
+
+Creates a user with --messages messages (and a like of each), exports them
+once with export.py's streamed NDJSON (plain and gzipped) and once the
+naive way, through the ORM relationships, then deletes the user again.
+Each export runs in a fresh process, so its peak RSS is its own.
+
+    python -m benchmarks.bench_export [--messages N]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from app import create_app
+from archive import ensure_partitions
+from models import db, User
+
+USERNAME = 'bench-export'
+
+WORKER = """
+import json, resource, sys, time
+from app import create_app
+from models import db, User
+mode, user_id = sys.argv[1], int(sys.argv[2])
+app = create_app()
+with app.app_context():
+    start = time.perf_counter()
+    size = 0
+    if mode == 'naive':
+        user = User.query.get(user_id)
+        records = [{'type': 'message', 'id': m.id, 'text': m.text,
+                    'timestamp': m.timestamp.isoformat()}
+                   for m in user.messages]
+        records += [{'type': 'like', 'message_id': m.id}
+                    for m in user.liked_messages]
+        records += [{'type': 'following', 'user_id': u.id}
+                    for u in user.following]
+        size = len('\\n'.join(json.dumps(r) for r in records).encode())
+    else:
+        from export import export_chunks
+        for chunk in export_chunks(user_id, compress=mode == 'gzip'):
+            size += len(chunk)
+    elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'bytes': size,
+                  'maxrss_mb': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+def create_user(messages):
+    """Create the benchmark user with `messages` messages, each liked."""
+
+    user = User(username=USERNAME, email=f'{USERNAME}@test.com',
+                password='HASHED_PASSWORD')
+    db.session.add(user)
+    db.session.flush()
+
+    conn = db.session.connection()
+    top = conn.execute("SELECT last_value FROM messages_id_seq").scalar()
+    ensure_partitions(conn, ahead=1, upto_id=top + messages)
+    conn.execute(db.text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'Benchmark warble number ' || n || ', #export',
+               now() - n * interval '1 minute', :user_id
+        FROM generate_series(1, :messages) n
+    """), {'user_id': user.id, 'messages': messages})
+    conn.execute(db.text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id FROM messages WHERE user_id = :user_id
+    """), {'user_id': user.id})
+    db.session.commit()
+    return user.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--modes', default='stream,gzip,naive')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        User.query.filter_by(username=USERNAME).delete()
+        db.session.commit()
+
+        start = time.perf_counter()
+        user_id = create_user(args.messages)
+        print(f"user: {args.messages} messages and likes "
+              f"({time.perf_counter() - start:.1f}s to create)")
+
+        try:
+            for mode in args.modes.split(','):
+                out = subprocess.run(
+                    [sys.executable, '-c', WORKER, mode, str(user_id)],
+                    check=True, capture_output=True, text=True).stdout
+                result = json.loads(out.strip().splitlines()[-1])
+                rows = 2 * args.messages
+                print(f"{mode:>6}: {result['seconds']:6.1f}s "
+                      f"{rows / result['seconds']:>10,.0f} rows/s "
+                      f"{result['bytes'] / 2**20:8.1f}MB out "
+                      f"{result['maxrss_mb']:8.1f}MB peak RSS")
+        finally:
+            User.query.filter_by(id=user_id).delete()
+            db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark the ORM overhead of the per-request lookups, baked and not.
+
+Each lookup is run the way it was written before it was baked (a Query
+built and compiled on every call) and through its baked version. CPU time
+is the process's own, so it is the Python cost of building, compiling and
+loading; the database's share of wall time barely moves. The session is
+emptied before every call so query.get() can't answer from it.
+
+    python -m benchmarks.bench_queries [--repeat N]
+"""
+
+import argparse
+import time
+
+from app import create_app, message_by_id, message_list, messages_by
+from benchmarks.bench_compression import busiest_user_id
+from models import db, User, Message
+from pagination import Page
+
+
+def measure(lookup, repeat):
+    """Return (CPU seconds, wall seconds) per call of `lookup`."""
+
+    # Warm up: the first baked call builds and compiles.
+    lookup()
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(repeat):
+        db.session.expunge_all()
+        lookup()
+    return ((time.process_time() - cpu) / repeat,
+            (time.perf_counter() - wall) / repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.test_request_context('/').push()
+
+    user_id = busiest_user_id()
+    username = User.query.get(user_id).username
+    message_id = db.session.query(db.func.max(Message.id)).scalar()
+    user_ids = [user_id] + [
+        followed.id for followed in User.query.get(user_id).following]
+    columns = (Message.timestamp, Message.id)
+    per_page = app.config['PAGE_SIZE']
+    feed, shards = messages_by(user_ids)
+
+    lookups = [
+        ('user by id (add_user_to_g, users_show)',
+         lambda: User.query.get(user_id),
+         lambda: User.by_id(user_id)),
+        ('user by username (authenticate)',
+         lambda: User.query.filter_by(username=username).first(),
+         lambda: User.by_username(username)),
+        ('message by id (messages_show)',
+         lambda: (message_list(Message.query)
+                  .filter(Message.id == message_id).first()),
+         lambda: message_by_id(message_id)),
+        (f'home feed, {per_page} of {len(user_ids)} users (homepage)',
+         lambda: Page(message_list(Message.query)
+                      .filter(Message.user_id.in_(user_ids)),
+                      columns, per_page).rows,
+         lambda: Page(feed, columns, per_page, scatter=shards).rows),
+    ]
+
+    print(f"{'lookup':<44}{'orm cpu':>10}{'baked cpu':>11}{'saved':>7}"
+          f"{'orm wall':>10}{'baked wall':>12}")
+    totals = [0.0] * 4
+    for name, orm, baked in lookups:
+        orm_cpu, orm_wall = measure(orm, args.repeat)
+        baked_cpu, baked_wall = measure(baked, args.repeat)
+        for i, value in enumerate((orm_cpu, baked_cpu, orm_wall, baked_wall)):
+            totals[i] += value
+        print(f"{name:<44}{orm_cpu * 1e6:>8.0f}us{baked_cpu * 1e6:>9.0f}us"
+              f"{1 - baked_cpu / orm_cpu:>7.0%}"
+              f"{orm_wall * 1e6:>8.0f}us{baked_wall * 1e6:>10.0f}us")
+
+    orm_cpu, baked_cpu, orm_wall, baked_wall = totals
+    print(f"{'all of the above':<44}{orm_cpu * 1e6:>8.0f}us"
+          f"{baked_cpu * 1e6:>9.0f}us{1 - baked_cpu / orm_cpu:>7.0%}"
+          f"{orm_wall * 1e6:>8.0f}us{baked_wall * 1e6:>10.0f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark the friends-of-friends job on a synthetic follow graph.
+
+Builds a graph with --users users and --edges follows, where who gets
+followed is heavy-tailed (a few very popular users, like the real thing),
+then times scoring and top-k selection for every user. The database isn't
+involved; `flask recommendations build` adds the COPY in and out.
+
+    python -m benchmarks.bench_recommendations [--users N] [--edges M]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from recommend import friends_of_friends
+
+
+def synthetic_graph(users, edges, seed=0):
+    """(follower ids, followed ids) without duplicate or self follows."""
+
+    rng = np.random.default_rng(seed)
+    follower = rng.integers(1, users + 1, size=edges, dtype=np.int64)
+    # Zipf-like popularity: user ids ranked by how often they're followed.
+    followed = np.minimum(rng.zipf(1.3, size=edges), users).astype(np.int64)
+    followed = (followed * 7919) % users + 1
+
+    pairs = np.unique(follower * (users + 1) + followed)
+    follower, followed = pairs // (users + 1), pairs % (users + 1)
+    keep = follower != followed
+    return follower[keep].astype(np.int32), followed[keep].astype(np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--edges', type=int, default=5000000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--block-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    follower, followed = synthetic_graph(args.users, args.edges)
+    print(f"graph: {args.users} users, {len(follower)} follows "
+          f"({time.perf_counter() - start:.1f}s to generate)")
+
+    start = time.perf_counter()
+    rows = 0
+    for users, _ranks, _recommended, _scores in friends_of_friends(
+            follower, followed, k=args.k, block_size=args.block_size):
+        rows += len(users)
+    elapsed = time.perf_counter() - start
+
+    print(f"scored: {rows} recommendations in {elapsed:.1f}s "
+          f"({args.users / elapsed:,.0f} users/s)")
+
+
+if __name__ == '__main__':
+    main()
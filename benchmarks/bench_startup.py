@@ -0,0 +1,89 @@
+"""Benchmark first-request latency of a fresh worker.
+
+Each run starts a new Python process (as a new gunicorn worker would),
+imports the app and times the first request to each page, so template
+compilation lands in the measurement. Runs are done with an empty
+bytecode cache ("cold") and with templates precompiled ("warm").
+
+    python -m benchmarks.bench_startup [--runs N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from app import create_app
+from models import User
+from templating import SharedBytecodeCache, compile_templates
+
+WORKER = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app, CURR_USER_KEY
+app = create_app()
+timings = {'import': time.perf_counter() - start}
+client = app.test_client()
+with client.session_transaction() as sess:
+    sess[CURR_USER_KEY] = int(sys.argv[1])
+for url in sys.argv[2:]:
+    start = time.perf_counter()
+    client.get(url).get_data()
+    timings[url] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def run_worker(cache_dir, user_id, urls):
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=cache_dir)
+    out = subprocess.run(
+        [sys.executable, '-c', WORKER, str(user_id)] + urls,
+        env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+
+    user_id = User.query.first().id
+    urls = ['/', '/users', f'/users/{user_id}', f'/users/{user_id}/following',
+            '/messages/new', '/login']
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cold = []
+        for _ in range(args.runs):
+            shutil.rmtree(cache_dir)
+            os.mkdir(cache_dir)
+            cold.append(run_worker(cache_dir, user_id, urls))
+
+        compile_templates(app.jinja_env.overlay(
+            cache_size=0, bytecode_cache=SharedBytecodeCache(cache_dir)))
+
+        warm = [run_worker(cache_dir, user_id, urls)
+                for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(cache_dir)
+
+    print(f"{'first request':<28}{'cold ms':>10}{'warm ms':>10}")
+    for key in ['import'] + urls:
+        cold_ms = statistics.median(run[key] for run in cold) * 1000
+        warm_ms = statistics.median(run[key] for run in warm) * 1000
+        print(f"{key:<28}{cold_ms:>10.1f}{warm_ms:>10.1f}")
+
+    total_cold = statistics.median(sum(run.values()) for run in cold) * 1000
+    total_warm = statistics.median(sum(run.values()) for run in warm) * 1000
+    print(f"{'total':<28}{total_cold:>10.1f}{total_warm:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark list pages built from ORM instances and from view models.
+
+Each list is fetched a page at a time and its items rendered, once from
+ORM instances (as the routes did before view_models.py) and once from
+MessageItems/UserCards. Time is wall time per page, without tracing;
+memory is then traced once with tracemalloc: the peak allocated while
+building and rendering a page.
+
+    python -m benchmarks.bench_views [--repeat N]
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from flask import current_app, g
+
+from app import create_app, message_list
+from benchmarks.bench_compression import busiest_user_id
+from models import db, User, Message, Follows
+from pagination import Page
+from view_models import message_items, user_cards
+
+
+def render_items(template_name, **context):
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return ''.join(template.blocks['items'](template.new_context(context)))
+
+
+def measure(build, repeat):
+    """Return (seconds, KiB peak) per call of `build`."""
+
+    build()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        db.session.expunge_all()
+        build()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.test_request_context('/').push()
+
+    user_id = busiest_user_id()
+    user_ids = [user_id] + [
+        followed.id for followed in User.query.get(user_id).following]
+    per_page = app.config['PAGE_SIZE']
+    feed_key = (Message.timestamp, Message.id)
+    following_key = (Follows.user_being_followed_id,)
+
+    lists = {
+        'home feed': ('home.html', 'messages', feed_key,
+                      lambda: message_list(Message.query),
+                      lambda: message_items(db.session),
+                      lambda q: q.filter(Message.user_id.in_(user_ids))),
+        'profile messages': ('users/show.html', 'messages', feed_key,
+                             lambda: message_list(Message.query),
+                             lambda: message_items(db.session),
+                             lambda q: q.filter(Message.user_id == user_id)),
+        'users': ('users/index.html', 'users', (User.id,),
+                  lambda: User.query,
+                  lambda: user_cards(db.session),
+                  lambda q: q),
+        'following': ('users/following.html', 'following', following_key,
+                      lambda: User.query,
+                      lambda: user_cards(db.session),
+                      lambda q: q.join(
+                          Follows, Follows.user_being_followed_id == User.id)
+                      .filter(Follows.user_following_id == user_id)),
+    }
+
+    print(f"{'list':<18}{'':<7}{'ms':>8}{'KiB peak':>10}")
+    for name, (template, var, key, orm, view, narrow) in lists.items():
+        results = []
+        for kind, base in (('orm', orm), ('view', view)):
+            def build(base=base):
+                g.user = User.query.get(user_id)
+                page = Page(narrow(base()), key, per_page,
+                            descending=key is feed_key)
+                return render_items(template, user=g.user, liked=set(),
+                                    **{var: page})
+            results.append(measure(build, args.repeat))
+            elapsed, peak = results[-1]
+            print(f"{name if kind == 'orm' else '':<18}{kind:<7}"
+                  f"{elapsed * 1000:>8.2f}{peak:>10.0f}")
+        (orm_time, orm_peak), (view_time, view_peak) = results
+        print(f"{'':<18}{'saved':<7}{1 - view_time / orm_time:>8.0%}"
+              f"{1 - view_peak / orm_peak:>10.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+"""Caching for Warbler, shared between workers.
+
+A Cache looks a key up in a stack of tiers, fastest first:
+
+- local: an LRU dict in the worker process. Entries are kept for at most
+  CACHE_LOCAL_TTL seconds, since other workers can't evict them.
+- shared: a table of fixed-size slots in a memory-mapped file, shared by
+  every worker on the host (CACHE_SHARED_PATH).
+- network: a memcached server shared by every host (CACHE_SERVER,
+  "host:port"), spoken to over the text protocol.
+
+A hit in a slower tier is copied into the faster ones. Writes go to every
+tier. A tier that fails (say, memcached is down) counts as a miss; the cache
+never breaks a request.
+
+Entries can carry tags. Each tag has a version, kept in the slowest tier;
+invalidating a tag gives it a new version, and every entry stored under the
+old one becomes a miss, in every tier and every worker at once. That needs a
+shared tier: with only the local one, tag versions live in each worker, so
+the others keep serving the old entries for up to CACHE_LOCAL_TTL seconds.
+Only cache tagged values that can stand being that stale without one.
+
+Values must be picklable, and shouldn't be mutated once cached.
+"""
+
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from metrics import counter
+
+CACHE_REQUESTS = counter(
+    'warbler_cache_requests_total',
+    "Cache lookups, by tier and result.",
+    ('tier', 'result'))
+
+CACHE_EVICTIONS = counter(
+    'warbler_cache_evictions_total',
+    "Live entries evicted to make room, by tier.",
+    ('tier',))
+
+# Returned by tiers for a miss, so None can be cached.
+MISS = object()
+
+# Tag versions are never expired, only replaced.
+FOREVER = None
+
+
+class CacheTierError(Exception):
+    """A cache tier could not be reached; treated as a miss."""
+
+
+class Tier:
+    """Base class for a cache tier: counts hits, misses and evictions."""
+
+    name = None
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        CACHE_REQUESTS.inc(tier=self.name, result='hit' if hit else 'miss')
+
+    def evicted(self):
+        self.evictions += 1
+        CACHE_EVICTIONS.inc(tier=self.name)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class LocalTier(Tier):
+    """LRU dict in this process, bounded by number of entries."""
+
+    name = 'local'
+
+    def __init__(self, max_items=1024, max_ttl=5):
+        super().__init__()
+        self.max_items = max_items
+        self.max_ttl = max_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+            return MISS
+
+    def set(self, key, value, ttl):
+        if ttl is FOREVER or ttl > self.max_ttl:
+            ttl = self.max_ttl
+
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evicted()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedMemoryTier(Tier):
+    """Fixed-size slot table in a memory-mapped file, shared between processes.
+
+    Slots are grouped into buckets of WAYS; a key can only live in its
+    bucket, and a full bucket evicts its least recently used entry. Each
+    bucket is locked with a byte-range lock on the file while it's used, so
+    workers only contend on the same bucket.
+    """
+
+    name = 'shared'
+
+    WAYS = 4
+    MAGIC = b'WBLRCACHE1'
+    HEADER = struct.Struct('<10sII')
+    HEADER_SIZE = 64
+    # key hash, expires at, last used, payload length
+    SLOT = struct.Struct('<QddI')
+
+    def __init__(self, path, slots=4096, slot_size=1024):
+        super().__init__()
+        self.path = path
+        self.buckets = max(1, slots // self.WAYS)
+        self.slot_size = slot_size
+        self.size = self.HEADER_SIZE + self.buckets * self.WAYS * slot_size
+        self._map = None
+        self._fd = None
+        # Record locks are per process; threads need their own lock.
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._map is not None:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = self.HEADER.pack(self.MAGIC, self.buckets, self.slot_size)
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            # A file laid out for other settings is started afresh.
+            if os.pread(fd, len(header), 0) != header:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, header, 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+
+    def _hash(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def _bucket(self, key_hash):
+        """(offset, length) of the bucket for a key hash."""
+
+        length = self.WAYS * self.slot_size
+        offset = self.HEADER_SIZE + (key_hash % self.buckets) * length
+        return offset, length
+
+    def _locked(self, key_hash, func):
+        self._open()
+        offset, length = self._bucket(key_hash)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                return func(offset)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def _slots(self, offset):
+        for way in range(self.WAYS):
+            slot = offset + way * self.slot_size
+            yield (slot,) + self.SLOT.unpack_from(self._map, slot)
+
+    def get(self, key):
+        key_hash = self._hash(key)
+        now = time.time()
+
+        def get_in_bucket(offset):
+            for slot, slot_hash, expires, _used, length in self._slots(offset):
+                if slot_hash != key_hash or expires <= now:
+                    continue
+
+                start = slot + self.SLOT.size
+                stored_key, value = pickle.loads(self._map[start:start + length])
+                if stored_key != key:
+                    continue
+
+                self.SLOT.pack_into(self._map, slot,
+                                    slot_hash, expires, now, length)
+                return value
+            return MISS
+
+        return self._locked(key_hash, get_in_bucket)
+
+    def set(self, key, value, ttl):
+        payload = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.slot_size - self.SLOT.size:
+            # Too big for a slot; the other tiers still have it.
+            self.delete(key)
+            return
+
+        key_hash = self._hash(key)
+        now = time.time()
+        expires = float('inf') if ttl is FOREVER else now + ttl
+
+        def set_in_bucket(offset):
+            slots = list(self._slots(offset))
+
+            def pick():
+                # The key's own slot, else a free or expired one, else LRU.
+                for slot, slot_hash, *_rest in slots:
+                    if slot_hash == key_hash:
+                        return slot, False
+                for slot, slot_hash, slot_expires, *_rest in slots:
+                    if not slot_hash or slot_expires <= now:
+                        return slot, False
+                return min(slots, key=lambda s: s[3])[0], True
+
+            slot, evicting = pick()
+            if evicting:
+                self.evicted()
+
+            start = slot + self.SLOT.size
+            self._map[start:start + len(payload)] = payload
+            self.SLOT.pack_into(self._map, slot,
+                                key_hash, expires, now, len(payload))
+
+        self._locked(key_hash, set_in_bucket)
+
+    def delete(self, key):
+        key_hash = self._hash(key)
+
+        def delete_in_bucket(offset):
+            for slot, slot_hash, *_rest in self._slots(offset):
+                if slot_hash == key_hash:
+                    self.SLOT.pack_into(self._map, slot, 0, 0, 0, 0)
+
+        self._locked(key_hash, delete_in_bucket)
+
+    def clear(self):
+        self._open()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                start = self.HEADER_SIZE
+                self._map[start:] = bytes(self.size - start)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+class NetworkTier(Tier):
+    """A memcached server, over the text protocol."""
+
+    name = 'network'
+
+    def __init__(self, address, prefix='warbler:', timeout=0.25):
+        super().__init__()
+        host, _sep, port = address.rpartition(':')
+        self.address = (host or 'localhost', int(port))
+        self.prefix = prefix
+        self.timeout = timeout
+        self._sock = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        name = (self.prefix + key).encode()
+        # memcached keys are at most 250 bytes, without spaces or controls.
+        if len(name) > 200 or any(b <= 32 or b == 127 for b in name):
+            name = (self.prefix + "#" + hashlib.sha1(name).hexdigest()).encode()
+        return name
+
+    def _connect(self):
+        # A socket inherited from the process we were forked from is shared
+        # with it; open our own.
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = socket.create_connection(self.address, self.timeout)
+            self._file = self._sock.makefile('rb')
+            self._pid = os.getpid()
+        return self._sock
+
+    def _call(self, func):
+        with self._lock:
+            try:
+                return func(self._connect())
+            except (OSError, ValueError, pickle.UnpicklingError):
+                self._sock = None
+                raise CacheTierError(f"memcached at {self.address} failed")
+
+    def _expect(self, *replies):
+        line = self._file.readline()
+        if line.rstrip(b'\r\n') not in replies:
+            raise ValueError(f"unexpected reply {line!r}")
+
+    def get(self, key):
+        def get(sock):
+            sock.sendall(b"get " + self._key(key) + b"\r\n")
+            line = self._file.readline()
+            if line == b"END\r\n":
+                return MISS
+            if not line.startswith(b"VALUE "):
+                raise ValueError(f"unexpected reply {line!r}")
+
+            length = int(line.split()[3])
+            data = self._file.read(length + 2)[:-2]
+            self._expect(b"END")
+            return pickle.loads(data)
+
+        return self._call(get)
+
+    def set(self, key, value, ttl):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        # memcached: 0 is "never"; anything over 30 days is a timestamp.
+        exptime = 0 if ttl is FOREVER else max(1, int(ttl))
+        if exptime > 30 * 24 * 3600:
+            exptime = int(time.time()) + exptime
+
+        def set(sock):
+            sock.sendall(b"set %s 0 %d %d\r\n%s\r\n"
+                         % (self._key(key), exptime, len(data), data))
+            self._expect(b"STORED")
+
+        self._call(set)
+
+    def delete(self, key):
+        def delete(sock):
+            sock.sendall(b"delete " + self._key(key) + b"\r\n")
+            self._expect(b"DELETED", b"NOT_FOUND")
+
+        self._call(delete)
+
+    def clear(self):
+        def flush(sock):
+            sock.sendall(b"flush_all\r\n")
+            self._expect(b"OK")
+
+        self._call(flush)
+
+
+class Cache:
+    """Tiered cache with TTLs and tag-based invalidation."""
+
+    def __init__(self, tiers, default_ttl=300):
+        self.tiers = tiers
+        self.default_ttl = default_ttl
+
+    def _try(self, func, *args):
+        try:
+            return func(*args)
+        except CacheTierError:
+            return MISS
+
+    def _tag_versions(self, tags):
+        """Current version of each tag, read from the slowest tier."""
+
+        tier = self.tiers[-1]
+        versions = []
+        for tag in tags:
+            version = self._try(tier.get, "tag:" + tag)
+            if version is MISS:
+                version = self._new_tag_version(tag)
+            versions.append(version)
+        return tuple(versions)
+
+    def _new_tag_version(self, tag):
+        version = os.urandom(8).hex()
+        self._try(self.tiers[-1].set, "tag:" + tag, version, FOREVER)
+        return version
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default`."""
+
+        for i, tier in enumerate(self.tiers):
+            entry = self._try(tier.get, key)
+            if entry is MISS:
+                tier.record(False)
+                continue
+
+            value, expires, tags, versions = entry
+            if tags and self._tag_versions(tags) != versions:
+                # Stored under an invalidated tag.
+                tier.record(False)
+                break
+
+            tier.record(True)
+            ttl = expires - time.time()
+            for faster in self.tiers[:i]:
+                self._try(faster.set, key, entry, ttl)
+            return value
+
+        return default
+
+    def set(self, key, value, ttl=None, tags=(), versions=None):
+        """Cache `value` under `key` for `ttl` seconds, tagged with `tags`.
+
+        `versions` are the tags' versions from before `value` was read, if
+        known: a tag invalidated since then makes the entry a miss.
+        """
+
+        ttl = self.default_ttl if ttl is None else ttl
+        tags = tuple(tags)
+        if versions is None:
+            versions = self._tag_versions(tags)
+        entry = (value, time.time() + ttl, tags, versions)
+
+        for tier in self.tiers:
+            self._try(tier.set, key, entry, ttl)
+
+    def get_or_set(self, key, make_value, ttl=None, tags=(), cache_none=True):
+        """Return the cached value for `key`, caching make_value() on a miss.
+
+        With cache_none=False, a None from make_value() isn't kept, for
+        lookups of things that may yet come to exist.
+        """
+
+        value = self.get(key, MISS)
+        if value is MISS:
+            # An invalidation while make_value() runs may have come after
+            # it read its data; storing under the old versions drops it.
+            versions = self._tag_versions(tuple(tags))
+            value = make_value()
+            if value is not None or cache_none:
+                self.set(key, value, ttl, tags, versions)
+        return value
+
+    def delete(self, key):
+        for tier in self.tiers:
+            self._try(tier.delete, key)
+
+    def invalidate(self, *tags):
+        """Make every entry stored with any of `tags` a miss."""
+
+        for tag in tags:
+            self._new_tag_version(tag)
+
+    def clear(self):
+        for tier in self.tiers:
+            self._try(tier.clear)
+
+    def stats(self):
+        """Hits, misses and evictions of each tier, in this process."""
+
+        return {tier.name: tier.stats() for tier in self.tiers}
+
+
+def make_cache(config):
+    """Build the tiers turned on in `config`."""
+
+    tiers = [LocalTier(max_items=config['CACHE_LOCAL_MAX_ITEMS'],
+                       max_ttl=config['CACHE_LOCAL_TTL'])]
+
+    if config['CACHE_SHARED_PATH']:
+        tiers.append(SharedMemoryTier(config['CACHE_SHARED_PATH'],
+                                      slots=config['CACHE_SHARED_SLOTS'],
+                                      slot_size=config['CACHE_SHARED_SLOT_SIZE']))
+
+    if config['CACHE_SERVER']:
+        tiers.append(NetworkTier(config['CACHE_SERVER'],
+                                 prefix=config['CACHE_KEY_PREFIX']))
+
+    return Cache(tiers, default_ttl=config['CACHE_DEFAULT_TTL'])
+
+
+def get_cache():
+    return current_app.extensions['cache']
+
+
+# The current app's cache, for use in views.
+cache = LocalProxy(get_cache)
+
+
+def connect_cache(app):
+    """Give the provided Flask app a shared cache.
+
+    Nothing is opened until the cache is first used, so this is safe to call
+    before gunicorn forks its workers.
+    """
+
+    app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+    app.config.setdefault('CACHE_LOCAL_MAX_ITEMS', 1024)
+    app.config.setdefault('CACHE_LOCAL_TTL', 5)
+    app.config.setdefault(
+        'CACHE_SHARED_PATH',
+        os.path.join(app.instance_path, 'warbler-cache.mmap'))
+    app.config.setdefault('CACHE_SHARED_SLOTS', 4096)
+    app.config.setdefault('CACHE_SHARED_SLOT_SIZE', 1024)
+    app.config.setdefault('CACHE_SERVER', os.environ.get('CACHE_SERVER'))
+    app.config.setdefault('CACHE_KEY_PREFIX', 'warbler:')
+
+    app.extensions['cache'] = make_cache(app.config)
@@ -0,0 +1,180 @@
+"""Response compression for Warbler.
+
+WSGI middleware that gzip- or brotli-encodes responses according to the
+client's Accept-Encoding. Output is compressed and flushed chunk by chunk as
+the app produces it, so streamed pages stay streamed; nothing is buffered
+beyond what the compressor holds.
+
+Responses are left alone when they are small, already encoded (e.g.
+precompressed assets), not a compressible content type (e.g. images), or
+anything other than a 200.
+"""
+
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+class GzipCompressor:
+    """gzip stream that can be flushed after every chunk."""
+
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._z.compress(chunk) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """brotli stream that can be flushed after every chunk."""
+
+    def __init__(self, quality):
+        # Imported here so workers only load brotli once a client asks for it.
+        import brotli
+        self._b = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk):
+        return self._b.process(chunk) + self._b.flush()
+
+    def finish(self):
+        return self._b.finish()
+
+
+def is_compressible(mimetype):
+    """Is a response of this mimetype worth compressing?"""
+
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+class CompressedIterable:
+    """Compress a WSGI app iterable as it is consumed."""
+
+    def __init__(self, app_iter, compressor):
+        self.app_iter = app_iter
+        self.compressor = compressor
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            if chunk:
+                data = self.compressor.compress(chunk)
+                if data:
+                    yield data
+
+        yield self.compressor.finish()
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class Compress:
+    """WSGI middleware negotiating gzip/brotli response compression."""
+
+    def __init__(self, app, min_size=500, gzip_level=6, brotli_quality=4):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def negotiate(self, environ):
+        """Pick 'br', 'gzip' or None from the request's Accept-Encoding."""
+
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        best = None
+        # On equal quality, brotli wins: it is smaller at similar cost.
+        for encoding in ('br', 'gzip'):
+            quality = accept[encoding]
+            if quality and (best is None or quality > best[1]):
+                best = (encoding, quality)
+
+        return best and best[0]
+
+    def make_compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.gzip_level)
+
+    def should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+
+        if 'Content-Encoding' in headers:
+            return False
+
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        if not is_compressible(mimetype):
+            return False
+
+        length = headers.get('Content-Length')
+        if length is not None and int(length) < self.min_size:
+            return False
+
+        return True
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ)
+        compressing = []
+
+        def compressing_start_response(status, headers, exc_info=None):
+            headers = Headers(headers)
+
+            if encoding and self.should_compress(status, headers):
+                compressing.append(encoding)
+                headers['Content-Encoding'] = encoding
+                headers.remove('Content-Length')
+
+                # The encoded body is a different representation, so a
+                # strong validator no longer holds.
+                etag = headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    headers['ETag'] = f"W/{etag}"
+
+            mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+            if is_compressible(mimetype):
+                vary = headers.get('Vary')
+                if not vary:
+                    headers['Vary'] = 'Accept-Encoding'
+                elif 'accept-encoding' not in vary.lower():
+                    headers['Vary'] = f"{vary}, Accept-Encoding"
+
+            return start_response(status, headers.to_wsgi_list(), exc_info)
+
+        app_iter = self.app(environ, compressing_start_response)
+
+        if not compressing:
+            return app_iter
+
+        return CompressedIterable(app_iter, self.make_compressor(encoding))
+
+
+def connect_compression(app):
+    """Compress responses of the provided Flask app."""
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+
+    app.wsgi_app = Compress(
+        app.wsgi_app,
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        gzip_level=app.config['COMPRESS_GZIP_LEVEL'],
+        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+    )
@@ -0,0 +1,162 @@
+"""Bulk export of a user's data as NDJSON.
+
+One JSON object per line, each with a "type": the user's profile first,
+then their messages (archived ones included), the messages they like, the
+users they follow and the users following them. For example:
+
+    {"type": "profile", "id": 1, "username": "alice", ...}
+    {"type": "message", "id": 7, "timestamp": "2020-01-01T10:00:00", ...}
+    {"type": "like", "message_id": 9}
+    {"type": "following", "user_id": 2}
+    {"type": "follower", "user_id": 3}
+
+The user's messages, likes and follows are read from their shard, and
+their followers from every shard (shards.py). Rows are read through
+server-side cursors, EXPORT_BATCH at a time
+(Query.yield_per), and written as they're read, so an export takes the
+same memory however much the user has posted. Only plain columns are
+selected: no ORM objects are built, and nothing is held by the session.
+"""
+
+import heapq
+import json
+import sys
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from archive import archived_user_likes, archived_user_messages
+from models import db, User, Message, Follows, Like
+from shards import every_shard, home_session, session_for
+
+PROFILE_COLUMNS = (User.id, User.username, User.email, User.image_url,
+                   User.header_image_url, User.bio, User.location)
+
+
+def _stream(query):
+    return query.yield_per(current_app.config['EXPORT_BATCH'])
+
+
+def export_records(user_id):
+    """The user's data as dicts, in export order; nothing if no such user."""
+
+    profile = (db.session.query(*PROFILE_COLUMNS)
+               .filter(User.id == user_id)
+               .first())
+    if profile is None:
+        return
+    yield dict(profile._asdict(), type='profile')
+    session = home_session(user_id)
+
+    for message_id, timestamp, text in archived_user_messages(user_id):
+        yield {'type': 'message', 'id': message_id,
+               'timestamp': timestamp.isoformat(), 'text': text}
+    for message_id, timestamp, text in _stream(
+            session.query(Message.id, Message.timestamp, Message.text)
+            .filter(Message.user_id == user_id)
+            .order_by(Message.id)):
+        yield {'type': 'message', 'id': message_id,
+               'timestamp': timestamp.isoformat(), 'text': text}
+
+    for message_id in archived_user_likes(user_id):
+        yield {'type': 'like', 'message_id': message_id}
+    for (message_id,) in _stream(
+            session.query(Like.message_id)
+            .filter(Like.user_id == user_id)
+            .order_by(Like.id)):
+        yield {'type': 'like', 'message_id': message_id}
+
+    for (followed_id,) in _stream(
+            session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id)
+            .order_by(Follows.user_being_followed_id)):
+        yield {'type': 'following', 'user_id': followed_id}
+
+    # Each follow is on its follower's shard; a follow being moved between
+    # shards is briefly on both.
+    followers = heapq.merge(*(
+        _stream(session_for(number).query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == user_id)
+                .order_by(Follows.user_following_id))
+        for number in every_shard()))
+    last = None
+    for (follower_id,) in followers:
+        if follower_id != last:
+            yield {'type': 'follower', 'user_id': follower_id}
+        last = follower_id
+
+
+def export_chunks(user_id, compress=False):
+    """The user's export as bytes, in chunks of about EXPORT_CHUNK_SIZE.
+
+    With `compress`, the chunks make up a gzip file.
+    """
+
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    gzipper = (zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+               if compress else None)
+
+    def output(lines):
+        data = '\n'.join(lines).encode('utf-8') + b'\n'
+        return gzipper.compress(data) if gzipper else data
+
+    lines, size = [], 0
+    for record in export_records(user_id):
+        line = encoder.encode(record)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            data = output(lines)
+            if data:
+                yield data
+            lines, size = [], 0
+
+    if lines:
+        data = output(lines)
+        if data:
+            yield data
+    if gzipper:
+        yield gzipper.flush()
+
+
+@click.command('export')
+@click.argument('user')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help="File to write (default: standard output).")
+@click.option('--gzip', 'compress', is_flag=True,
+              help="gzip the output (the default for a .gz --output).")
+@with_appcontext
+def export_command(user, output, compress):
+    """Export a user's profile, messages, likes and follows as NDJSON.
+
+    USER is a username or a user id.
+    """
+
+    user_id = (db.session.query(User.id)
+               .filter(User.username == user)
+               .scalar())
+    if user_id is None and user.isdigit():
+        user_id = db.session.query(User.id).filter(User.id == int(user)).scalar()
+    if user_id is None:
+        raise click.ClickException(f"No user {user!r}.")
+
+    compress = compress or bool(output and output.endswith('.gz'))
+    out = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        for chunk in export_chunks(user_id, compress):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+def connect_export(app):
+    """Add user data export to the provided Flask app."""
+
+    app.config.setdefault('EXPORT_BATCH', 10000)
+    app.config.setdefault('EXPORT_CHUNK_SIZE', 64 * 1024)
+
+    app.cli.add_command(export_command)
@@ -0,0 +1,277 @@
+"""Shared database fixtures for the Warbler tests.
+
+The schema is created once, in a template database, and only rebuilt when the
+models change. Each test process clones its own database from the template
+(one per pytest-xdist worker), so parallel workers never share rows.
+
+Every DatabaseTestCase test runs inside an outer transaction on a single
+connection. The app's session works in a SAVEPOINT within it, so code under
+test can commit and roll back as usual; at the end of the test the outer
+transaction is rolled back and the database is clean again, without any DDL.
+"""
+
+import hashlib
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import create_app
+from availability import get_availability_index
+from cache import get_cache
+from like_counts import get_like_counter
+from models import db
+from notifications import get_notification_buffer
+from tags import get_trending
+
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL',
+                              "postgresql:///warbler-test")
+SCHEMA_COMMENT = "warbler-schema:"
+
+# Key for the advisory lock serializing template builds between workers.
+TEMPLATE_LOCK = 6451
+
+
+def worker_database_url():
+    """URL of this process's database: one per pytest-xdist worker."""
+
+    url = make_url(DATABASE_URL)
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker:
+        url.database = f"{url.database}-{worker}"
+    return url
+
+
+def template_name():
+    return f"{make_url(DATABASE_URL).database}-template"
+
+
+def schema_fingerprint():
+    """Hash of the DDL for the current models."""
+
+    dialect = postgresql.dialect()
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect))
+                   for index in sorted(table.indexes, key=lambda i: i.name))
+        # DDL attached to tables (triggers, partitions) is part of the schema.
+        for listener in table.dispatch.after_create:
+            ddl.append(str(getattr(listener, 'statement', '')))
+
+    return hashlib.sha1("\n".join(ddl).encode()).hexdigest()
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _database_comment(conn, name):
+    return conn.execute(
+        "SELECT shobj_description(oid, 'pg_database') FROM pg_database "
+        "WHERE datname = %s", (name,)).scalar()
+
+
+def build_template(admin, name, fingerprint):
+    """(Re)create the template database with the current schema."""
+
+    admin.execute(f"DROP DATABASE IF EXISTS {_quote(name)}")
+    admin.execute(f"CREATE DATABASE {_quote(name)}")
+
+    url = make_url(DATABASE_URL)
+    url.database = name
+    engine = create_engine(url)
+    try:
+        db.metadata.create_all(bind=engine)
+    finally:
+        engine.dispose()
+
+    # Written last, so a half-built template is rebuilt by the next run.
+    admin.execute(f"COMMENT ON DATABASE {_quote(name)} IS %s",
+                  (SCHEMA_COMMENT + fingerprint,))
+
+
+@contextmanager
+def _template_lock():
+    """A connection to the server, holding the template's lock."""
+
+    admin_url = make_url(DATABASE_URL)
+    admin_url.database = 'postgres'
+    admin = create_engine(admin_url, isolation_level='AUTOCOMMIT')
+    try:
+        with admin.connect() as conn:
+            conn.execute("SELECT pg_advisory_lock(%s)", (TEMPLATE_LOCK,))
+            try:
+                yield conn
+            finally:
+                conn.execute("SELECT pg_advisory_unlock(%s)", (TEMPLATE_LOCK,))
+    finally:
+        admin.dispose()
+
+
+def _clone_template(conn, name):
+    # Cloning needs the template to have no other connections, so it stays
+    # under the lock too. It's a file copy: fast.
+    conn.execute(f"DROP DATABASE IF EXISTS {_quote(name)}")
+    conn.execute(f"CREATE DATABASE {_quote(name)} "
+                 f"TEMPLATE {_quote(template_name())}")
+
+
+_prepared = False
+
+
+def prepare_database():
+    """Give this process a fresh database cloned from the template."""
+
+    global _prepared
+    if _prepared:
+        return
+
+    url = worker_database_url()
+    template = template_name()
+    fingerprint = schema_fingerprint()
+
+    # The app may already hold connections to the old database.
+    db.get_engine(app).dispose()
+
+    with _template_lock() as conn:
+        comment = _database_comment(conn, template)
+        if comment != SCHEMA_COMMENT + fingerprint:
+            build_template(conn, template, fingerprint)
+        _clone_template(conn, url.database)
+
+    _prepared = True
+
+
+def prepare_shard_databases(count):
+    """URLs of `count` fresh databases besides this process's, for shards."""
+
+    prepare_database()
+    urls = []
+    with _template_lock() as conn:
+        for number in range(1, count + 1):
+            url = worker_database_url()
+            url.database = f"{url.database}-shard{number}"
+            _clone_template(conn, url.database)
+            urls.append(str(url))
+    return urls
+
+
+# Apps created by the tests themselves use this process's database too.
+os.environ['DATABASE_URL'] = str(worker_database_url())
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'WTF_CSRF_ENABLED': False,
+    'DEBUG_TB_ENABLED': False,
+    # Cheap password hashes: tests sign up a handful of users each.
+    'BCRYPT_LOG_ROUNDS': 4,
+    # Buckets are committed outside the test's transaction; test_throttle
+    # turns this on and cleans up after itself.
+    'THROTTLE_ENABLED': False,
+    # Only the in-process cache tier, emptied before every test.
+    'CACHE_SHARED_PATH': None,
+    'CACHE_SERVER': None,
+    # Follow queries read the follows table; test_follow_graph builds
+    # snapshots in a temporary directory.
+    'FOLLOW_GRAPH_DIR': None,
+    # A trending sketch private to the test process.
+    'TRENDING_PATH': None,
+    # test_archive archives to a temporary directory.
+    'MESSAGES_ARCHIVE_DIR': None,
+    # test_slow_queries turns the slow-query log on.
+    'SLOW_QUERY_THRESHOLD': None,
+    # Counters private to the test process; test_throttle shares them.
+    'METRICS_DIR': None,
+    # Requests flush, so tests see when; a thread would race them.
+    'LIKE_COUNT_FLUSH_THREAD': False,
+    'NOTIFICATION_FLUSH_THREAD': False,
+    # The filter is built by the request, on the test's connection.
+    'AVAILABILITY_BUILD_THREAD': False,
+}
+
+app = create_app(TEST_CONFIG)
+app.app_context().push()
+
+
+@contextmanager
+def count_queries():
+    """Record the SQL statements run inside the block, in a list."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class DatabaseTestCase(TestCase):
+    """Base class for tests that use the database.
+
+    Everything a test writes, committed or not, is rolled back after it.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        prepare_database()
+
+    def setUp(self):
+        super().setUp()
+
+        # A fresh app context per test, so nothing left on g (like g.user)
+        # outlives the session it was loaded in.
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+        # Ids are reused between tests, so cached lookups would be stale.
+        get_cache().clear()
+        get_trending().clear()
+        get_like_counter().clear()
+        get_availability_index().clear()
+        get_notification_buffer().clear()
+
+        self._finished = False
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+
+        self._app_session = db.session
+        db.session = scoped_session(self._savepoint_session,
+                                    scopefunc=self._app_session.registry.scopefunc)
+
+        self.addCleanup(self._rollback)
+
+    def _savepoint_session(self):
+        session = db.create_session({'bind': self._connection, 'binds': {}})()
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            # The app committed or rolled back: start the next savepoint.
+            if (transaction.nested and not transaction._parent.nested
+                    and not self._finished):
+                session.expire_all()
+                session.begin_nested()
+
+        return session
+
+    def _rollback(self):
+        # Release the savepoint first: closing the session leaves it open.
+        self._finished = True
+        db.session.rollback()
+        db.session.remove()
+        db.session = self._app_session
+
+        self._transaction.rollback()
+        self._connection.close()
@@ -0,0 +1,469 @@
+"""Read-optimized snapshot of the Warbler follow graph.
+
+Questions like "does this user follow me back?" or "how many of the people I
+follow also follow them?" used to load whole ORM collections. Here they are
+binary searches and sorted-array intersections over a snapshot of the
+follows table:
+
+- the graph is stored twice in CSR form, by follower (who a user follows)
+  and by followed user (who follows them). Each is three .npy files: the
+  user ids that have edges, offsets into the neighbour list, and the
+  neighbour ids, sorted within each user;
+- workers np.load() them with mmap_mode='r', so every worker on the host
+  shares one copy in the page cache, and only the pages touched get read;
+- `flask follow-graph refresh` (run it every minute or so) replays the
+  `follow_changes` log, which a trigger on `follows` fills, onto the
+  previous snapshot and writes a new version next to it. CURRENT is then
+  swapped atomically; workers notice and map the new files;
+- each request overlays the changes logged since its snapshot, so a follow
+  shows up straight away rather than on the next refresh.
+
+Follows live on the follower's shard (shards.py), so each shard has its own
+log; a snapshot keeps its position in each, and the logs are merged by time.
+
+Without a snapshot (or when the refresh job has fallen far behind) queries
+fall back to the follows table. NumPy is imported on first use.
+"""
+
+import json
+import os
+import shutil
+import time
+from contextlib import ExitStack
+from itertools import chain
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+
+from models import db, Follows
+from shards import every_shard, home_session, scatter, shard_connections
+
+follow_graph_cli = AppGroup(
+    'follow-graph', help="Maintain the follow graph snapshot.")
+
+# Changes a snapshot hasn't seen: logged after it, or by a transaction that
+# was still in progress when it was taken.
+CHANGES_SINCE = db.text("""
+    SELECT id, follower_id, followed_id, followed, changed_at
+    FROM follow_changes
+    WHERE id > :change_id OR txid >= :xmin
+    ORDER BY id
+""")
+
+_snapshots = {}
+
+
+def _merge_changes(logs):
+    """One list of changes from each shard's, oldest first."""
+
+    # A pair's changes are on one shard, until the follower's bucket moves.
+    return sorted(chain.from_iterable(logs), key=lambda change: change[4])
+
+
+def _edge_keys(np, src, dst):
+    """Pack (src, dst) id pairs into sortable int64 keys."""
+
+    return (src.astype(np.int64) << 32) | dst.astype(np.int64)
+
+
+class Adjacency:
+    """One direction of the follow graph, in CSR form."""
+
+    def __init__(self, rows, indptr, neighbors):
+        self.rows = rows
+        self.indptr = indptr
+        self.neighbors = neighbors
+
+    @classmethod
+    def from_keys(cls, keys):
+        """Build from sorted, unique (user << 32 | neighbor) keys."""
+
+        import numpy as np
+
+        rows, starts = np.unique(keys >> 32, return_index=True)
+        return cls(rows.astype(np.int32),
+                   np.append(starts, len(keys)).astype(np.int64),
+                   (keys & 0xffffffff).astype(np.int32))
+
+    def keys(self):
+        import numpy as np
+
+        users = np.repeat(self.rows, np.diff(self.indptr))
+        return _edge_keys(np, users, self.neighbors)
+
+    def __getitem__(self, user_id):
+        """Sorted neighbour ids of `user_id` (a view into the snapshot)."""
+
+        i = self.rows.searchsorted(user_id)
+        if i < len(self.rows) and self.rows[i] == user_id:
+            return self.neighbors[self.indptr[i]:self.indptr[i + 1]]
+        return self.neighbors[:0]
+
+    def __len__(self):
+        return len(self.neighbors)
+
+    def save(self, directory, name):
+        import numpy as np
+
+        for part in ('rows', 'indptr', 'neighbors'):
+            np.save(os.path.join(directory, f'{name}.{part}.npy'),
+                    getattr(self, part))
+
+    @classmethod
+    def load(cls, directory, name):
+        import numpy as np
+
+        return cls(*(np.load(os.path.join(directory, f'{name}.{part}.npy'),
+                             mmap_mode='r')
+                     for part in ('rows', 'indptr', 'neighbors')))
+
+
+class Snapshot:
+    """Both directions of the graph, and the log positions they reflect.
+
+    `log` holds a (change_id, xmin) position for each shard, in order.
+    """
+
+    def __init__(self, following, followers, log, version=None):
+        self.following = following
+        self.followers = followers
+        self.log = log
+        self.version = version
+
+    def save(self, directory, version):
+        self.following.save(directory, 'following')
+        self.followers.save(directory, 'followers')
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump({'log': self.log, 'edges': len(self.following)}, f)
+        self.version = version
+
+    @classmethod
+    def load(cls, directory, version):
+        path = os.path.join(directory, version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        # Snapshots from before sharding have a single position.
+        log = meta.get('log') or [[meta['change_id'], meta['xmin']]]
+        return cls(Adjacency.load(path, 'following'),
+                   Adjacency.load(path, 'followers'),
+                   [tuple(position) for position in log], version)
+
+
+def current_version(directory):
+    """Name of the snapshot CURRENT points to, or None."""
+
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_snapshot(directory):
+    """The current snapshot in `directory`, mapped once per process."""
+
+    version = current_version(directory)
+    if version is None:
+        return None
+
+    snapshot = _snapshots.get(directory)
+    if snapshot is None or snapshot.version != version:
+        snapshot = _snapshots[directory] = Snapshot.load(directory, version)
+    return snapshot
+
+
+class FollowGraph:
+    """Follow queries against a snapshot plus the changes made since."""
+
+    def __init__(self, snapshot, changes=()):
+        self.snapshot = snapshot
+        self._memo = {}
+
+        # Only the last change to each pair counts.
+        state = {}
+        for _id, follower_id, followed_id, followed, _at in changes:
+            state[follower_id, followed_id] = followed
+
+        self._changes = {'following': {}, 'followers': {}}
+        for (follower_id, followed_id), followed in state.items():
+            self._changes['following'].setdefault(
+                follower_id, ([], []))[not followed].append(followed_id)
+            self._changes['followers'].setdefault(
+                followed_id, ([], []))[not followed].append(follower_id)
+
+    def _neighbors(self, direction, user_id):
+        import numpy as np
+
+        key = (direction, user_id)
+        if key not in self._memo:
+            ids = getattr(self.snapshot, direction)[user_id]
+            added, removed = self._changes[direction].get(user_id, ((), ()))
+            if removed:
+                ids = ids[~np.isin(ids, removed)]
+            if added:
+                ids = np.union1d(ids, added).astype(np.int32)
+            self._memo[key] = ids
+        return self._memo[key]
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._neighbors('following', user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._neighbors('followers', user_id)
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        ids = self.following(follower_id)
+        i = ids.searchsorted(followed_id)
+        return bool(i < len(ids) and ids[i] == followed_id)
+
+    def mutuals(self, user_id):
+        """Ids of the users who follow `user_id` and are followed back."""
+
+        import numpy as np
+
+        return np.intersect1d(self.following(user_id),
+                              self.followers(user_id), assume_unique=True)
+
+    def followers_you_know(self, viewer_id, user_id):
+        """Ids of the users `viewer_id` follows who follow `user_id`."""
+
+        import numpy as np
+
+        return np.intersect1d(self.following(viewer_id),
+                              self.followers(user_id), assume_unique=True)
+
+
+class DatabaseGraph(FollowGraph):
+    """The same queries, answered from the follows tables.
+
+    Who a user follows is on their shard; who follows them, on any.
+    """
+
+    def __init__(self):
+        self._memo = {}
+
+    def _neighbors(self, direction, user_id):
+        import numpy as np
+
+        key = (direction, user_id)
+        if key in self._memo:
+            return self._memo[key]
+
+        if direction == 'following':
+            ids = [i for (i,) in home_session(user_id).query(
+                Follows.user_being_followed_id).filter(
+                    Follows.user_following_id == user_id)]
+        else:
+            def followers(session, _):
+                return [i for (i,) in session.query(
+                    Follows.user_following_id).filter(
+                        Follows.user_being_followed_id == user_id)]
+
+            # A follow being moved between shards is briefly on both.
+            ids = set(chain.from_iterable(scatter(followers, every_shard())))
+
+        self._memo[key] = np.array(sorted(ids), dtype=np.int32)
+        return self._memo[key]
+
+
+def load_graph():
+    """A FollowGraph for this request: the snapshot plus recent changes."""
+
+    config = current_app.config
+    directory = config['FOLLOW_GRAPH_DIR']
+    snapshot = load_snapshot(directory) if directory else None
+    if snapshot is None or len(snapshot.log) != len(every_shard()):
+        # None yet, or from before shards were added.
+        return DatabaseGraph()
+
+    limit = config['FOLLOW_GRAPH_MAX_OVERLAY']
+
+    def since(session, position):
+        change_id, xmin = position
+        return session.execute(
+            CHANGES_SINCE, {'change_id': change_id, 'xmin': xmin}
+        ).fetchmany(limit + 1)
+
+    changes = _merge_changes(scatter(since, dict(enumerate(snapshot.log))))
+    if len(changes) > limit:
+        # The refresh job has stopped; the snapshot is too stale to patch.
+        return DatabaseGraph()
+
+    return FollowGraph(snapshot, changes)
+
+
+def follow_graph():
+    """The follow graph, loaded once per request."""
+
+    if 'follow_graph' not in g:
+        g.follow_graph = load_graph()
+    return g.follow_graph
+
+
+def _forget_graph():
+    # Tests run several requests in one app context, and so share `g`.
+    g.pop('follow_graph', None)
+
+
+def _apply(np, keys, added, removed):
+    """Merge sorted `added` keys into sorted `keys`, dropping `removed`."""
+
+    def present(values):
+        i = keys.searchsorted(values)
+        found = np.zeros(len(values), dtype=bool)
+        inside = i < len(keys)
+        found[inside] = keys[i[inside]] == values[inside]
+        return i, found
+
+    i, found = present(removed)
+    keys = np.delete(keys, i[found])
+
+    i, found = present(added)
+    added = added[~found]
+    return np.insert(keys, keys.searchsorted(added), added)
+
+
+def build_snapshot(conns, previous=None, max_changes=None):
+    """A new Snapshot, from `previous` plus the change logs if possible.
+
+    `conns` has a connection to each shard, in order. Run it in a
+    REPEATABLE READ transaction on each, so the log positions and the
+    follows they describe come from the same view of each database.
+    """
+
+    import numpy as np
+
+    xmins = [conn.execute(
+        "SELECT txid_snapshot_xmin(txid_current_snapshot())").scalar()
+        for conn in conns]
+
+    logs = None
+    if previous is not None and len(previous.log) == len(conns):
+        logs = []
+        for conn, (change_id, xmin) in zip(conns, previous.log):
+            result = conn.execute(CHANGES_SINCE, change_id=change_id,
+                                  xmin=xmin)
+            logs.append(result.fetchmany(max_changes + 1) if max_changes
+                        else result.fetchall())
+        if max_changes and sum(map(len, logs)) > max_changes:
+            # Cheaper to read the whole table again than to replay this.
+            logs = None
+
+    if logs is None:
+        from recommend import load_all_follows
+
+        change_ids = [conn.execute(
+            "SELECT coalesce(max(id), 0) FROM follow_changes").scalar()
+            for conn in conns]
+        follower, followed = load_all_follows(conns)
+        following = np.unique(_edge_keys(np, follower, followed))
+        followers = np.unique(_edge_keys(np, followed, follower))
+
+    else:
+        change_ids = [max([change_id] + [c[0] for c in log])
+                      for (change_id, _), log in zip(previous.log, logs)]
+        state = {}
+        for _id, follower_id, followed_id, followed, _at in _merge_changes(
+                logs):
+            state[follower_id, followed_id] = followed
+
+        pairs = {followed: np.array([p for p, f in state.items()
+                                     if f == followed],
+                                    dtype=np.int64).reshape(-1, 2)
+                 for followed in (True, False)}
+        following = _apply(
+            np, previous.following.keys(),
+            np.sort(_edge_keys(np, pairs[True][:, 0], pairs[True][:, 1])),
+            np.sort(_edge_keys(np, pairs[False][:, 0], pairs[False][:, 1])))
+        followers = _apply(
+            np, previous.followers.keys(),
+            np.sort(_edge_keys(np, pairs[True][:, 1], pairs[True][:, 0])),
+            np.sort(_edge_keys(np, pairs[False][:, 1], pairs[False][:, 0])))
+
+    return Snapshot(Adjacency.from_keys(following),
+                    Adjacency.from_keys(followers),
+                    list(zip(change_ids, xmins)))
+
+
+def refresh_graph(conns, directory, full=False, max_changes=None):
+    """Write a new snapshot of the shards `conns` to `directory`.
+
+    Returns the new Snapshot, now current. Older versions are removed,
+    except the one before, which workers may still be reading; so are the
+    log entries both versions have seen.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    previous = load_snapshot(directory)
+
+    with ExitStack() as stack:
+        for conn in conns:
+            stack.enter_context(conn.begin())
+        snapshot = build_snapshot(conns, None if full else previous,
+                                  max_changes)
+
+    version = f"v{time.time_ns()}"
+    building = os.path.join(directory, version + '.tmp')
+    os.makedirs(building)
+    snapshot.save(building, version)
+    os.rename(building, os.path.join(directory, version))
+
+    pointer = os.path.join(directory, 'CURRENT.tmp')
+    with open(pointer, 'w') as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(directory, 'CURRENT'))
+
+    keep = {version, previous and previous.version}
+    for name in os.listdir(directory):
+        if name.startswith('v') and name not in keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    if previous is not None and len(previous.log) == len(conns):
+        for conn, (change_id, xmin) in zip(conns, previous.log):
+            with conn.begin():
+                conn.execute(
+                    db.text("DELETE FROM follow_changes "
+                            "WHERE id <= :change_id AND txid < :xmin"),
+                    change_id=change_id, xmin=xmin)
+
+    return snapshot
+
+
+@follow_graph_cli.command('refresh')
+@click.option('--full', is_flag=True,
+              help="Reread the follows table instead of the change log.")
+def refresh_command(full):
+    """Bring the follow graph snapshot up to date."""
+
+    config = current_app.config
+    start = time.perf_counter()
+
+    with shard_connections(isolation_level='REPEATABLE READ') as conns:
+        snapshot = refresh_graph(
+            conns, config['FOLLOW_GRAPH_DIR'], full=full,
+            max_changes=config['FOLLOW_GRAPH_MAX_CHANGES'])
+
+    click.echo(f"Wrote {snapshot.version} ({len(snapshot.following)} follows) "
+               f"in {time.perf_counter() - start:.1f}s.")
+
+
+def connect_follow_graph(app):
+    """Add the follow graph snapshot to the provided Flask app."""
+
+    app.config.setdefault(
+        'FOLLOW_GRAPH_DIR', os.path.join(app.instance_path, 'follow-graph'))
+    # Unrefreshed changes a request will patch in before giving up on the
+    # snapshot, and the most a refresh replays before rereading the table.
+    app.config.setdefault('FOLLOW_GRAPH_MAX_OVERLAY', 5000)
+    app.config.setdefault('FOLLOW_GRAPH_MAX_CHANGES', 1000000)
+
+    app.before_request(_forget_graph)
+    app.add_template_global(follow_graph, 'follow_graph')
+    app.cli.add_command(follow_graph_cli)
@@ -0,0 +1,22 @@
+"""Gunicorn settings for Warbler.
+
+Gunicorn loads this file automatically when started from the project root.
+"""
+
+
+def pre_fork(server, worker):
+    """With --preload, close the master's pooled database connections.
+
+    The app is loaded once in the master and then forked; anything it has
+    connected to the database (e.g. a CLI step or warm-up query) must not be
+    inherited by the workers. models.py also refuses to hand out a
+    connection in any process other than the one that opened it.
+    """
+
+    if not server.cfg.preload_app:
+        return
+
+    from models import db
+
+    with server.app.wsgi().app_context():
+        db.engine.dispose()
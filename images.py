@@ -0,0 +1,463 @@
+"""Image proxy for Warbler: resized, cached avatars and header images.
+
+User avatars and headers are arbitrary URLs. Rather than have every feed row
+pull the original image, templates link to ``/img/<variant>/<key>`` (via the
+``img`` filter). The first request for a variant fetches the source once,
+resizes and re-encodes it, and stores the result in an on-disk,
+content-addressed cache; later requests are served straight from disk with
+long-lived cache headers.
+
+Cache layout (under ``IMAGE_CACHE_DIR``)::
+
+    sources/<key>             source URL the key was issued for
+    refs/<variant>/<key>      content hash of the rendered variant
+    blobs/<hash[:2]>/<hash>   rendered image bytes
+
+The cache is bounded by ``IMAGE_CACHE_MAX_BYTES``, sources and blobs
+together; when it grows past that, the least recently used are evicted.
+Each process adds up what it stores and only walks the cache to evict when
+that passes the limit, or every ``IMAGE_EVICT_INTERVAL`` seconds to count
+what other workers stored. Sources registered within the interval are kept,
+since pages just rendered link to them.
+
+A source that isn't an image Pillow can read, or is more than
+``IMAGE_MAX_SOURCE_PIXELS`` big, is rendered as the default image instead.
+One that can't be fetched is answered with the default image too, but only
+briefly cached, so it's tried again.
+"""
+
+import functools
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import time
+import urllib.parse
+
+from flask import Blueprint, Response, abort, current_app, request
+
+images = Blueprint('images', __name__)
+
+# name: (width, height, crop). Cropped variants are cut to exactly that
+# size; the others are only scaled down to fit inside it.
+VARIANTS = {
+    'avatar': (48, 48, True),
+    'profile': (200, 200, True),
+    'card': (400, 200, True),
+    'hero': (1600, 400, False),
+}
+
+DEFAULT_IMAGE = "/static/images/default-pic.png"
+
+ONE_YEAR = 60 * 60 * 24 * 365
+
+# How long browsers keep the default image served for a failed fetch.
+RETRY_SECONDS = 60
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class BadImage(ValueError):
+    """A source that can't be rendered."""
+
+
+# (cache dir, key): monotonic time this process last wrote or touched the
+# source file, so the template filter doesn't stat the disk for every row
+# of a feed.
+_known_keys = {}
+
+# cache dir: (bytes of blobs, monotonic time they were counted). The count
+# is this process's last walk, plus what it has stored since.
+_blob_bytes = {}
+
+
+def image_key(url):
+    """Return the cache key for a source URL."""
+
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def _cache_dir():
+    return current_app.config['IMAGE_CACHE_DIR']
+
+
+def _path(*parts):
+    return os.path.join(_cache_dir(), *parts)
+
+
+def _write_atomic(path, data):
+    """Write `data` to `path` so readers never see a partial file."""
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def register_source(url):
+    """Record `url` as a proxyable source and return its key."""
+
+    key = image_key(url)
+    known = (_cache_dir(), key)
+    now = time.monotonic()
+
+    # Touched well within the interval, so eviction keeps it while pages
+    # rendered here still link to it.
+    checked_at = _known_keys.get(known)
+    if (checked_at is None or now - checked_at
+            >= current_app.config['IMAGE_EVICT_INTERVAL'] / 2):
+        path = _path('sources', key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            data = url.encode('utf-8')
+            _write_atomic(path, data)
+            _count_stored(len(data))
+        _known_keys[known] = now
+
+    return key
+
+
+def img_url(url, variant):
+    """Template filter: proxied URL for `url` rendered as `variant`."""
+
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown image variant: {variant}")
+
+    return f"/img/{variant}/{register_source(url or DEFAULT_IMAGE)}"
+
+
+def _resolve(host, port):
+    """The address to connect to for `host`.
+
+    Raises ValueError unless every address it resolves to is public, so a
+    source can't point the proxy at the server's own network.
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"Can't resolve {host}: {e}")
+
+    addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"Image source {host} is not public: {address}")
+    return addresses[0]
+
+
+def _connect_to(address, host_port, *args):
+    return socket.create_connection((address, host_port[1]), *args)
+
+
+def _get(url, timeout):
+    """Send a GET for an http(s) `url`; return (connection, response)."""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"Unsupported image source: {url}")
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    address = _resolve(parts.hostname, port)
+
+    if parts.scheme == 'https':
+        conn = http.client.HTTPSConnection(parts.hostname, port,
+                                           timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(parts.hostname, port,
+                                          timeout=timeout)
+    # Connect to the address checked, not to whatever the name resolves to
+    # by then; the Host header and TLS still use the name.
+    conn._create_connection = functools.partial(_connect_to, address)
+
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    try:
+        conn.request('GET', path, headers={'User-Agent': 'Warbler'})
+        return conn, conn.getresponse()
+    except BaseException:
+        conn.close()
+        raise
+
+
+def fetch_source(url):
+    """Return the raw bytes of a source image.
+
+    Site-local ``/static/...`` paths are read from the static folder; http(s)
+    URLs on public addresses are downloaded, up to IMAGE_MAX_SOURCE_BYTES,
+    following at most IMAGE_MAX_REDIRECTS redirects, each checked the same.
+    """
+
+    if url.startswith('/static/'):
+        static = os.path.realpath(current_app.static_folder)
+        path = os.path.realpath(
+            os.path.join(static, url[len('/static/'):].split('?')[0]))
+        if not path.startswith(static + os.sep):
+            raise ValueError(f"Bad static path: {url}")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    if url.startswith(('http://', 'https://')):
+        limit = current_app.config['IMAGE_MAX_SOURCE_BYTES']
+        timeout = current_app.config['IMAGE_FETCH_TIMEOUT']
+        source = url
+
+        for _hop in range(current_app.config['IMAGE_MAX_REDIRECTS'] + 1):
+            conn, resp = _get(url, timeout)
+            try:
+                if resp.status in REDIRECTS and resp.getheader('Location'):
+                    url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                    continue
+                if resp.status != 200:
+                    raise ValueError(
+                        f"Image source answered {resp.status}: {url}")
+                data = resp.read(limit + 1)
+            finally:
+                conn.close()
+            if len(data) > limit:
+                raise ValueError(f"Source image too large: {source}")
+            return data
+
+        raise ValueError(f"Too many redirects: {source}")
+
+    raise ValueError(f"Unsupported image source: {url}")
+
+
+def render_variant(data, variant):
+    """Resize and re-encode source image bytes; return (bytes, mimetype).
+
+    Raises BadImage if Pillow can't read them, or they're too big.
+    """
+
+    # Imported here so workers only load Pillow once they render an image.
+    from PIL import Image, ImageOps
+
+    width, height, crop = VARIANTS[variant]
+
+    try:
+        # Only the header is read here, so the size check is cheap.
+        image = Image.open(io.BytesIO(data))
+        pixels = image.width * image.height
+        if pixels > current_app.config['IMAGE_MAX_SOURCE_PIXELS']:
+            raise BadImage(f"Source image has {pixels} pixels")
+        image = ImageOps.exif_transpose(image)
+
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.convert('RGBA').save(out, 'PNG', optimize=True)
+            return out.getvalue(), 'image/png'
+
+        image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True,
+                                  progressive=True)
+        return out.getvalue(), 'image/jpeg'
+    except BadImage:
+        raise
+    except (Image.DecompressionBombError, OSError, ValueError, TypeError,
+            SyntaxError, EOFError) as e:
+        raise BadImage(f"{type(e).__name__}: {e}") from e
+
+
+def _blob_path(digest):
+    return _path('blobs', digest[:2], digest)
+
+
+def store_blob(data, mimetype):
+    """Store rendered bytes under their content hash; return the hash."""
+
+    ext = 'png' if mimetype == 'image/png' else 'jpg'
+    digest = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    path = _blob_path(digest)
+
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+        _count_stored(len(data))
+
+    return digest
+
+
+def _count_stored(size):
+    """Add `size` bytes to the cache's count; evict if it's past the limit."""
+
+    directory = _cache_dir()
+    total, counted_at = _blob_bytes.get(directory, (None, None))
+    if (total is None or time.monotonic() - counted_at
+            >= current_app.config['IMAGE_EVICT_INTERVAL']):
+        evict()
+        return
+
+    total += size
+    _blob_bytes[directory] = (total, counted_at)
+    if total > current_app.config['IMAGE_CACHE_MAX_BYTES']:
+        evict()
+
+
+def _stored(directory):
+    """(mtime, size, path) of each file under `directory` in the cache."""
+
+    for root, _dirs, files in os.walk(_path(directory)):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield st.st_mtime, st.st_size, path
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict():
+    """Delete least recently used files until under IMAGE_CACHE_MAX_BYTES.
+
+    A ref whose blob is gone is treated as a cache miss and the variant is
+    rendered again. A source goes with its refs, and its key is a 404 until
+    a page registers it again; sources registered within
+    IMAGE_EVICT_INTERVAL are never evicted.
+    """
+
+    limit = current_app.config['IMAGE_CACHE_MAX_BYTES']
+    kept_since = time.time() - current_app.config['IMAGE_EVICT_INTERVAL']
+    stored = list(_stored('blobs'))
+    sources = list(_stored('sources'))
+    total = sum(size for _mtime, size, _path in stored + sources)
+
+    if total > limit:
+        # Evict down to 90% of the limit so we aren't evicting on every
+        # write.
+        target = limit * 0.9
+        stored += [source for source in sources if source[0] < kept_since]
+        for _mtime, size, path in sorted(stored):
+            if total <= target:
+                break
+            _unlink(path)
+            if os.path.dirname(path) == _path('sources'):
+                for variant in VARIANTS:
+                    _unlink(_path('refs', variant, os.path.basename(path)))
+            total -= size
+
+    _blob_bytes[_cache_dir()] = (total, time.monotonic())
+
+
+def get_variant(key, variant):
+    """Return (bytes, digest) for a variant, rendering it on a miss.
+
+    Returns None if no source is registered under `key`.
+    """
+
+    ref = _path('refs', variant, key)
+    digest = _read(ref)
+
+    if digest:
+        digest = digest.decode('ascii')
+        data = _read(_blob_path(digest))
+        if data is not None:
+            # mtime doubles as last-served time for eviction.
+            os.utime(_blob_path(digest))
+            return data, digest
+
+    url = _read(_path('sources', key))
+    if url is None:
+        return None
+
+    try:
+        data, mimetype = render_variant(fetch_source(url.decode('utf-8')),
+                                        variant)
+    except BadImage as e:
+        # Served, and cached, in place of the source: sending the browser
+        # to the original would only hand it the same bad image.
+        current_app.logger.warning("image %s can't be rendered: %s", key, e)
+        return default_variant(variant, ref)
+    digest = store_blob(data, mimetype)
+    _write_atomic(ref, digest.encode('ascii'))
+
+    return data, digest
+
+
+def default_variant(variant, ref=None):
+    """Return (bytes, digest) for the default image as `variant`.
+
+    Stored under `ref` if given, in place of the source's own.
+    """
+
+    data, mimetype = render_variant(fetch_source(DEFAULT_IMAGE), variant)
+    digest = store_blob(data, mimetype)
+    if ref is not None:
+        _write_atomic(ref, digest.encode('ascii'))
+
+    return data, digest
+
+
+@images.route('/img/<variant>/<key>')
+def image_proxy(variant, key):
+    """Serve a resized, cached variant of a registered source image."""
+
+    if (variant not in VARIANTS or len(key) != 32
+            or key.strip('0123456789abcdef')):
+        abort(404)
+
+    cache_control = f"public, max-age={ONE_YEAR}, immutable"
+    try:
+        found = get_variant(key, variant)
+    except (OSError, ValueError) as e:
+        # Source unreachable, or not allowed: never send the browser to it.
+        # The default image stands in, uncached here, until a retry.
+        current_app.logger.warning("image proxy failed for %s: %s", key, e)
+        found = default_variant(variant)
+        cache_control = f"public, max-age={RETRY_SECONDS}"
+
+    if found is None:
+        abort(404)
+
+    data, digest = found
+    mimetype = 'image/png' if digest.endswith('.png') else 'image/jpeg'
+
+    response = Response(data, mimetype=mimetype)
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(digest)
+    return response.make_conditional(request)
+
+
+def connect_images(app):
+    """Set up the image proxy on the provided Flask app."""
+
+    app.config.setdefault(
+        'IMAGE_CACHE_DIR',
+        os.environ.get('IMAGE_CACHE_DIR',
+                       os.path.join(app.instance_path, 'image-cache')))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    app.config.setdefault('IMAGE_EVICT_INTERVAL', 5 * 60)
+    app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('IMAGE_MAX_SOURCE_PIXELS', 40 * 1000 * 1000)
+    app.config.setdefault('IMAGE_FETCH_TIMEOUT', 5)
+    app.config.setdefault('IMAGE_MAX_REDIRECTS', 3)
+
+    app.add_template_filter(img_url, 'img')
+    app.register_blueprint(images)
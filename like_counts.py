@@ -0,0 +1,323 @@
+"""Write-behind like counts for Warbler messages.
+
+Message cards show how many likes a message has. Counting `likes` for
+every card would cost a COUNT per message per render, so the count is kept
+on the message itself, in `messages.like_count`.
+
+Updating that row on every like would make a popular message's row the
+place every liker queues for its lock. Instead each worker adds likes and
+unlikes up in memory, and at most every LIKE_COUNT_FLUSH_SECONDS writes
+them out in one statement per LIKE_COUNT_BATCH messages:
+
+    UPDATE messages SET like_count = like_count + v.delta
+    FROM (VALUES (7, 312), (9, -1), ...) AS v (id, delta)
+    WHERE messages.id = v.id
+
+so a message liked a thousand times a second is updated about once a
+second per worker. Requests that take likes flush when it's time, and so
+does a daemon thread in each worker (LIKE_COUNT_FLUSH_THREAD), so likes
+don't wait for the next one. Until then, the worker that took the likes
+adds them to the count it shows (like_count()); other workers show them
+after the flush. Workers flush what they have left as they exit.
+
+With shards, every flush writes every shard, each in a transaction of its
+own; a message is on one of them, and the others skip its id. A shard
+that fails keeps its counts, and gets them with the next flush.
+
+Counts a worker never flushed (it was killed) are lost. `flask likes
+reconcile` recounts every message's likes from the `likes` table and fixes
+any count that's off; run it now and then, and after adding the column to
+an existing database.
+"""
+
+import atexit
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from metrics import counter
+from models import db
+from shards import get_router, scatter, shard_count
+
+likes_cli = AppGroup('likes', help="Maintain message like counts.")
+
+LIKE_COUNT_UPDATES = counter(
+    'warbler_like_count_updates_total',
+    "Messages whose like count was updated by a write-behind flush.")
+
+
+class LikeCounter:
+    """Like count changes not yet written to the database, by message id."""
+
+    def __init__(self):
+        self._deltas = {}
+        # {shard: deltas} a failed flush left for that shard alone.
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def add(self, message_id, delta):
+        with self._lock:
+            self._deltas[message_id] = self._deltas.get(message_id, 0) + delta
+
+    def pending(self, message_id):
+        return self._deltas.get(message_id, 0)
+
+    def due(self, seconds):
+        return bool(self._deltas or self._retries) and (
+            time.monotonic() - self._flushed_at >= seconds)
+
+    def take(self):
+        """Remove and return the pending changes."""
+
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            self._flushed_at = time.monotonic()
+        return {message_id: delta for message_id, delta in deltas.items()
+                if delta}
+
+    def restore(self, deltas):
+        """Put back changes taken by a flush that failed."""
+
+        for message_id, delta in deltas.items():
+            self.add(message_id, delta)
+
+    def retry(self, shard, deltas):
+        """Keep changes that failed to be written to `shard` alone."""
+
+        with self._lock:
+            retries = self._retries.setdefault(shard, {})
+            for message_id, delta in deltas.items():
+                retries[message_id] = retries.get(message_id, 0) + delta
+
+    def take_retries(self, shard):
+        """Remove and return the changes kept for `shard`."""
+
+        with self._lock:
+            return self._retries.pop(shard, {})
+
+    def clear(self):
+        with self._lock:
+            self._deltas = {}
+            self._retries = {}
+
+
+class FlushTimer:
+    """Calls `flush` every `seconds_key` seconds of config, in a daemon thread.
+
+    The thread starts on the first start() in each process, so workers
+    forked from a preloaded app get one each.
+    """
+
+    def __init__(self, app, flush, seconds_key, name):
+        self.app = app
+        self.flush = flush
+        self.seconds_key = seconds_key
+        self.name = name
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True,
+                                 name=self.name).start()
+
+    def _run(self):
+        while True:
+            # A floor, so a setting of 0 doesn't spin.
+            time.sleep(max(self.app.config[self.seconds_key], 0.01))
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception("%s failed", self.name)
+
+
+def write_deltas(conn, deltas, batch_size):
+    """Add `deltas` ({message id: change}) to the messages' like counts."""
+
+    # Rows are locked in id order, so concurrent flushes can't deadlock.
+    items = sorted(deltas.items())
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        values = ", ".join(f"(:id{i}, :delta{i})" for i in range(len(batch)))
+        params = {}
+        for i, (message_id, delta) in enumerate(batch):
+            params[f'id{i}'] = message_id
+            params[f'delta{i}'] = delta
+        conn.execute(db.text(
+            f"UPDATE messages SET like_count = like_count + v.delta "
+            f"FROM (VALUES {values}) AS v (id, delta) "
+            f"WHERE messages.id = v.id"), params)
+    LIKE_COUNT_UPDATES.inc(len(items))
+
+
+def get_like_counter():
+    """The pending like counts of the current app."""
+
+    app = current_app._get_current_object()
+    return app.extensions['like_counter']
+
+
+def like_count(message):
+    """`message`'s like count, with this worker's unflushed likes."""
+
+    return message.like_count + get_like_counter().pending(message.id)
+
+
+def count_like(message_id, delta):
+    """Record a like (+1) or unlike (-1) of a message by this worker."""
+
+    get_like_counter().add(message_id, delta)
+    timer = current_app.extensions.get('like_count_timer')
+    if timer is not None:
+        timer.start()
+
+
+def flush(conn):
+    """Write out the current app's pending counts on `conn`."""
+
+    counter = get_like_counter()
+    deltas = counter.take()
+    if not deltas:
+        return 0
+    try:
+        write_deltas(conn, deltas, current_app.config['LIKE_COUNT_BATCH'])
+    except Exception:
+        counter.restore(deltas)
+        raise
+    return len(deltas)
+
+
+def flush_if_due():
+    """Write out and commit the pending counts, if it's time to.
+
+    Call it after the request's own commit: the flush is a transaction of
+    its own, so a failed request doesn't take other requests' likes with
+    it.
+    """
+
+    counter = get_like_counter()
+    if counter.due(current_app.config['LIKE_COUNT_FLUSH_SECONDS']):
+        write_to_shards(counter, counter.take())
+
+
+def write_to_shards(counter, deltas, run=scatter):
+    """Write `deltas` to every shard, each in a transaction of its own.
+
+    A shard's changes kept by `counter` go with them. If a shard fails, its
+    changes are logged and kept for it again: the others have theirs, and
+    mustn't count them twice. `run` is scatter(), or _each_shard().
+    """
+
+    batch_size = current_app.config['LIKE_COUNT_BATCH']
+    logger = current_app.logger
+
+    def write(session, number):
+        shard_deltas = dict(deltas)
+        for message_id, delta in counter.take_retries(number).items():
+            shard_deltas[message_id] = shard_deltas.get(message_id, 0) + delta
+        shard_deltas = {message_id: delta for message_id, delta
+                        in shard_deltas.items() if delta}
+        if not shard_deltas:
+            return
+        try:
+            write_deltas(session.connection(), shard_deltas, batch_size)
+            session.commit()
+        except Exception:
+            session.rollback()
+            counter.retry(number, shard_deltas)
+            logger.exception("Like counts not written to shard %d; kept "
+                             "for the next flush", number)
+
+    run(write, {number: number for number in range(shard_count())})
+
+
+def _each_shard(fn, shards):
+    """scatter(), one shard at a time in this thread: at exit, its threads
+    are gone."""
+
+    router = get_router()
+    for number, value in shards.items():
+        if number == 0:
+            fn(db.session(), value)
+            continue
+        session = router.sessionmaker(number)()
+        try:
+            fn(session, value)
+        finally:
+            session.close()
+
+
+def reconcile(conn, batch_size):
+    """Set every message's like count from `likes`; return how many were off.
+
+    Messages are recounted a range of `batch_size` ids at a time, each in
+    its own transaction, so no lock is held for long.
+    """
+
+    top = conn.execute("SELECT coalesce(max(id), 0) FROM messages").scalar()
+    fixed = 0
+    for low in range(0, top + 1, batch_size):
+        with conn.begin():
+            fixed += conn.execute(db.text("""
+                UPDATE messages SET like_count = c.likes
+                FROM (
+                    SELECT m.id, count(l.id) AS likes
+                    FROM messages m LEFT JOIN likes l ON l.message_id = m.id
+                    WHERE m.id >= :low AND m.id < :high
+                    GROUP BY m.id
+                ) c
+                WHERE messages.id = c.id AND messages.like_count <> c.likes
+            """), {'low': low, 'high': low + batch_size}).rowcount
+    return fixed
+
+
+@likes_cli.command('reconcile')
+def reconcile_command():
+    """Recount every message's likes, fixing counts that drifted."""
+
+    if shard_count() > 1:
+        # A message's likes are on its likers' shards, not with it.
+        raise click.UsageError("Can't recount likes across shards.")
+
+    start = time.perf_counter()
+    with db.engine.connect() as conn:
+        fixed = reconcile(conn, current_app.config['LIKE_COUNT_RECONCILE_BATCH'])
+    click.echo(f"Fixed {fixed} like counts in "
+               f"{time.perf_counter() - start:.1f}s.")
+
+
+def connect_like_counts(app):
+    """Add write-behind message like counts to the provided Flask app."""
+
+    app.config.setdefault('LIKE_COUNT_FLUSH_SECONDS', 1.0)
+    app.config.setdefault('LIKE_COUNT_BATCH', 1000)
+    app.config.setdefault('LIKE_COUNT_RECONCILE_BATCH', 100000)
+    app.config.setdefault('LIKE_COUNT_FLUSH_THREAD', True)
+
+    app.extensions['like_counter'] = LikeCounter()
+    if app.config['LIKE_COUNT_FLUSH_THREAD']:
+        app.extensions['like_count_timer'] = FlushTimer(
+            app, flush_if_due, 'LIKE_COUNT_FLUSH_SECONDS',
+            'warbler-like-counts')
+
+    def flush_at_exit():
+        counter = app.extensions['like_counter']
+        if counter.due(0):
+            with app.app_context():
+                write_to_shards(counter, counter.take(), run=_each_shard)
+                db.session.remove()
+
+    atexit.register(flush_at_exit)
+
+    app.add_template_global(like_count)
+    app.cli.add_command(likes_cli)
@@ -0,0 +1,264 @@
+"""Process metrics for Warbler.
+
+A small registry of labelled counters, served at /metrics in the Prometheus
+text format, once METRICS_TOKEN is set: the scraper sends it as a bearer
+token. Without one /metrics is off.
+
+Each process writes its counters to a file of its own in METRICS_DIR,
+memory-mapped so an increment is a store, not a syscall; /metrics sums the
+files of every process on the host, so it reports the same totals whichever
+gunicorn worker answers. Files of exited workers are kept, so totals never
+go down; empty the directory as the server starts to reset them. With
+METRICS_DIR set to None, counters are the answering process's own.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+
+from flask import Blueprint, Response, abort, current_app, request
+
+metrics = Blueprint('metrics', __name__)
+
+
+class CounterFile:
+    """One process's counter values, in a memory-mapped file.
+
+    After a header holding the bytes used, entries are appended: the key's
+    length (and padding), the key, padded to 8 bytes, and the value as a
+    double. Only the owning process writes; values are updated in place,
+    under a lock, since growing the file remaps it.
+    """
+
+    USED = struct.Struct('<Q')
+    LENGTH = struct.Struct('<Ixxxx')
+    VALUE = struct.Struct('<d')
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = os.fstat(self._fd).st_size
+        if size < self.INITIAL_SIZE:
+            size = self.INITIAL_SIZE
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+        # A file left by an earlier process with this pid carries on.
+        self._offsets = {}
+        for key, offset, _value in self.entries(self._map):
+            self._offsets[key] = offset
+
+    @classmethod
+    def entries(cls, data):
+        """(key, value offset, value) of each entry in the file's `data`."""
+
+        if len(data) < cls.USED.size:
+            return
+        (used,) = cls.USED.unpack_from(data, 0)
+        position = cls.USED.size
+        while position < used:
+            (length,) = cls.LENGTH.unpack_from(data, position)
+            start = position + cls.LENGTH.size
+            offset = start + _padded(length)
+            key = bytes(data[start:start + length]).decode('utf-8')
+            (value,) = cls.VALUE.unpack_from(data, offset)
+            yield key, offset, value
+            position = offset + cls.VALUE.size
+
+    def values(self):
+        with self._lock:
+            return {key: value
+                    for key, _offset, value in self.entries(self._map)}
+
+    def set(self, key, value):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            self.VALUE.pack_into(self._map, offset, value)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        (used,) = self.USED.unpack_from(self._map, 0)
+        used = used or self.USED.size
+        offset = used + self.LENGTH.size + _padded(len(encoded))
+        end = offset + self.VALUE.size
+        if end > len(self._map):
+            self._grow(end)
+
+        self.LENGTH.pack_into(self._map, used, len(encoded))
+        start = used + self.LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        self.VALUE.pack_into(self._map, offset, 0.0)
+        # Written last: readers only look as far as this.
+        self.USED.pack_into(self._map, 0, end)
+        self._offsets[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        os.ftruncate(self._fd, size)
+        self._map.close()
+        self._map = mmap.mmap(self._fd, size)
+
+
+def _padded(length):
+    return (length + 7) // 8 * 8
+
+
+_shared = {'directory': None, 'owner': None, 'file': None}
+_shared_lock = threading.Lock()
+
+
+def _process_file():
+    """This process's CounterFile, or None without a METRICS_DIR."""
+
+    directory = _shared['directory']
+    if directory is None:
+        return None
+    owner = (directory, os.getpid())
+    if _shared['owner'] != owner:
+        with _shared_lock:
+            if _shared['owner'] != owner:
+                _shared['file'] = CounterFile(
+                    os.path.join(directory, f'{os.getpid()}.counters'))
+                _shared['owner'] = owner
+    return _shared['file']
+
+
+def _shared_totals(directory):
+    """{name: {label values: value}}, summed over every process's file."""
+
+    totals = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return totals
+    for name in names:
+        if not name.endswith('.counters'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        for key, _offset, value in CounterFile.entries(data):
+            name, *key = json.loads(key)
+            values = totals.setdefault(name, {})
+            values[tuple(key)] = values.get(tuple(key), 0) + value
+    return totals
+
+
+class Counter:
+    """A monotonically increasing count, split by label values."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return json.dumps([self.name, *key])
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        shared = _process_file()
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's counts are in the parent's file.
+                self._values, self._pid = {}, os.getpid()
+            value = self._values[key] = self._values.get(key, 0) + amount
+            if shared is not None:
+                shared.set(self._key(key), value)
+
+    def value(self, **labels):
+        """The count in this process."""
+
+        key = tuple(str(labels[label]) for label in self.labels)
+        if self._pid != os.getpid():
+            return 0
+        return self._values.get(key, 0)
+
+    def render(self, values=None):
+        """The counter in the text format: its `values` if given, else this
+        process's."""
+
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} counter"]
+
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+
+        for key, value in sorted(values.items()):
+            value = int(value) if value == int(value) else value
+            if key:
+                pairs = ",".join(f'{label}="{_escape(v)}"'
+                                 for label, v in zip(self.labels, key))
+                lines.append(f"{self.name}{{{pairs}}} {value}")
+            else:
+                lines.append(f"{self.name} {value}")
+
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+_registry = {}
+
+
+def counter(name, help, labels=()):
+    """Return the counter called `name`, creating it on first use."""
+
+    if name not in _registry:
+        _registry[name] = Counter(name, help, labels)
+    return _registry[name]
+
+
+def render_metrics():
+    directory = _shared['directory']
+    if directory is None:
+        return "\n".join(c.render()
+                         for _name, c in sorted(_registry.items())) + "\n"
+
+    totals = _shared_totals(directory)
+    return "\n".join(c.render(totals.get(name, {}))
+                     for name, c in sorted(_registry.items())) + "\n"
+
+
+@metrics.route('/metrics')
+def show_metrics():
+    """All counters, in the Prometheus text format."""
+
+    token = current_app.config['METRICS_TOKEN']
+    if not token or request.headers.get('Authorization') != f"Bearer {token}":
+        abort(404)
+
+    return Response(render_metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def connect_metrics(app):
+    """Serve the metrics of the provided Flask app.
+
+    /metrics needs METRICS_TOKEN set, and sent as a bearer token.
+    """
+
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault(
+        'METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+
+    _shared['directory'] = app.config['METRICS_DIR']
+    app.register_blueprint(metrics)
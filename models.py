@@ -1,19 +1,48 @@
 """SQLAlchemy models for Warbler."""
 
+import os
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, bindparam, event, exc
+from sqlalchemy.ext import baked
+from sqlalchemy.pool import Pool
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Queries made on almost every request are baked: built and compiled to SQL
+# once per worker, then only given new parameters. A baked query is cached
+# by the code of the lambdas that build it, not by what they close over, so
+# values always go in as bindparam()s.
+bakery = baked.bakery()
+
+_dummy_hashes = {}
+
+
+def _dummy_hash():
+    """A password hash at the current cost, for users that don't exist."""
+
+    rounds = bcrypt._log_rounds
+    if rounds not in _dummy_hashes:
+        _dummy_hashes[rounds] = bcrypt.generate_password_hash(
+            os.urandom(16).hex()).decode('UTF-8')
+    return _dummy_hashes[rounds]
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # The primary key covers a user's followers, in order; this covers who
+    # they follow, for keyset paging through both lists.
+    __table_args__ = (
+        db.Index('ix_follows_following', 'user_following_id',
+                 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -27,6 +56,83 @@ class Follows(db.Model):
     )
 
 
+class FollowChange(db.Model):
+    """A follow or unfollow, logged by a trigger on `follows`.
+
+    follow_graph.py replays these onto its snapshot of the graph. `txid` is
+    the writing transaction, so changes that were still uncommitted when a
+    snapshot was taken aren't missed.
+    """
+
+    __tablename__ = 'follow_changes'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # True for a follow, False for an unfollow.
+    followed = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    txid = db.Column(
+        db.BigInteger,
+        nullable=False,
+        index=True,
+        server_default=db.text('txid_current()'),
+    )
+
+    # Orders changes logged on different shards (shards.py).
+    changed_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        server_default=db.text('clock_timestamp()'),
+    )
+
+
+# Follows copied between shards as their bucket moves (shards.py) aren't
+# new follows, nor unfollows.
+LOG_FOLLOW_CHANGE = """
+CREATE OR REPLACE FUNCTION log_follow_change() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.moving_follows', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO follow_changes (follower_id, followed_id, followed)
+        VALUES (NEW.user_following_id, NEW.user_being_followed_id, true);
+    ELSE
+        INSERT INTO follow_changes (follower_id, followed_id, followed)
+        VALUES (OLD.user_following_id, OLD.user_being_followed_id, false);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+event.listen(Follows.__table__, 'after_create', DDL(LOG_FOLLOW_CHANGE + """
+CREATE TRIGGER follows_log_changes
+AFTER INSERT OR DELETE ON follows
+FOR EACH ROW EXECUTE PROCEDURE log_follow_change();
+""").execute_if(dialect='postgresql'))
+
+event.listen(Follows.__table__, 'before_drop', DDL(
+    "DROP FUNCTION IF EXISTS log_follow_change() CASCADE"
+).execute_if(dialect='postgresql'))
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -72,6 +178,19 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Notification groups with news since the user last looked at them
+    # (notifications.py): kept as a counter, not counted.
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    notifications_seen_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -105,6 +224,25 @@ class User(db.Model):
         found_user_list = [user for user in self.following if user == other_user]
         return len(found_user_list) == 1
 
+    @classmethod
+    def by_id(cls, user_id, session=None):
+        """The user with `user_id`, or None (a baked query.get()).
+
+        From `session` if given, e.g. their shard's (shards.py).
+        """
+
+        query = bakery(lambda s: s.query(User))
+        return query.for_session(session or db.session()).get(user_id)
+
+    @classmethod
+    def by_username(cls, username):
+        """The user with `username`, or None (a baked query)."""
+
+        query = bakery(lambda s: s.query(User))
+        query += lambda q: q.filter(User.username == bindparam('username'))
+        return (query.for_session(db.session())
+                .params(username=username).first())
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -135,21 +273,42 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.by_username(username)
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
+        else:
+            # Check against a throwaway hash anyway, so a wrong username
+            # takes as long as a wrong password and can't be told apart.
+            bcrypt.check_password_hash(_dummy_hash(), password)
 
         return False
 
 
+# Messages are range-partitioned by id, this many ids to a partition, so
+# old partitions can be archived whole (archive.py).
+MESSAGE_PARTITION_SIZE = 1000000
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # Message lists are paged by (timestamp, id), newest first. Indexes are
+    # per partition, so the hot ones stay small.
+    __table_args__ = (
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
+    # Messages read back from the archive aren't in the database.
+    archived = False
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -163,7 +322,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -172,17 +331,79 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept up to date in batches by like_counts.py, a second or so behind.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+# The default partition takes ids past the last range, should `flask
+# messages maintain` not have run in time.
+event.listen(Message.__table__, 'after_create', DDL(
+    f"CREATE TABLE messages_p0 PARTITION OF messages "
+    f"FOR VALUES FROM (MINVALUE) TO ({MESSAGE_PARTITION_SIZE}); "
+    f"CREATE TABLE messages_p1 PARTITION OF messages "
+    f"FOR VALUES FROM ({MESSAGE_PARTITION_SIZE}) "
+    f"TO ({2 * MESSAGE_PARTITION_SIZE}); "
+    f"CREATE TABLE messages_default PARTITION OF messages DEFAULT"
+).execute_if(dialect='postgresql'))
+
+
+class MessageTag(db.Model):
+    """A hashtag ('#flask') or mention ('@alice') in a message."""
+
+    __tablename__ = 'message_tags'
+
+    # Lowercased, with the sigil. The primary key leads with the tag, so a
+    # tag's newest messages are read from the end of one index range.
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
     """
 
-    db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+
+
+# Pooled connections must never be shared between processes (e.g. a
+# gunicorn master and the workers it forks). Record which process opened
+# each connection and refuse to hand it out in any other one; the pool then
+# opens a fresh connection instead.
+
+@event.listens_for(Pool, 'connect')
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        # Drop it without closing: closing would end the session for the
+        # process that really owns it.
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection belongs to pid {connection_record.info['pid']}, "
+            f"not {pid}")
 
 
 class Like(db.Model):
@@ -190,6 +411,13 @@ class Like(db.Model):
 
     __tablename__ = 'likes'
 
+    # A user's likes are paged by id, newest first. Likes are found by
+    # message too, when a message is deleted or archived.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -205,4 +433,224 @@ class Like(db.Model):
         db.Integer,
         db.ForeignKey('messages.id', ondelete='CASCADE'),
         nullable=False, 
-    )
\ No newline at end of file
+    )
+
+
+class Recommendation(db.Model):
+    """A user suggested to another in "Who to follow" (recommend.py).
+
+    The table is rebuilt wholesale by `flask recommendations build`, so it
+    has no foreign keys; rows naming a deleted user just join to nothing.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+# A notification group's actors are kept in bounded space however many
+# there are: their ids while there are few (NULL past
+# notifications.EXACT_ACTORS), and always a HyperLogLog sketch, an array of
+# 256 registers each holding the most leading zeros seen among the hashes
+# of the actors that fall into it. The distinct count is exact while the
+# ids are kept, and the sketch's estimate (within a few percent) after.
+NOTIFICATION_ACTORS = """
+CREATE OR REPLACE FUNCTION notification_actor_ids(
+    a integer[], b integer[], cap integer) RETURNS integer[] AS $$
+    SELECT CASE WHEN a IS NULL OR b IS NULL THEN NULL ELSE (
+        SELECT CASE WHEN count(*) <= cap THEN array_agg(id ORDER BY id) END
+        FROM (SELECT DISTINCT unnest(a || b) AS id) ids) END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION hll_union(a smallint[], b smallint[])
+RETURNS smallint[] AS $$
+    SELECT array_agg(greatest(x, y) ORDER BY i)
+    FROM unnest(a, b) WITH ORDINALITY AS r(x, y, i)
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION hll_estimate(registers smallint[])
+RETURNS integer AS $$
+    -- Linear counting while registers are still empty: it's the more
+    -- accurate of the two for small counts.
+    SELECT round(CASE WHEN raw <= 2.5 * m AND zeros > 0
+                      THEN m * ln(m / zeros) ELSE raw END)::integer
+    FROM (SELECT m, zeros,
+                 0.7213 / (1 + 1.079 / m) * m * m / total AS raw
+          FROM (SELECT count(*)::float8 AS m,
+                       count(*) FILTER (WHERE x = 0)::float8 AS zeros,
+                       sum(power(2::float8, -x)) AS total
+                FROM unnest(registers) AS x) sums) estimates
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION notification_actor_count(
+    ids integer[], sketch smallint[]) RETURNS integer AS $$
+    SELECT coalesce(cardinality(ids), hll_estimate(sketch))
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+
+class Notification(db.Model):
+    """Likes of a user's message, or new followers, in one time bucket.
+
+    Events are grouped (notifications.py): the row for a group counts its
+    distinct actors, in bounded space, and names the latest. `subject_id`
+    is the liked message, or the followed user. It has no foreign key, as
+    messages are archived and deleted under their notifications; a row
+    whose message is gone just joins to nothing. So does `last_actor_id`,
+    once that user is deleted.
+    """
+
+    __tablename__ = 'notifications'
+
+    # A user's notifications are paged newest first.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'subject_id', 'bucket',
+                            name='uq_notifications_group'),
+        db.Index('ix_notifications_user_id_updated_at', 'user_id',
+                 'updated_at', 'id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    bucket = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Every actor's id, while there are few enough; else NULL.
+    actor_ids = db.Column(
+        db.ARRAY(db.Integer),
+    )
+
+    actor_sketch = db.Column(
+        db.ARRAY(db.SmallInteger),
+        nullable=False,
+    )
+
+    # notification_actor_count() of the two above, but never less than it
+    # was: the sketch's estimate can start out below the exact count.
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    last_actor_id = db.Column(
+        db.Integer,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+event.listen(Notification.__table__, 'before_create', DDL(
+    NOTIFICATION_ACTORS
+).execute_if(dialect='postgresql'))
+
+
+class ShardBucket(db.Model):
+    """Which shard holds a bucket of users' own data (shards.py).
+
+    A user's bucket is their id modulo SHARD_BUCKETS. Buckets without a row
+    are on shard 0, the main database.
+    """
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Set while the bucket is copied to another shard; its users' writes
+    # are refused until it's done.
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+
+class ThrottleBucket(db.Model):
+    """Token bucket limiting attempts on a password endpoint (throttle.py)."""
+
+    __tablename__ = 'throttle_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+    )
+
+
+# Counts for the profile stats. Deferred, so they are only queried when a
+# template shows them, and without loading the underlying collections.
+
+def _count_of(model, owner_column):
+    return db.column_property(
+        db.select([db.func.count()])
+        .where(owner_column == User.id)
+        .correlate_except(model)
+        .as_scalar(),
+        deferred=True,
+    )
+
+
+User.message_count = _count_of(Message, Message.user_id)
+User.following_count = _count_of(Follows, Follows.user_following_id)
+User.followers_count = _count_of(Follows, Follows.user_being_followed_id)
+User.likes_count = _count_of(Like, Like.user_id)
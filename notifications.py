@@ -0,0 +1,301 @@
+"""Notifications for Warbler: likes of your messages, and new followers.
+
+Events aren't stored one by one. They're grouped by who they're for, what
+they're about (a message, or the user followed) and a time bucket of
+NOTIFICATION_BUCKET_SECONDS, and each group is one row in `notifications`:
+how many people, and who was last ("alice and 40 others liked your
+message"). People are counted once per group however often they like,
+unlike and like again. The row holds its actors in bounded space: their
+ids while there are at most EXACT_ACTORS, and a HyperLogLog sketch of
+SKETCH_REGISTERS registers, which counts them from then on to within a few
+percent (models.NOTIFICATION_ACTORS). A message liked by a million people
+is still one row a bucket, rewritten once per flush.
+
+Like counts (like_counts.py) are kept the same way. Each worker adds its
+events up in memory, and at most every NOTIFICATION_FLUSH_SECONDS writes
+them out in one statement per NOTIFICATION_BATCH groups, from the request
+or from a daemon thread (NOTIFICATION_FLUSH_THREAD). The statement
+upserts the groups and bumps their owners' `unread_notifications`. So
+however viral a message gets, it costs one row per bucket, and one upsert
+per flush per worker.
+
+`users.unread_notifications` counts the groups with news since the user
+last opened /notifications (`users.notifications_seen_at`). A group counts
+when it's created, or when it gets news after the user last looked; news
+for a group already unread doesn't count twice. Opening the page zeroes
+the counter. It's a counter, not a COUNT, so the navbar badge costs
+nothing; flushes racing each other can overcount a little until then.
+
+Only new likes and follows notify. Undoing one doesn't take its
+notification back. Events a worker never flushed (it was killed) are
+lost.
+"""
+
+import atexit
+import datetime
+import hashlib
+import threading
+import time
+
+from flask import current_app
+
+from like_counts import FlushTimer
+from metrics import counter
+from models import db, User
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Groups with more actors than this are only counted by their sketch.
+EXACT_ACTORS = 32
+SKETCH_REGISTERS = 256
+
+NOTIFICATION_GROUPS_WRITTEN = counter(
+    'warbler_notification_groups_written_total',
+    "Notification groups upserted by a flush.")
+
+
+class NotificationBuffer:
+    """Events not yet written, by (user_id, kind, subject_id, bucket).
+
+    Each group holds (actor ids, last actor id, time of the last event).
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def add(self, key, actor_id, when, actors=None):
+        with self._lock:
+            seen, last_actor_id, last = self._groups.get(
+                key, (frozenset(), None, None))
+            seen = seen | (actors or {actor_id})
+            if last is not None and last > when:
+                actor_id, when = last_actor_id, last
+            self._groups[key] = (seen, actor_id, when)
+
+    def due(self, seconds):
+        return bool(self._groups) and (
+            time.monotonic() - self._flushed_at >= seconds)
+
+    def take(self):
+        """Remove and return the pending groups."""
+
+        with self._lock:
+            groups, self._groups = self._groups, {}
+            self._flushed_at = time.monotonic()
+        return groups
+
+    def restore(self, groups):
+        """Put back groups taken by a flush that failed."""
+
+        for key, (actors, actor_id, when) in groups.items():
+            self.add(key, actor_id, when, actors)
+
+    def clear(self):
+        with self._lock:
+            self._groups = {}
+
+
+def actor_sketch(actor_ids):
+    """The HyperLogLog registers of `actor_ids`, as hll_union() merges them.
+
+    Each id's 64-bit hash picks a register with its top 8 bits, and the
+    register keeps the highest rank (leading zeros + 1) of the other 56.
+    """
+
+    registers = [0] * SKETCH_REGISTERS
+    for actor_id in actor_ids:
+        digest = hashlib.blake2b(str(actor_id).encode(), digest_size=8)
+        h = int.from_bytes(digest.digest(), 'big')
+        rest = h & ((1 << 56) - 1)
+        register = h >> 56
+        registers[register] = max(registers[register],
+                                  56 - rest.bit_length() + 1)
+    return registers
+
+
+def write_groups(conn, groups, batch_size):
+    """Upsert `groups` (as NotificationBuffer.take() returns them)."""
+
+    # Rows are locked in key order, so concurrent flushes can't deadlock.
+    items = sorted(groups.items())
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        values = ", ".join(
+            f"(:user_id{i}, :kind{i}, :subject_id{i}, :bucket{i}, "
+            f"CAST(:actor_ids{i} AS integer[]), "
+            f"CAST(:sketch{i} AS smallint[]), :actor_id{i}, "
+            f"CAST(:at{i} AS timestamp))"
+            for i in range(len(batch)))
+        params = {'cap': EXACT_ACTORS}
+        for i, ((user_id, kind, subject_id, bucket),
+                (actors, actor_id, when)) in enumerate(batch):
+            params.update({
+                f'user_id{i}': user_id, f'kind{i}': kind,
+                f'subject_id{i}': subject_id, f'bucket{i}': bucket,
+                f'actor_ids{i}': (sorted(actors)
+                                  if len(actors) <= EXACT_ACTORS else None),
+                f'sketch{i}': actor_sketch(actors), f'actor_id{i}': actor_id,
+                f'at{i}': when,
+            })
+
+        # `news` holds the groups that are new, or have actors the row
+        # doesn't; the others have nothing to tell. `fresh` counts the news
+        # the user hasn't seen since they looked. Both read the table as it
+        # was before the upsert; the upsert itself merges into the row as
+        # it is, so racing flushes lose no actors.
+        conn.execute(db.text(f"""
+            WITH incoming (user_id, kind, subject_id, bucket, actor_ids,
+                           actor_sketch, last_actor_id, updated_at)
+                AS (VALUES {values}),
+            recipients AS (
+                SELECT i.*, u.notifications_seen_at AS seen_at,
+                       n.id AS existing_id, n.updated_at AS existing_at,
+                       n.actor_ids AS existing_ids,
+                       n.actor_sketch AS existing_sketch
+                FROM incoming i
+                JOIN users u ON u.id = i.user_id
+                LEFT JOIN notifications n
+                    ON n.user_id = i.user_id AND n.kind = i.kind
+                    AND n.subject_id = i.subject_id AND n.bucket = i.bucket
+            ),
+            news AS (
+                SELECT * FROM recipients
+                WHERE existing_id IS NULL
+                   OR notification_actor_ids(existing_ids, actor_ids, :cap)
+                      IS DISTINCT FROM existing_ids
+                   OR hll_union(existing_sketch, actor_sketch)
+                      <> existing_sketch
+            ),
+            fresh AS (
+                SELECT user_id, count(*) AS groups
+                FROM news
+                WHERE existing_id IS NULL OR existing_at <= seen_at
+                GROUP BY user_id
+            ),
+            upserted AS (
+                INSERT INTO notifications (user_id, kind, subject_id, bucket,
+                                           actor_ids, actor_sketch,
+                                           actor_count, last_actor_id,
+                                           updated_at)
+                SELECT user_id, kind, subject_id, bucket, actor_ids,
+                       actor_sketch,
+                       notification_actor_count(actor_ids, actor_sketch),
+                       last_actor_id, updated_at
+                FROM news
+                ON CONFLICT (user_id, kind, subject_id, bucket) DO UPDATE
+                SET actor_ids = notification_actor_ids(
+                        notifications.actor_ids, excluded.actor_ids, :cap),
+                    actor_sketch = hll_union(notifications.actor_sketch,
+                                             excluded.actor_sketch),
+                    actor_count = greatest(
+                        notifications.actor_count,
+                        notification_actor_count(
+                            notification_actor_ids(notifications.actor_ids,
+                                                   excluded.actor_ids, :cap),
+                            hll_union(notifications.actor_sketch,
+                                      excluded.actor_sketch))),
+                    last_actor_id = CASE
+                        WHEN excluded.updated_at >= notifications.updated_at
+                        THEN excluded.last_actor_id
+                        ELSE notifications.last_actor_id END,
+                    updated_at = greatest(notifications.updated_at,
+                                          excluded.updated_at)
+            )
+            UPDATE users
+            SET unread_notifications = unread_notifications + fresh.groups
+            FROM fresh
+            WHERE users.id = fresh.user_id
+        """), params)
+    NOTIFICATION_GROUPS_WRITTEN.inc(len(items))
+
+
+def get_notification_buffer():
+    """The pending notifications of the current app."""
+
+    app = current_app._get_current_object()
+    return app.extensions['notification_buffer']
+
+
+def notify(user_id, kind, subject_id, actor_id, when=None):
+    """Tell `user_id` that `actor_id` did `kind` (LIKE or FOLLOW) to
+    `subject_id` (the message liked, or the user followed)."""
+
+    when = when or datetime.datetime.utcnow()
+    bucket = int((when - EPOCH).total_seconds()) // (
+        current_app.config['NOTIFICATION_BUCKET_SECONDS'])
+    get_notification_buffer().add((user_id, kind, subject_id, bucket),
+                                  actor_id, when)
+    timer = current_app.extensions.get('notification_timer')
+    if timer is not None:
+        timer.start()
+
+
+def flush_notifications(conn):
+    """Write out the current app's pending notifications on `conn`."""
+
+    buffer = get_notification_buffer()
+    groups = buffer.take()
+    if not groups:
+        return 0
+    try:
+        write_groups(conn, groups, current_app.config['NOTIFICATION_BATCH'])
+    except Exception:
+        buffer.restore(groups)
+        raise
+    return len(groups)
+
+
+def flush_notifications_if_due():
+    """Write out and commit the pending notifications, if it's time to.
+
+    Call it after the request's own commit, as like_counts.flush_if_due().
+    """
+
+    buffer = get_notification_buffer()
+    if not buffer.due(current_app.config['NOTIFICATION_FLUSH_SECONDS']):
+        return
+    groups = buffer.take()
+    try:
+        write_groups(db.session.connection(), groups,
+                     current_app.config['NOTIFICATION_BATCH'])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        buffer.restore(groups)
+        raise
+
+
+def mark_seen(user):
+    """Note that `user` has looked at their notifications; commits."""
+
+    db.session.query(User).filter(User.id == user.id).update(
+        {User.notifications_seen_at: datetime.datetime.utcnow(),
+         User.unread_notifications: 0})
+    db.session.commit()
+
+
+def connect_notifications(app):
+    """Add grouped like and follow notifications to the provided Flask app."""
+
+    app.config.setdefault('NOTIFICATION_BUCKET_SECONDS', 24 * 60 * 60)
+    app.config.setdefault('NOTIFICATION_FLUSH_SECONDS', 1.0)
+    app.config.setdefault('NOTIFICATION_BATCH', 1000)
+    app.config.setdefault('NOTIFICATION_FLUSH_THREAD', True)
+
+    app.extensions['notification_buffer'] = NotificationBuffer()
+    if app.config['NOTIFICATION_FLUSH_THREAD']:
+        app.extensions['notification_timer'] = FlushTimer(
+            app, flush_notifications_if_due, 'NOTIFICATION_FLUSH_SECONDS',
+            'warbler-notifications')
+
+    def flush_at_exit():
+        if app.extensions['notification_buffer'].due(0):
+            with app.app_context(), db.engine.begin() as conn:
+                flush_notifications(conn)
+
+    atexit.register(flush_at_exit)
@@ -0,0 +1,246 @@
+"""Keyset pagination for Warbler's list pages.
+
+Each list is ordered by a unique key, e.g. (timestamp, id) for messages, and
+a page is "the next N rows after this key": a range scan on an index that
+starts where the last page ended. Page 1000 costs what page 1 does, where
+OFFSET would read and throw away every row before it.
+
+The key of a page's last (or first) row travels in the URL as an opaque,
+signed cursor: `?after=...` for the next page, `?before=...` for the
+previous one. List templates put their rows and pager in an `items` block;
+with `?fragment=1` only that block is sent back, and
+static/js/infinite-scroll.js appends it to the page as the reader scrolls.
+"""
+
+import datetime
+from itertools import chain
+
+from flask import abort, current_app, request, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import DateTime, bindparam, tuple_
+from sqlalchemy.ext.baked import BakedQuery
+
+from models import db
+from shards import scatter
+from templating import stream_template
+
+CURSOR_ARGS = ('after', 'before', 'fragment')
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='warbler-cursor')
+
+
+def encode_cursor(values):
+    """An opaque cursor for a row's key `values`."""
+
+    return _serializer().dumps([
+        value.isoformat() if isinstance(value, datetime.datetime) else value
+        for value in values])
+
+
+def decode_cursor(cursor, columns):
+    """The key values in `cursor`, for the key `columns`; 400 if invalid."""
+
+    try:
+        values = _serializer().loads(cursor)
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [datetime.datetime.fromisoformat(value)
+                if isinstance(column.type, DateTime) else value
+                for column, value in zip(columns, values)]
+    except (BadSignature, TypeError, ValueError):
+        abort(400)
+
+
+class Page:
+    """One page of a query, ordered by the unique key `columns`.
+
+    The rows are fetched when the page is first iterated, so a streamed
+    template sends its head before the query runs. `next_url` and
+    `prev_url` link to the neighbouring pages, or are None at either end.
+
+    `archive`, if given, is called as archive(cursor, ascending, limit) for
+    up to `limit` more rows past `cursor`, (item, *key) like the query's,
+    from somewhere other than the database (see archive.py). They're merged
+    in by key when the query can't fill the page going forwards, and
+    always going back.
+
+    `query` may be a BakedQuery (see models.bakery), run with `params`;
+    the cursor is then bound as parameters too, so each list compiles to
+    one statement for its first page and one for each direction after.
+
+    `scatter`, if given, runs the query on several shards at once (see
+    shards.scatter()): {shard: params}, each shard's added to `params`, or
+    None. Their pages are merged by key. `load`, if given, is called with
+    the page's items and returns what to show for them, in order.
+    """
+
+    def __init__(self, query, columns, per_page, after=None, before=None,
+                 descending=True, archive=None, params=None, scatter=None,
+                 load=None):
+        self.query = query
+        self.params = params or {}
+        self.scatter = scatter
+        self.load = load
+        self.columns = columns
+        self.archive = archive
+        self.per_page = per_page
+        self.descending = descending
+        self.forwards = before is None
+
+        cursor = after if self.forwards else before
+        self.cursor = decode_cursor(cursor, columns) if cursor else None
+
+        self.fragment = bool(request.args.get('fragment'))
+        self._endpoint = request.endpoint
+        self._args = dict(request.view_args)
+        self._args.update((key, value) for key, value in request.args.items()
+                          if key not in CURSOR_ARGS)
+
+        self._rows = None
+        self._next = self._prev = None
+
+    def _page_query(self, query, bounds, ascending):
+        query = query.add_columns(*self.columns)
+        if bounds is not None:
+            # A row value comparison: (timestamp, id) < (:timestamp, :id).
+            key, bound = tuple_(*self.columns), tuple_(*bounds)
+            if len(self.columns) == 1:
+                key, bound = self.columns[0], bounds[0]
+            query = query.filter(key > bound if ascending else key < bound)
+
+        return (query
+                .order_by(*[column.asc() if ascending else column.desc()
+                            for column in self.columns])
+                .limit(self.per_page + 1))
+
+    def _query_rows(self, ascending, session=None, shard_params=None):
+        if not isinstance(self.query, BakedQuery):
+            query = self.query
+            if session is not None:
+                query = query.with_session(session).params(
+                    **(shard_params or {}))
+            return self._page_query(query, self.cursor, ascending).all()
+
+        params = dict(self.params, **(shard_params or {}))
+        bounds = None
+        if self.cursor is not None:
+            bounds = [bindparam(f"cursor_{i}", type_=column.type)
+                      for i, column in enumerate(self.columns)]
+            params.update((f"cursor_{i}", value)
+                          for i, value in enumerate(self.cursor))
+
+        # What changes the SQL goes in the cache key; the values don't.
+        query = self.query.with_criteria(
+            lambda q: self._page_query(q, bounds, ascending),
+            bounds is not None, ascending, self.per_page)
+        return query.for_session(session or db.session()).params(
+            **params).all()
+
+    def _scatter_rows(self, ascending):
+        pages = scatter(
+            lambda session, params: self._query_rows(ascending, session,
+                                                     params),
+            self.scatter)
+
+        # A bucket being moved is on two shards for a while.
+        rows = {}
+        for row in chain.from_iterable(pages):
+            rows.setdefault(tuple(row[1:]), row)
+        return sorted(rows.values(), key=lambda row: tuple(row[1:]),
+                      reverse=not ascending)
+
+    def _fetch(self):
+        # Going back, walk the index the other way from the cursor.
+        ascending = self.forwards != self.descending
+        if self.scatter is None:
+            rows = self._query_rows(ascending)
+        else:
+            rows = self._scatter_rows(ascending)
+
+        if self.archive is not None and (
+                len(rows) <= self.per_page or not self.forwards):
+            rows = sorted(
+                rows + self.archive(self.cursor, ascending, self.per_page + 1),
+                key=lambda row: tuple(row[1:]), reverse=not ascending)
+
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not self.forwards:
+            rows.reverse()
+
+        self._rows = [row[0] for row in rows]
+        if self.load is not None:
+            self._rows = self.load(self._rows)
+        if rows:
+            first, last = rows[0][1:], rows[-1][1:]
+            if more or not self.forwards:
+                self._next = encode_cursor(last)
+            if (more and not self.forwards) or (
+                    self.forwards and self.cursor is not None):
+                self._prev = encode_cursor(first)
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._fetch()
+        return self._rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _url(self, cursor, **args):
+        if self.rows and cursor:
+            return url_for(self._endpoint, **self._args, **args)
+        return None
+
+    @property
+    def next_url(self):
+        return self._url(self._next, after=self._next)
+
+    @property
+    def prev_url(self):
+        return self._url(self._prev, before=self._prev)
+
+    @property
+    def next_fragment_url(self):
+        return self._url(self._next, after=self._next, fragment=1)
+
+
+def paginate(query, *columns, descending=True, archive=None, params=None,
+             scatter=None, load=None):
+    """The page of `query` the request's cursor asks for.
+
+    `columns` must be a unique key, in the order the list is shown;
+    newest (highest) first unless `descending` is false. Don't order
+    `query` itself. See Page for `archive`, for baked queries and their
+    `params`, and for `scatter` and `load`.
+    """
+
+    return Page(query, columns, current_app.config['PAGE_SIZE'],
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+                descending=descending, archive=archive, params=params,
+                scatter=scatter, load=load)
+
+
+def render_list(template_name, **context):
+    """Stream a list page, or only its `items` block for ?fragment=1."""
+
+    if not request.args.get('fragment'):
+        return stream_template(template_name, **context)
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return ''.join(template.blocks['items'](template.new_context(context)))
+
+
+def connect_pagination(app):
+    """Set the page size of the provided Flask app's lists."""
+
+    app.config.setdefault('PAGE_SIZE', 50)
@@ -0,0 +1,287 @@
+"""On-demand and sampled request profiling for Warbler.
+
+A request is profiled when:
+
+- it carries an `X-Warbler-Profile` header with a token from
+  `flask profile token` (signed with the app's secret key, good for
+  PROFILE_TOKEN_MAX_AGE seconds);
+- it has `?profile=1` and the logged-in user is in PROFILE_ADMINS; or
+- it's picked at random, at PROFILE_SAMPLE_RATE (0 to 1; 0 by default).
+
+A profiled request gets a sampling thread that records the request
+thread's Python stack every PROFILE_INTERVAL seconds, until the response
+has been sent (streamed pages included). SQL statements are timed as they
+run. Each profile is saved to PROFILE_DIR as two files:
+
+- `<name>.collapsed`: one line per distinct stack, outermost frame first,
+  frames joined by ';', then the number of samples. Feed it to
+  flamegraph.pl or speedscope as is.
+- `<name>.json`: the route, status, wall time, SQL time and statement
+  count, and how many samples fell in templates and in SQL.
+
+Only the newest PROFILE_KEEP profiles are kept. A request that isn't
+profiled pays for the trigger checks and one thread-local lookup per SQL
+statement.
+"""
+
+import datetime
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import counter
+
+profile_cli = AppGroup('profile', help="Profile requests.")
+
+HEADER = 'X-Warbler-Profile'
+
+PROFILED_REQUESTS = counter(
+    'warbler_profiled_requests_total',
+    "Requests profiled, by what asked for it.",
+    labels=('trigger',))
+
+# The profile of the request being handled by the current thread, if any.
+_current = threading.local()
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key,
+                                  salt='warbler-profile')
+
+
+def make_token():
+    """A token for the profile header."""
+
+    return _serializer().dumps('profile')
+
+
+def _valid_token(token):
+    try:
+        _serializer().loads(
+            token, max_age=current_app.config['PROFILE_TOKEN_MAX_AGE'])
+        return True
+    except BadSignature:
+        return False
+
+
+@functools.lru_cache(maxsize=4096)
+def _frame_name(code):
+    filename = code.co_filename
+    # Paths relative to the project (or to site-packages) read better.
+    for prefix in sys.path:
+        if prefix and filename.startswith(prefix + os.sep):
+            filename = filename[len(prefix) + 1:]
+            break
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _in_template(code):
+    return code.co_filename.endswith('.html')
+
+
+def _in_sql(code):
+    return code.co_name in ('do_execute', 'do_executemany') or (
+        code.co_name == 'execute' and 'psycopg2' in code.co_filename)
+
+
+class Profile:
+    """A sampling profile of one thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = self.template_samples = self.sql_samples = 0
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.started = time.perf_counter()
+        self.duration = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='warbler-profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._sample(frame)
+
+    def _sample(self, frame):
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        codes.reverse()
+
+        stack = ';'.join(_frame_name(code) for code in codes)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+        if any(_in_template(code) for code in codes):
+            self.template_samples += 1
+        if any(_in_sql(code) for code in codes):
+            self.sql_samples += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n"
+                       for stack, count in sorted(self.stacks.items()))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if getattr(_current, 'profile', None) is not None:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    profile = getattr(_current, 'profile', None)
+    started = conn.info.get('profile_started')
+    if profile is not None and started:
+        profile.sql_time += time.perf_counter() - started.pop()
+        profile.sql_count += 1
+
+
+def _trigger():
+    """What asks for this request to be profiled, or None."""
+
+    config = current_app.config
+    token = request.headers.get(HEADER)
+    if token and _valid_token(token):
+        return 'header'
+    if (request.args.get('profile') and getattr(g, 'user', None)
+            and g.user.username in config['PROFILE_ADMINS']):
+        return 'admin'
+    rate = config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        return 'sample'
+    return None
+
+
+def _start_profile():
+    trigger = _trigger()
+    if trigger is None:
+        return
+
+    profile = Profile(threading.get_ident(),
+                      current_app.config['PROFILE_INTERVAL'])
+    profile.trigger = trigger
+    _current.profile = profile
+    g.profile = profile
+    profile.start()
+    PROFILED_REQUESTS.inc(trigger=trigger)
+
+
+def _finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    app = current_app._get_current_object()
+    info = {'method': request.method, 'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint, 'status': response.status_code,
+            'trigger': profile.trigger}
+
+    def save():
+        _current.profile = None
+        profile.stop()
+        save_profile(app.config['PROFILE_DIR'], profile, info,
+                     app.config['PROFILE_KEEP'])
+
+    # After the body has been sent, so streamed pages are profiled whole.
+    response.call_on_close(save)
+    return response
+
+
+def _abandon_profile(exc):
+    # The request failed before there was a response to profile.
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _current.profile = None
+        profile.stop()
+
+
+def save_profile(directory, profile, info, keep):
+    """Write `profile` to `directory`, keeping only the `keep` newest."""
+
+    os.makedirs(directory, exist_ok=True)
+    endpoint = (info.get('endpoint') or 'unknown').replace('.', '-')
+    # Names sort oldest first.
+    name = (f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+            f"-{endpoint}-{uuid.uuid4().hex[:6]}")
+
+    summary = dict(info, duration=profile.duration,
+                   interval=profile.interval, samples=profile.samples,
+                   template_samples=profile.template_samples,
+                   sql_samples=profile.sql_samples,
+                   sql_time=profile.sql_time, sql_count=profile.sql_count)
+    for suffix, data in (('.collapsed', profile.collapsed()),
+                         ('.json', json.dumps(summary, indent=2) + '\n')):
+        path = os.path.join(directory, name + suffix)
+        with open(path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    names = sorted(entry[:-len('.json')] for entry in os.listdir(directory)
+                   if entry.endswith('.json'))
+    for old in names[:-keep] if keep else names:
+        for suffix in ('.collapsed', '.json'):
+            try:
+                os.remove(os.path.join(directory, old + suffix))
+            except FileNotFoundError:
+                pass
+
+    return name
+
+
+@profile_cli.command('token')
+def token_command():
+    """Print a token for the X-Warbler-Profile header."""
+
+    max_age = current_app.config['PROFILE_TOKEN_MAX_AGE']
+    click.echo(make_token())
+    click.echo(f"Good for {max_age} seconds, e.g.:\n"
+               f"  curl -H '{HEADER}: <token>' ...", err=True)
+
+
+def connect_profiler(app):
+    """Add request profiling to the provided Flask app.
+
+    Call this after the blueprints are registered, so g.user is loaded
+    when it's checked for PROFILE_ADMINS.
+    """
+
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path,
+                                                      'profiles'))
+    app.config.setdefault('PROFILE_ADMINS', ())
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_INTERVAL', 0.005)
+    app.config.setdefault('PROFILE_KEEP', 200)
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abandon_profile)
+    app.cli.add_command(profile_cli)
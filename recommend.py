@@ -0,0 +1,248 @@
+"""Recommendations for the "Who to follow" box on the Warbler home page.
+
+Friends of friends: the people followed by the people you follow, scored by
+how many of those you follow them through. With A the adjacency matrix of
+the follows table (A[i, j] = 1 when i follows j), (A @ A)[i, j] counts the
+paths i -> k -> j, which is exactly that score.
+
+`flask recommendations build` computes it for every user at once:
+
+- the follows table is read with a binary COPY straight into NumPy arrays,
+  and the user ids compacted into a SciPy CSR matrix;
+- A @ A is multiplied a block of rows at a time, so memory stays bounded by
+  the block rather than the whole graph;
+- existing follows and the users themselves are masked out, and the top
+  RECOMMENDATIONS_PER_USER candidates of every row picked with one sort;
+- the results are COPYed into a fresh table which then replaces
+  `recommendations` in one transaction, so readers never see a half-built
+  table.
+
+The home page then reads a user's suggestions with one primary key lookup.
+NumPy and SciPy are only imported by the batch job, not by web workers.
+"""
+
+import io
+import struct
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import Recommendation, User
+from shards import shard_connections
+
+recommendations_cli = AppGroup(
+    'recommendations', help="Build 'Who to follow' recommendations.")
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+
+def _copy_dtype(np, *columns):
+    """dtype of a binary COPY row of non-null int4 `columns`."""
+
+    fields = [('count', '>i2')]
+    for column in columns:
+        fields += [(f'{column}_length', '>i4'), (column, '>i4')]
+    return np.dtype(fields)
+
+
+class _EdgeSink:
+    """File-like target for a binary COPY of the follows table."""
+
+    def __init__(self, np):
+        self.np = np
+        self.dtype = _copy_dtype(np, 'follower', 'followed')
+        self.buffer = bytearray()
+        self.header = True
+        self.chunks = []
+
+    def write(self, data):
+        # libpq hands over one row at a time; parse them a megabyte at once.
+        self.buffer += data
+        if len(self.buffer) >= 1 << 20:
+            self.parse()
+
+    def parse(self):
+        if self.header:
+            if len(self.buffer) < len(PGCOPY_HEADER):
+                return
+            del self.buffer[:len(PGCOPY_HEADER)]
+            self.header = False
+
+        rows = len(self.buffer) // self.dtype.itemsize
+        size = rows * self.dtype.itemsize
+        chunk = self.np.frombuffer(bytes(self.buffer[:size]), dtype=self.dtype)
+        self.chunks.append((chunk['follower'].astype(self.np.int32),
+                            chunk['followed'].astype(self.np.int32)))
+        del self.buffer[:size]
+
+    def arrays(self):
+        """(follower ids, followed ids), once the COPY has finished."""
+
+        self.parse()
+        if bytes(self.buffer) != PGCOPY_TRAILER:
+            raise ValueError("Unexpected end of COPY data")
+
+        np = self.np
+        empty = [np.empty(0, np.int32)]
+        return (np.concatenate([c[0] for c in self.chunks] or empty),
+                np.concatenate([c[1] for c in self.chunks] or empty))
+
+
+def load_follows(conn):
+    """Read the follows table into (follower ids, followed ids) arrays."""
+
+    import numpy as np
+
+    sink = _EdgeSink(np)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        "COPY follows (user_following_id, user_being_followed_id) "
+        "TO STDOUT (FORMAT binary)", sink)
+    return sink.arrays()
+
+
+def load_all_follows(conns):
+    """load_follows() from each of `conns`, one per shard, concatenated."""
+
+    import numpy as np
+
+    if len(conns) == 1:
+        return load_follows(conns[0])
+
+    edges = [load_follows(conn) for conn in conns]
+    # A follow being moved between shards is briefly on both.
+    pairs = np.unique(np.stack([
+        np.concatenate([follower for follower, _ in edges]),
+        np.concatenate([followed for _, followed in edges])], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def friends_of_friends(follower, followed, k=10, block_size=10000):
+    """Top `k` friends-of-friends of every user in the graph.
+
+    Yields (user ids, ranks, recommended ids, scores) arrays for a block of
+    users at a time. Ranks start at 1; ties go to the lower user id.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    # Compact ids to 0..n-1, so gaps in the id sequence cost nothing.
+    ids, index = np.unique(np.concatenate([follower, followed]),
+                           return_inverse=True)
+    n = len(ids)
+    src, dst = index[:len(follower)], index[len(follower):]
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(src), dtype=np.int32), (src, dst)), shape=(n, n))
+
+    for start in range(0, n, block_size):
+        block = adjacency[start:start + block_size]
+        paths = block @ adjacency
+
+        # Zero out people already followed, then the users themselves.
+        paths = (paths - paths.multiply(block)).tocoo()
+        rows, cols, scores = paths.row, paths.col, paths.data
+        keep = (scores > 0) & (cols != rows + start)
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+        # Best first within each row; the rank is the offset from the start
+        # of the row's run.
+        order = np.lexsort((cols, -scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        top = rank < k
+
+        yield (ids[rows[top] + start], rank[top] + 1,
+               ids[cols[top]], scores[top])
+
+
+def _copy_recommendations(cursor, user_ids, ranks, recommended_ids, scores):
+    import numpy as np
+
+    columns = ('user_id', 'rank', 'recommended_id', 'score')
+    rows = np.empty(len(user_ids), dtype=_copy_dtype(np, *columns))
+    rows['count'] = len(columns)
+    for column, values in zip(columns,
+                              (user_ids, ranks, recommended_ids, scores)):
+        rows[f'{column}_length'] = 4
+        rows[column] = values
+
+    cursor.copy_expert(
+        "COPY recommendations_next (user_id, rank, recommended_id, score) "
+        "FROM STDIN (FORMAT binary)",
+        io.BytesIO(PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER))
+
+
+def build_recommendations(conn, k=10, block_size=10000, shard_conns=None):
+    """Rebuild the recommendations table; return the number of rows.
+
+    The follows are read from `shard_conns` (one per shard) if given.
+    """
+
+    total = 0
+    with conn.begin():
+        follower, followed = load_all_follows(shard_conns or [conn])
+
+        conn.execute("DROP TABLE IF EXISTS recommendations_next")
+        conn.execute("CREATE TABLE recommendations_next "
+                     "(LIKE recommendations INCLUDING ALL)")
+
+        cursor = conn.connection.cursor()
+        for block in friends_of_friends(follower, followed, k, block_size):
+            _copy_recommendations(cursor, *block)
+            total += len(block[0])
+
+        # Readers wait only for the swap, not for the build.
+        conn.execute("DROP TABLE recommendations")
+        conn.execute("ALTER TABLE recommendations_next "
+                     "RENAME TO recommendations")
+        conn.execute("ALTER INDEX recommendations_next_pkey "
+                     "RENAME TO recommendations_pkey")
+        conn.execute("ANALYZE recommendations")
+
+    return total
+
+
+def recommended_users(user_id, exclude=(), limit=3):
+    """The users suggested to `user_id`, best first, skipping `exclude`."""
+
+    # At most RECOMMENDATIONS_PER_USER rows, from the primary key index.
+    exclude = set(exclude)
+    users = (User
+             .query
+             .join(Recommendation, Recommendation.recommended_id == User.id)
+             .filter(Recommendation.user_id == user_id)
+             .order_by(Recommendation.rank)
+             .all())
+    return [user for user in users if user.id not in exclude][:limit]
+
+
+@recommendations_cli.command('build')
+def build_command():
+    """Rebuild every user's recommendations from the follows table."""
+
+    config = current_app.config
+    start = time.perf_counter()
+
+    with shard_connections() as conns:
+        total = build_recommendations(
+            conns[0],
+            k=config['RECOMMENDATIONS_PER_USER'],
+            block_size=config['RECOMMENDATIONS_BLOCK_SIZE'],
+            shard_conns=conns)
+
+    click.echo(f"Wrote {total} recommendations "
+               f"in {time.perf_counter() - start:.1f}s.")
+
+
+def connect_recommendations(app):
+    """Add the recommendations job to the provided Flask app."""
+
+    app.config.setdefault('RECOMMENDATIONS_PER_USER', 10)
+    app.config.setdefault('RECOMMENDATIONS_SHOWN', 3)
+    app.config.setdefault('RECOMMENDATIONS_BLOCK_SIZE', 10000)
+
+    app.cli.add_command(recommendations_cli)
@@ -0,0 +1,573 @@
+"""Sharding Warbler's per-user data across Postgres databases, by user id.
+
+The main database (SQLALCHEMY_DATABASE_URI) is shard 0. It holds what's
+shared: `users`, notifications, recommendations, and the map of where
+everyone's data lives. Each user's own data -- their messages and their
+tags, the users they follow and the messages they like -- lives on one
+shard: shard 0, or one of SHARD_URIS. So writes are spread over as many
+primaries as there are shards.
+
+A user's bucket is their id modulo SHARD_BUCKETS, and `shard_buckets`
+says which shard each bucket is on (without a row, shard 0). Moving a
+bucket moves a small slice of the users, so a shard can be added without
+moving everyone. Workers cache the map for SHARD_MAP_REFRESH_SECONDS.
+
+Every shard has a copy of `users`, written on signup, profile edits and
+deletes, so lists join their authors where they are and foreign keys to
+users hold. Likes refer to messages on other shards, so `likes` has no
+foreign key to `messages`, and deleting a message deletes its likes
+everywhere. Message and like ids are drawn from sequences that step by
+SHARD_ID_STRIDE, each shard from its own offset, so ids are unique across
+shards and stay so when rows move.
+
+home_session(user_id) is the session on a user's shard. Reads across
+users -- the home timeline, followers, a tag's messages -- scatter(): the
+query runs on each shard it needs at once, in threads, and
+pagination.Page merges the pages by key.
+
+`flask shards init` readies every shard's schema and copies `users` to
+them; it's safe to rerun, e.g. after adding a shard to SHARD_URIS.
+`flask shards rebalance` then spreads the buckets evenly, moving as few as
+it can, one at a time (`flask shards move BUCKET SHARD`): writes by its
+users get a 503 while its rows are copied, then the map flips and the old
+rows are deleted.
+
+Batch jobs read every shard through shard_connections(). With no
+SHARD_URIS there is one shard, and routing costs nothing.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+from archive import ensure_partitions
+from models import (db, User, Message, MessageTag, Follows, Like,
+                    ShardBucket, LOG_FOLLOW_CHANGE)
+
+shards_cli = AppGroup('shards', help="Spread users' data over databases.")
+
+# Drawn from on every shard, so they step by SHARD_ID_STRIDE.
+ID_SEQUENCES = ('messages_id_seq', 'likes_id_seq')
+
+
+class ShardMoving(Exception):
+    """A write by a user whose bucket is being moved between shards."""
+
+
+class ShardRouter:
+    """The shards' engines, threads for scatter(), and the bucket map."""
+
+    def __init__(self, app):
+        self.app = app
+        self._makers = {}
+        self._executor = None
+        self._placement = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def count(self):
+        return 1 + len(self.app.config['SHARD_URIS'])
+
+    def sessionmaker(self, number):
+        """Sessions on shard `number` (not 0: that's db.session)."""
+
+        with self._lock:
+            if number not in self._makers:
+                engine = create_engine(
+                    self.app.config['SHARD_URIS'][number - 1],
+                    **self.app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                self._makers[number] = sessionmaker(bind=engine)
+            return self._makers[number]
+
+    def engine(self, number):
+        if number == 0:
+            return db.engine
+        return self.sessionmaker(number).kw['bind']
+
+    def executor(self):
+        # Started on first use, so not in a process that forks later.
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.app.config['SHARD_SCATTER_THREADS'],
+                    thread_name_prefix='warbler-shards')
+            return self._executor
+
+    def placement(self):
+        """{bucket: (shard, moving)} for the buckets not on shard 0."""
+
+        now = time.monotonic()
+        if (self._placement is None or now - self._loaded_at
+                >= self.app.config['SHARD_MAP_REFRESH_SECONDS']):
+            self._placement = {
+                bucket: (shard, moving) for bucket, shard, moving in
+                db.session.query(ShardBucket.bucket, ShardBucket.shard,
+                                 ShardBucket.moving)}
+            self._loaded_at = now
+        return self._placement
+
+    def forget(self):
+        """Reread the map on next use."""
+
+        self._placement = None
+
+    def dispose(self):
+        with self._lock:
+            for maker in self._makers.values():
+                maker.kw['bind'].dispose()
+            self._makers = {}
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        self.forget()
+
+
+def get_router():
+    """The shard router of the current app."""
+
+    return current_app.extensions['shards']
+
+
+def shard_count():
+    return get_router().count()
+
+
+def _home(user_id):
+    router = get_router()
+    if router.count() == 1:
+        return 0, False
+    bucket = user_id % current_app.config['SHARD_BUCKETS']
+    return router.placement().get(bucket, (0, False))
+
+
+def shard_of(user_id):
+    """The number of the shard holding `user_id`'s data."""
+
+    return _home(user_id)[0]
+
+
+def session_for(number):
+    """The request's session on shard `number`: db.session's for 0."""
+
+    if number == 0:
+        return db.session()
+    sessions = g.setdefault('shard_sessions', {})
+    if number not in sessions:
+        sessions[number] = get_router().sessionmaker(number)()
+    return sessions[number]
+
+
+def home_session(user_id, write=False):
+    """The request's session on `user_id`'s shard.
+
+    Pass `write` to write their data: while their bucket is being moved,
+    that raises ShardMoving, which the app answers with a 503.
+    """
+
+    number, moving = _home(user_id)
+    if write and moving:
+        raise ShardMoving(user_id)
+    return session_for(number)
+
+
+def every_shard():
+    """All the shards, for scatter()."""
+
+    return dict.fromkeys(range(shard_count()))
+
+
+def users_by_shard(user_ids):
+    """{shard: [ids]} of `user_ids`, for scatter()."""
+
+    shards = {}
+    for user_id in user_ids:
+        shards.setdefault(shard_of(user_id), []).append(user_id)
+    return shards
+
+
+@contextmanager
+def shard_connections(**options):
+    """A connection to each shard, in shard order, for batch jobs.
+
+    `options` are execution options for each, e.g. an isolation_level.
+    """
+
+    router = get_router()
+    conns = []
+    try:
+        for number in range(router.count()):
+            conns.append(router.engine(number).connect())
+        yield [conn.execution_options(**options) for conn in conns]
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def _run(maker, fn, value):
+    session = maker()
+    try:
+        return fn(session, value)
+    finally:
+        session.close()
+
+
+def scatter(fn, shards):
+    """fn(session, value) on each of `shards` ({number: value}) at once.
+
+    Returns the results, in shard order. Shard 0 runs in this thread on
+    db.session; the others run in the router's threads, each on a session
+    of its own that's closed after, so return rows, not lazy objects.
+    """
+
+    router = get_router()
+    futures = {number: router.executor().submit(
+                   _run, router.sessionmaker(number), fn, value)
+               for number, value in shards.items() if number != 0}
+
+    results = {}
+    if 0 in shards:
+        results[0] = fn(db.session(), shards[0])
+    for number, future in futures.items():
+        results[number] = future.result()
+    return [results[number] for number in sorted(results)]
+
+
+def _other_shards():
+    return dict.fromkeys(range(1, shard_count()))
+
+
+def _upsert_users(session, rows):
+    table = User.__table__
+    insert = postgresql.insert(table)
+    session.execute(insert.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={column.name: insert.excluded[column.name]
+              for column in table.columns if column.name != 'id'}), rows)
+
+
+def copy_user(user):
+    """Write `user`'s row to every shard's copy of `users`."""
+
+    row = {column.name: getattr(user, column.key)
+           for column in User.__table__.columns}
+
+    def write(session, _):
+        _upsert_users(session, [row])
+        session.commit()
+
+    scatter(write, _other_shards())
+
+
+def remove_user(user_id):
+    """Delete a user's copies, and so their data, from the other shards."""
+
+    def delete(session, _):
+        session.execute(User.__table__.delete().where(
+            User.__table__.c.id == user_id))
+        session.commit()
+
+    scatter(delete, _other_shards())
+
+
+##############################################################################
+# Schema and rebalancing
+
+
+def id_floors(conns):
+    """The highest value of each of ID_SEQUENCES on any of `conns`."""
+
+    return {sequence: max(conn.execute(
+                f"SELECT last_value FROM {sequence}").scalar()
+                for conn in conns)
+            for sequence in ID_SEQUENCES}
+
+
+def init_shard(conn, number, stride, floors):
+    """Ready shard `number`'s tables on `conn` for sharding; safe to rerun.
+
+    Its id sequences step by `stride` from above `floors` (id_floors()),
+    starting at `number` modulo `stride`.
+    """
+
+    # The messages liked are on other shards.
+    conn.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS "
+                 "likes_message_id_fkey")
+    # The follow graph merges the shards' change logs by time, and doesn't
+    # see bucket moves.
+    conn.execute("ALTER TABLE follow_changes ADD COLUMN IF NOT EXISTS "
+                 "changed_at timestamptz NOT NULL DEFAULT clock_timestamp()")
+    conn.execute(LOG_FOLLOW_CHANGE)
+    for sequence in ID_SEQUENCES:
+        floor = floors[sequence]
+        conn.execute(f"ALTER SEQUENCE {sequence} INCREMENT BY {stride}")
+        conn.execute("SELECT setval(%s, %s)",
+                     (sequence, floor + (number - floor) % stride))
+    ensure_partitions(conn)
+
+
+def copy_users(source, conn, batch_size):
+    """Upsert every user on `source` into `conn`; return how many."""
+
+    table = User.__table__
+    copied, last_id = 0, 0
+    while True:
+        rows = [dict(row) for row in source.execute(
+            table.select().where(table.c.id > last_id)
+            .order_by(table.c.id).limit(batch_size))]
+        if not rows:
+            return copied
+        _upsert_users(conn, rows)
+        copied += len(rows)
+        last_id = rows[-1]['id']
+
+
+def _in_bucket(column, bucket):
+    return column % current_app.config['SHARD_BUCKETS'] == bucket
+
+
+def _bucket_rows(bucket):
+    """(table, condition) for a bucket's rows, in the order to copy them."""
+
+    messages, likes, follows = (Message.__table__, Like.__table__,
+                                Follows.__table__)
+    tags = MessageTag.__table__
+    message_ids = select([messages.c.id]).where(
+        _in_bucket(messages.c.user_id, bucket))
+    return [
+        (messages, _in_bucket(messages.c.user_id, bucket)),
+        (tags, tags.c.message_id.in_(message_ids)),
+        (likes, _in_bucket(likes.c.user_id, bucket)),
+        (follows, _in_bucket(follows.c.user_following_id, bucket)),
+    ]
+
+
+def _log_follows(session, log):
+    # Transaction-local, but turned back on: on shard 0 the transaction may
+    # be one the app goes on using.
+    session.execute("SELECT set_config('warbler.moving_follows', :value, "
+                    "true)", {'value': 'off' if log else 'on'})
+
+
+def copy_bucket(source, target, bucket):
+    """Copy a bucket's rows from session `source` to `target`.
+
+    Doesn't commit. Returns how many rows were copied.
+    """
+
+    _log_follows(target, False)
+    copied = 0
+    for table, condition in _bucket_rows(bucket):
+        rows = [dict(row) for row in
+                source.execute(table.select().where(condition))]
+        if table is Message.__table__ and rows:
+            ensure_partitions(target.connection(), ahead=0,
+                              upto_id=max(row['id'] for row in rows))
+        if rows:
+            target.execute(table.insert(), rows)
+        copied += len(rows)
+    _log_follows(target, True)
+    return copied
+
+
+def delete_bucket(session, bucket):
+    """Delete a bucket's rows through `session`, without committing."""
+
+    _log_follows(session, False)
+    for table, condition in reversed(_bucket_rows(bucket)):
+        session.execute(table.delete().where(condition))
+    _log_follows(session, True)
+
+
+def placement():
+    """{bucket: shard} for every bucket, from the map as stored now."""
+
+    stored = dict(db.session.query(ShardBucket.bucket, ShardBucket.shard))
+    return {bucket: stored.get(bucket, 0)
+            for bucket in range(current_app.config['SHARD_BUCKETS'])}
+
+
+def plan_rebalance(current, shards):
+    """[(bucket, shard)] moves spreading `current` ({bucket: shard}) evenly
+    over `shards` shards.
+
+    As few buckets move as can: each shard keeps what it has up to its
+    share, and only the buckets past it move, to the shards short of it.
+    """
+
+    held = {number: [] for number in range(shards)}
+    for bucket, number in sorted(current.items()):
+        held.setdefault(number, []).append(bucket)
+
+    share, extra = divmod(len(current), shards)
+    # The fullest shards keep the buckets left over by an uneven split.
+    fullest = sorted(range(shards), key=lambda number: -len(held[number]))
+    quota = {number: share + (rank < extra)
+             for rank, number in enumerate(fullest)}
+
+    spare = []
+    for number, buckets in held.items():
+        spare.extend(buckets[quota.get(number, 0):])
+
+    moves = []
+    for number in range(shards):
+        for _ in range(quota[number] - len(held[number])):
+            moves.append((spare.pop(0), number))
+    return moves
+
+
+def _set_bucket(bucket, shard, moving):
+    db.session.merge(ShardBucket(bucket=bucket, shard=shard, moving=moving))
+    db.session.commit()
+    get_router().forget()
+
+
+@contextmanager
+def _shard_session(number):
+    if number == 0:
+        yield db.session()
+        return
+    session = get_router().sessionmaker(number)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def move_bucket(bucket, target, pause=0):
+    """Move a bucket's rows to shard `target`; return how many were copied.
+
+    `pause` is how long workers can take to see a change to the map. The
+    bucket's users can't write from the time they see it's moving until
+    they see where it's gone; the old rows are deleted once no worker
+    reads them.
+    """
+
+    source = placement()[bucket]
+    if source == target:
+        return 0
+
+    _set_bucket(bucket, source, moving=True)
+    time.sleep(pause)
+    with _shard_session(source) as src, _shard_session(target) as dst:
+        try:
+            copied = copy_bucket(src, dst, bucket)
+            dst.commit()
+        except Exception:
+            dst.rollback()
+            _set_bucket(bucket, source, moving=False)
+            raise
+
+    _set_bucket(bucket, target, moving=False)
+    time.sleep(pause)
+    with _shard_session(source) as src:
+        delete_bucket(src, bucket)
+        src.commit()
+    return copied
+
+
+@shards_cli.command('init')
+def init_command():
+    """Ready every shard's schema and copy users to them."""
+
+    config = current_app.config
+    router = get_router()
+    if router.count() > config['SHARD_ID_STRIDE']:
+        raise click.UsageError(
+            f"More shards than SHARD_ID_STRIDE ({config['SHARD_ID_STRIDE']}).")
+
+    with shard_connections() as conns:
+        for conn in conns:
+            db.metadata.create_all(bind=conn)
+        floors = id_floors(conns)
+        for number, conn in enumerate(conns):
+            with conn.begin():
+                init_shard(conn, number, config['SHARD_ID_STRIDE'], floors)
+                copied = 0 if number == 0 else copy_users(
+                    conns[0], conn, config['SHARD_COPY_BATCH'])
+            click.echo(f"Shard {number}: ready, {copied} users copied.")
+
+
+@shards_cli.command('status')
+def status_command():
+    """Show how many buckets each shard holds."""
+
+    moving = db.session.query(func.count()).filter(
+        ShardBucket.moving).scalar()
+    held = {}
+    for shard in placement().values():
+        held[shard] = held.get(shard, 0) + 1
+    for number in range(shard_count()):
+        click.echo(f"Shard {number}: {held.get(number, 0)} buckets")
+    if moving:
+        click.echo(f"{moving} buckets moving")
+
+
+@shards_cli.command('move')
+@click.argument('bucket', type=int)
+@click.argument('shard', type=int)
+def move_command(bucket, shard):
+    """Move the data of BUCKET's users to SHARD."""
+
+    if not 0 <= shard < shard_count():
+        raise click.BadParameter(f"no shard {shard}", param_hint='SHARD')
+    copied = move_bucket(bucket, shard,
+                         current_app.config['SHARD_MAP_REFRESH_SECONDS'])
+    click.echo(f"Bucket {bucket}: {copied} rows moved to shard {shard}.")
+
+
+@shards_cli.command('rebalance')
+def rebalance_command():
+    """Spread the buckets evenly over the shards."""
+
+    pause = current_app.config['SHARD_MAP_REFRESH_SECONDS']
+    moves = plan_rebalance(placement(), shard_count())
+    for done, (bucket, shard) in enumerate(moves, 1):
+        start = time.perf_counter()
+        copied = move_bucket(bucket, shard, pause)
+        click.echo(f"[{done}/{len(moves)}] bucket {bucket} -> shard {shard}: "
+                   f"{copied} rows in {time.perf_counter() - start:.1f}s")
+    click.echo(f"Moved {len(moves)} buckets.")
+
+
+def _close_sessions(error=None):
+    for session in g.pop('shard_sessions', {}).values():
+        session.close()
+
+
+def _moving(e):
+    wait = current_app.config['SHARD_RETRY_AFTER']
+    return (f"<p>Your data is being moved. "
+            f"Please try again in {wait} seconds.</p>", 503,
+            {'Retry-After': str(wait), 'Cache-Control': 'no-store'})
+
+
+def connect_shards(app):
+    """Route the provided Flask app's per-user data to shards."""
+
+    app.config.setdefault(
+        'SHARD_URIS', os.environ.get('SHARD_DATABASE_URLS', '').split())
+    # Fixed once there's data: a user's bucket is their id modulo this.
+    app.config.setdefault('SHARD_BUCKETS', 1024)
+    # Message and like ids step by this, so it caps the number of shards.
+    app.config.setdefault('SHARD_ID_STRIDE', 64)
+    app.config.setdefault('SHARD_MAP_REFRESH_SECONDS', 5)
+    app.config.setdefault('SHARD_SCATTER_THREADS', 8)
+    app.config.setdefault('SHARD_RETRY_AFTER', 10)
+    app.config.setdefault('SHARD_COPY_BATCH', 10000)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+
+    app.extensions['shards'] = ShardRouter(app)
+
+    app.teardown_request(_close_sessions)
+    app.teardown_appcontext(_close_sessions)
+    app.register_error_handler(ShardMoving, _moving)
+    app.cli.add_command(shards_cli)
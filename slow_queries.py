@@ -0,0 +1,334 @@
+"""Slow-query log for Warbler.
+
+Every statement the app runs is timed. One that takes longer than
+SLOW_QUERY_THRESHOLD seconds is written to SLOW_QUERY_LOG, one JSON object
+per line, with:
+
+- `sql`: the statement normalized: literals become '?' and IN lists
+  collapse to one placeholder, so the same query with other values (or
+  more ids) looks the same; `fingerprint` is a short hash of it;
+- `params`: the shape of the parameters, each name with its type, and how
+  long any IN list was;
+- `route` and `caller`: the endpoint (or CLI command) and the line of
+  Warbler's own code the statement came from;
+- `plan`: its EXPLAIN, with SLOW_QUERY_EXPLAIN_TIMEOUT. Plain SELECTs get
+  EXPLAIN (ANALYZE, BUFFERS), which runs them again; anything else just
+  EXPLAIN, which doesn't.
+
+The request doesn't wait for the plan. The statement and its parameters
+go to a daemon thread, which explains them on a connection of its own,
+outside the pool, and then writes the record; so a slow request isn't made
+slower, and doesn't take a second pooled connection while holding one. At
+most SLOW_QUERY_MAX_PER_MINUTE wait; past that, records go out without a
+plan.
+
+A query that stays slow is logged at most once every
+SLOW_QUERY_INTERVAL seconds (the record says how many were skipped in
+between), and no more than SLOW_QUERY_MAX_PER_MINUTE records are written
+a minute in all, so a slow page under load doesn't turn into an EXPLAIN
+storm. The log rotates at 10MB.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from metrics import counter
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SLOW_QUERIES = counter(
+    'warbler_slow_queries_total',
+    "Statements slower than SLOW_QUERY_THRESHOLD, by route.",
+    labels=('route',))
+
+# Runs of bind parameters, e.g. IN (%(id_1)s, %(id_2)s, ...).
+PARAMETER_LIST = re.compile(r'\(\s*%\(\w+\)s(?:\s*,\s*%\(\w+\)s)+\s*\)')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'(?<![\w%)])-?\d+(?:\.\d+)?\b')
+WHITESPACE = re.compile(r'\s+')
+EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.I)
+# SQLAlchemy numbers the parameters it generates: user_id_1, user_id_2...
+PARAMETER_NUMBER = re.compile(r'_\d+$')
+
+# Explaining runs statements too; they mustn't be timed themselves.
+_explaining = threading.local()
+
+
+def normalize_sql(statement):
+    """`statement` with its values taken out."""
+
+    sql = PARAMETER_LIST.sub('(?)', statement)
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+def parameter_shape(parameters, executemany=False):
+    """The names and types of a statement's parameters, without values.
+
+    Numbered parameters of the same name (an IN list) are counted:
+    {'user_id': 'int x 37'}.
+    """
+
+    if executemany:
+        return {'rows': len(parameters),
+                'each': parameter_shape(parameters[0]) if parameters else {}}
+    if not isinstance(parameters, dict):
+        return [type(value).__name__ for value in parameters or ()]
+
+    shape = {}
+    for name, value in sorted(parameters.items()):
+        shape.setdefault(PARAMETER_NUMBER.sub('', name), []).append(
+            type(value).__name__)
+    return {name: types[0] if len(types) == 1
+            else f"{types[0]} x {len(types)}"
+            for name, types in shape.items()}
+
+
+def _caller():
+    """`file:line function` of the innermost Warbler frame below here."""
+
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (filename.startswith(PROJECT_DIR) and filename != __file__
+                and 'site-packages' not in filename):
+            return (f"{os.path.relpath(filename, PROJECT_DIR)}:"
+                    f"{frame.f_lineno} {frame.f_code.co_name}")
+        frame = frame.f_back
+    return None
+
+
+def _route():
+    if has_request_context():
+        return request.endpoint or request.path
+    return 'cli'
+
+
+class SlowQueryLog:
+    """Rate-limited writer of slow-query records."""
+
+    def __init__(self, path, interval, max_per_minute):
+        self.interval = interval
+        self.max_per_minute = max_per_minute
+        self._last = {}
+        self._skipped = {}
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+
+        self._handler = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=10 * 1024 * 1024, backupCount=5, delay=True)
+
+    def allow(self, fingerprint, now=None):
+        """Should a record for `fingerprint` be written now?
+
+        Returns how many were skipped since the last one, or None.
+        """
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            last = self._last.get(fingerprint)
+            minute, written = self._window
+            if int(now // 60) != minute:
+                minute, written = int(now // 60), 0
+
+            if ((last is not None and now - last < self.interval)
+                    or written >= self.max_per_minute):
+                self._skipped[fingerprint] = (
+                    self._skipped.get(fingerprint, 0) + 1)
+                return None
+
+            self._last[fingerprint] = now
+            self._window = (minute, written + 1)
+            return self._skipped.pop(fingerprint, 0)
+
+    def write(self, record):
+        if self._handler is not None:
+            self._handler.handle(logging.makeLogRecord(
+                {'msg': json.dumps(record, default=str)}))
+
+    def close(self):
+        if self._handler is not None:
+            self._handler.close()
+
+
+def explain(engine, statement, parameters, timeout_ms):
+    """The plan of `statement`, as Postgres's JSON, or an error string."""
+
+    # Only plain reads are run again: a WITH can hide a write.
+    analyze = (statement.lstrip().upper().startswith('SELECT')
+               and 'FOR UPDATE' not in statement.upper())
+    options = ('ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON')
+
+    _explaining.active = True
+    try:
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+            cursor.execute(f"EXPLAIN ({options}) {statement}", parameters)
+            return cursor.fetchone()[0]
+        except Exception as e:
+            return f"{type(e).__name__}: {e}".strip()
+        finally:
+            conn.rollback()
+            conn.close()
+    finally:
+        _explaining.active = False
+
+
+class Explainer:
+    """Explains slow statements and writes their records, in a daemon thread.
+
+    The thread starts on the first submit() in each process, and connects
+    with an engine of its own per database, without a pool.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._queue = queue.Queue(app.config['SLOW_QUERY_MAX_PER_MINUTE'])
+        self._engines = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, log, record, url, statement, parameters):
+        """Add the plan of `statement` on `url` to `record`, then write it to
+        `log`; without a plan if too many are waiting."""
+
+        self.start()
+        # Copied: the caller's parameters may be reused once it returns.
+        if isinstance(parameters, dict):
+            parameters = dict(parameters)
+        elif parameters is not None:
+            parameters = tuple(parameters)
+        try:
+            self._queue.put_nowait((log, record, url, statement, parameters))
+        except queue.Full:
+            record['plan'] = "not explained: too many waiting"
+            log.write(record)
+
+    def join(self):
+        """Wait for every submitted record to be written."""
+
+        self._queue.join()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._engines = {}
+                threading.Thread(target=self._run, daemon=True,
+                                 name='warbler-explain').start()
+
+    def _engine(self, url):
+        if url not in self._engines:
+            self._engines[url] = create_engine(url, poolclass=NullPool)
+        return self._engines[url]
+
+    def _run(self):
+        while True:
+            log, record, url, statement, parameters = self._queue.get()
+            try:
+                record['plan'] = explain(
+                    self._engine(url), statement, parameters,
+                    self.app.config['SLOW_QUERY_EXPLAIN_TIMEOUT'])
+                log.write(record)
+            except Exception:
+                self.app.logger.exception("explaining a slow query failed")
+            finally:
+                self._queue.task_done()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('slow_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    started = conn.info.get('slow_query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+
+    if not has_app_context() or getattr(_explaining, 'active', False):
+        return
+    app = current_app._get_current_object()
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is None or elapsed < threshold:
+        return
+
+    # Transaction control (BEGIN, SAVEPOINT...) has no plan to look at.
+    if not EXPLAINABLE.match(statement):
+        return
+
+    route = _route()
+    SLOW_QUERIES.inc(route=route)
+
+    sql = normalize_sql(statement)
+    fingerprint = hashlib.sha1(sql.encode()).hexdigest()[:12]
+    log = app.extensions['slow_queries']
+    skipped = log.allow(fingerprint)
+    if skipped is None:
+        return
+
+    record = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'duration': round(elapsed, 6),
+        'fingerprint': fingerprint,
+        'sql': sql,
+        'params': parameter_shape(parameters, executemany),
+        'route': route,
+        'caller': _caller(),
+        'skipped': skipped,
+        'plan': None,
+    }
+    if executemany:
+        log.write(record)
+    else:
+        app.extensions['slow_query_explainer'].submit(
+            log, record, conn.engine.url, statement, parameters)
+    app.logger.warning("slow query (%.3fs) in %s: %s", elapsed, route,
+                       sql[:200])
+
+
+def connect_slow_queries(app):
+    """Log the provided Flask app's slow statements, with their plans.
+
+    SLOW_QUERY_THRESHOLD = None turns it off.
+    """
+
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.2)
+    app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.instance_path,
+                                                         'slow-queries.log'))
+    app.config.setdefault('SLOW_QUERY_INTERVAL', 60)
+    app.config.setdefault('SLOW_QUERY_MAX_PER_MINUTE', 30)
+    # Milliseconds.
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_TIMEOUT', 5000)
+
+    app.extensions['slow_queries'] = SlowQueryLog(
+        app.config['SLOW_QUERY_LOG'],
+        interval=app.config['SLOW_QUERY_INTERVAL'],
+        max_per_minute=app.config['SLOW_QUERY_MAX_PER_MINUTE'])
+    app.extensions['slow_query_explainer'] = Explainer(app)
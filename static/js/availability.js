@@ -0,0 +1,64 @@
+// Live username/email availability on the signup form (availability.py).
+//
+// As a field is typed into, ask /api/availability about it (after a short
+// pause) and show whether it's free. A taken value blocks submitting the
+// form, so a collision is caught before the server hashes any password.
+// Without JavaScript, the server makes the same check on submit.
+
+(function () {
+  var DELAY = 300;
+
+  function watch(input, field) {
+    var timer = null;
+    var asked = null;
+    var note = document.createElement("small");
+    note.className = "availability form-text";
+    input.insertAdjacentElement("afterend", note);
+
+    function show(available) {
+      note.textContent = available ? "" :
+        field === "username" ? "Username already taken" :
+        "E-mail already registered";
+      note.classList.toggle("text-danger", !available);
+      input.setCustomValidity(available ? "" : note.textContent);
+    }
+
+    function ask() {
+      var value = input.value.trim();
+      asked = value;
+      if (!value || (field === "email" && !input.checkValidity() &&
+                     !input.validity.customError)) {
+        show(true);
+        return;
+      }
+      fetch("/api/availability?" + field + "=" + encodeURIComponent(value),
+            { credentials: "same-origin" })
+        .then(function (resp) {
+          if (!resp.ok) throw new Error(resp.status);
+          return resp.json();
+        })
+        .then(function (data) {
+          // Only the answer for what's in the field now counts.
+          if (asked === value) show(data[field].available);
+        })
+        .catch(function () {
+          // Leave it to the server's check on submit.
+          show(true);
+        });
+    }
+
+    input.addEventListener("input", function () {
+      clearTimeout(timer);
+      timer = setTimeout(ask, DELAY);
+    });
+  }
+
+  document.addEventListener("DOMContentLoaded", function () {
+    var form = document.getElementById("user_form");
+    if (!form) return;
+    ["username", "email"].forEach(function (field) {
+      var input = form.querySelector("[name=" + field + "]");
+      if (input) watch(input, field);
+    });
+  });
+})();
@@ -0,0 +1,45 @@
+// Infinite scrolling for paginated lists (pagination.py).
+//
+// When a list's "next" link scrolls into view, fetch the next page's
+// fragment (its rows and pager) and put it in place of the pager. Without
+// JavaScript, or IntersectionObserver, the link still works as a link.
+
+(function () {
+  if (!("IntersectionObserver" in window)) return;
+
+  var observer = new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting) load(entry.target);
+    });
+  }, { rootMargin: "400px" });
+
+  function watch(root) {
+    root.querySelectorAll(".pager a[rel=next][data-fragment]")
+      .forEach(function (link) { observer.observe(link); });
+  }
+
+  function load(link) {
+    observer.unobserve(link);
+    var pager = link.closest(".pager");
+
+    fetch(link.dataset.fragment, { credentials: "same-origin" })
+      .then(function (resp) {
+        if (!resp.ok) throw new Error(resp.status);
+        return resp.text();
+      })
+      .then(function (html) {
+        var template = document.createElement("template");
+        template.innerHTML = html;
+        var fragment = template.content;
+        watch(fragment);
+        pager.replaceWith(fragment);
+      })
+      .catch(function () {
+        // Leave the link for the reader to click.
+      });
+  }
+
+  document.addEventListener("DOMContentLoaded", function () {
+    watch(document);
+  });
+})();
@@ -0,0 +1,320 @@
+"""Hashtags, mentions and trending topics for Warbler.
+
+Tags are pulled out of a message when it's posted and stored in
+`message_tags`, lowercased and with their sigil ('#flask', '@alice'), so a
+tag's feed is an index range scan rather than a LIKE over every message.
+
+Trending tags are counted without touching the database: each posted tag
+goes into a count-min sketch, kept per time slice, in a memory-mapped file
+shared by every worker on the host (TRENDING_PATH). A tag's count over the
+last N seconds is the sum of the slices they cover; old slices are zeroed
+as the window slides on. Alongside the sketch sits a small table of the
+tags with the highest counts seen so far; the trending list is the top k of
+those, re-estimated and picked with a heap when it's asked for.
+
+Counts are approximate: the sketch can overcount a tag (when it collides
+with busier ones in every row), never undercount it.
+"""
+
+import fcntl
+import hashlib
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+
+from metrics import counter
+
+# '#' or '@', then word characters, not inside a word or an email address.
+TAG_PATTERN = re.compile(r'(?<![\w#@])([#@])(\w{1,50})')
+
+TRENDING_TAGS = counter(
+    'warbler_trending_tags_total',
+    "Tags counted by the trending sketch.")
+
+
+def extract_tags(text):
+    """The distinct tags in `text`, e.g. ['#flask', '@alice'], in order."""
+
+    tags = []
+    for sigil, name in TAG_PATTERN.findall(text):
+        tag = sigil + name.lower()
+        if tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def tag_url(tag):
+    """URL of a tag's feed; hashtags drop the '#'."""
+
+    return url_for('warbler.tag_feed', tag=tag.lstrip('#'))
+
+
+def tag_from_url(name):
+    """The stored tag for the <tag> part of a feed URL."""
+
+    name = name.lower()
+    return name if name.startswith('@') else '#' + name
+
+
+def linkify_tags(text):
+    """Escape message text, linking its tags to their feeds."""
+
+    def link(match):
+        tag = match.group(1) + match.group(2).lower()
+        return (f'<a href="{tag_url(tag)}" class="tag">'
+                f'{escape(match.group(0))}</a>')
+
+    return Markup(TAG_PATTERN.sub(link, str(escape(text))))
+
+
+class TrendingSketch:
+    """Sliding-window count-min sketch with a table of top candidates.
+
+    The window is `slices` slices of `slice_seconds` each. With a `path` the
+    sketch lives in that file and is shared between processes, locked with
+    a record lock while it's used; without one it's private to the process.
+    """
+
+    MAGIC = b'WBLRTREND1'
+    HEADER = struct.Struct('<10sIIIII')
+    HEADER_SIZE = 64
+    # Room for a 50 character tag in UTF-8, plus its sigil.
+    TAG_SIZE = 256
+
+    def __init__(self, path=None, slices=12, slice_seconds=300, depth=4,
+                 width=4096, capacity=64):
+        self.path = path
+        self.slices = slices
+        self.slice_seconds = slice_seconds
+        self.depth = depth
+        self.width = width
+        self.capacity = capacity
+
+        # Layout: header, slice numbers, counters, candidate estimates,
+        # candidate tags.
+        self._counts_at = self.HEADER_SIZE + 8 * slices
+        self._estimates_at = self._counts_at + 4 * slices * depth * width
+        self._tags_at = self._estimates_at + 8 * capacity
+        self.size = self._tags_at + self.TAG_SIZE * capacity
+
+        self._map = None
+        self._fd = None
+        self._pid = None
+        # Record locks are per process; threads need their own lock.
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # A private sketch isn't shared with forked workers: each gets its own.
+        if self._map is not None and (self.path or self._pid == os.getpid()):
+            return
+
+        header = self.HEADER.pack(self.MAGIC, self.slices, self.slice_seconds,
+                                  self.depth, self.width, self.capacity)
+
+        if self.path is None:
+            self._map = mmap.mmap(-1, self.size)
+            self._map[:len(header)] = header
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                # A file laid out for other settings is started afresh.
+                if os.pread(fd, len(header), 0) != header:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, header, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            self._map = mmap.mmap(fd, self.size)
+
+        view = memoryview(self._map)
+        self._epochs = view[self.HEADER_SIZE:self._counts_at].cast('q')
+        self._counts = view[self._counts_at:self._estimates_at].cast('I')
+        self._estimates = view[self._estimates_at:self._tags_at].cast('q')
+        self._pid = os.getpid()
+
+    def _locked(self, func):
+        self._open()
+        with self._lock:
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                return func()
+            finally:
+                if self._fd is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _cells(self, tag):
+        """The counter index of `tag` in each row of a slice."""
+
+        digest = hashlib.blake2b(tag.encode(), digest_size=4 * self.depth)
+        hashes = struct.unpack(f'<{self.depth}I', digest.digest())
+        return [row * self.width + h % self.width
+                for row, h in enumerate(hashes)]
+
+    def _live(self, current):
+        """Ring positions of the slices in the window, newest first."""
+
+        return [(current - age) % self.slices for age in range(self.slices)
+                if self._epochs[(current - age) % self.slices] == current - age]
+
+    def _slide(self, now):
+        """Move the window up to `now`; return the live slice positions.
+
+        The slice `now` falls in reuses the ring position of one that has
+        left the window, so it's zeroed first.
+        """
+
+        current = int(now // self.slice_seconds)
+        position = current % self.slices
+        if self._epochs[position] != current:
+            cells = self.depth * self.width
+            start = self._counts_at + 4 * position * cells
+            self._map[start:start + 4 * cells] = bytes(4 * cells)
+            self._epochs[position] = current
+            self._rescore(self._live(current))
+
+        return self._live(current)
+
+    def _estimate(self, cells, positions):
+        per_slice = self.depth * self.width
+        return min(sum(self._counts[p * per_slice + cell] for p in positions)
+                   for cell in cells)
+
+    def _tag(self, slot):
+        start = self._tags_at + slot * self.TAG_SIZE
+        return bytes(self._map[start:start + self.TAG_SIZE]).rstrip(b'\0')
+
+    def _set_tag(self, slot, tag):
+        start = self._tags_at + slot * self.TAG_SIZE
+        self._map[start:start + self.TAG_SIZE] = tag.ljust(self.TAG_SIZE, b'\0')
+
+    def _rescore(self, positions):
+        """Re-estimate the candidates after the window has moved."""
+
+        for slot in range(self.capacity):
+            tag = self._tag(slot)
+            if tag:
+                self._estimates[slot] = self._estimate(
+                    self._cells(tag.decode()), positions)
+
+    def add(self, tags, now=None):
+        """Count one use of each of `tags` now."""
+
+        now = time.time() if now is None else now
+
+        def add_locked():
+            positions = self._slide(now)
+            offset = positions[0] * self.depth * self.width
+            for tag in tags:
+                encoded = tag.encode()
+                cells = self._cells(tag)
+                for cell in cells:
+                    self._counts[offset + cell] += 1
+                estimate = self._estimate(cells, positions)
+
+                # Keep the tag if it's a candidate already, or beats the
+                # weakest one.
+                slots = [self._tag(slot) for slot in range(self.capacity)]
+                if encoded in slots:
+                    slot = slots.index(encoded)
+                else:
+                    slot = min(range(self.capacity),
+                               key=lambda s: (bool(slots[s]),
+                                              self._estimates[s]))
+                    if slots[slot] and self._estimates[slot] >= estimate:
+                        continue
+                    self._set_tag(slot, encoded)
+                self._estimates[slot] = estimate
+
+        self._locked(add_locked)
+        TRENDING_TAGS.inc(len(tags))
+
+    def count(self, tag, seconds=None, now=None):
+        """Estimated uses of `tag` in the last `seconds` (default: window)."""
+
+        now = time.time() if now is None else now
+
+        def count_locked():
+            positions = self._recent(self._slide(now), seconds)
+            return self._estimate(self._cells(tag), positions)
+
+        return self._locked(count_locked)
+
+    def _recent(self, positions, seconds):
+        if seconds is None:
+            return positions
+        wanted = max(1, -(-int(seconds) // self.slice_seconds))
+        return positions[:wanted]
+
+    def top(self, k=10, seconds=None, now=None):
+        """[(tag, estimated count), ...] of the `k` busiest candidates."""
+
+        now = time.time() if now is None else now
+
+        def top_locked():
+            positions = self._recent(self._slide(now), seconds)
+            scored = []
+            for slot in range(self.capacity):
+                tag = self._tag(slot).decode()
+                if tag:
+                    scored.append((self._estimate(self._cells(tag), positions),
+                                   tag))
+            # Busiest first; ties alphabetically.
+            return heapq.nsmallest(k, scored, key=lambda s: (-s[0], s[1]))
+
+        return [(tag, count) for count, tag in self._locked(top_locked)
+                if count > 0]
+
+    def clear(self):
+        def clear_locked():
+            self._map[self.HEADER_SIZE:] = bytes(self.size - self.HEADER_SIZE)
+
+        self._locked(clear_locked)
+
+
+def get_trending():
+    """The trending sketch of the current app, created on first use."""
+
+    app = current_app._get_current_object()
+    sketch = app.extensions.get('trending')
+    if sketch is None:
+        config = app.config
+        sketch = app.extensions['trending'] = TrendingSketch(
+            config['TRENDING_PATH'],
+            slices=config['TRENDING_SLICES'],
+            slice_seconds=config['TRENDING_SLICE_SECONDS'],
+            capacity=config['TRENDING_CANDIDATES'])
+    return sketch
+
+
+def trending_tags(k=None, seconds=None):
+    """The app's trending tags as [(tag, count), ...], busiest first."""
+
+    return get_trending().top(k or current_app.config['TRENDING_SHOWN'],
+                              seconds)
+
+
+def connect_tags(app):
+    """Add tag links and trending topics to the provided Flask app."""
+
+    app.config.setdefault(
+        'TRENDING_PATH', os.path.join(app.instance_path, 'warbler-trending.mmap'))
+    # A one hour window, sliding five minutes at a time.
+    app.config.setdefault('TRENDING_SLICES', 12)
+    app.config.setdefault('TRENDING_SLICE_SECONDS', 300)
+    app.config.setdefault('TRENDING_CANDIDATES', 64)
+    app.config.setdefault('TRENDING_SHOWN', 5)
+
+    app.add_template_filter(linkify_tags, 'tags')
+    app.add_template_filter(tag_url, 'tag_url')
@@ -0,0 +1,135 @@
+"""Template rendering helpers for Warbler."""
+
+import os
+import tempfile
+
+import click
+from flask import (Response, current_app, get_flashed_messages,
+                   stream_with_context)
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+templates_cli = AppGroup('templates', help="Manage compiled templates.")
+
+# Output by {{ flush() }}; when streaming, marks a point where everything
+# rendered so far should be sent to the client right away.
+FLUSH = Markup("<!-- flush -->")
+
+
+def flush():
+    """Template global: flush the streamed response at this point."""
+
+    return FLUSH
+
+
+def _chunks(events, size):
+    """Join rendered template output into chunks of about `size` chars.
+
+    A chunk is also cut wherever the template called flush().
+    """
+
+    buffer = []
+    length = 0
+
+    for event in events:
+        if event == FLUSH:
+            if buffer:
+                yield ''.join(buffer)
+                buffer = []
+                length = 0
+            continue
+
+        buffer.append(event)
+        length += len(event)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response.
+
+    The page is sent as it renders: everything before the first flush() in
+    the template goes out immediately, and the rest in chunks of about
+    STREAM_CHUNK_SIZE characters. Pass lazy rows (a query, or a
+    pagination.Page) rather than lists so they are fetched after the head
+    has gone out.
+    """
+
+    app = current_app._get_current_object()
+
+    # The session is saved before the body streams, so flashed messages
+    # must be popped now or they would be shown again on the next page.
+    get_flashed_messages(with_categories=True)
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    events = template.generate(context)
+
+    return Response(stream_with_context(
+        _chunks(events, app.config['STREAM_CHUNK_SIZE'])))
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """Jinja bytecode cache that several worker processes can share.
+
+    Entries are written to a temporary file and renamed into place, so a
+    worker never loads another worker's half-written entry. Jinja checks
+    each entry against a hash of the template source (and the Python
+    version) before using it, so stale entries are simply recompiled.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, '%s.jinja')
+
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def compile_templates(env):
+    """Compile every template into `env`'s bytecode cache; return the count."""
+
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+
+    return len(names)
+
+
+@templates_cli.command('compile')
+def compile_command():
+    """Precompile all templates into TEMPLATE_CACHE_DIR."""
+
+    count = compile_templates(current_app.jinja_env)
+    click.echo(f"Compiled {count} templates into "
+               f"{current_app.config['TEMPLATE_CACHE_DIR']}")
+
+
+def connect_templating(app):
+    """Set up template helpers on the provided Flask app."""
+
+    app.config.setdefault('STREAM_CHUNK_SIZE', 8192)
+    app.config.setdefault(
+        'TEMPLATE_CACHE_DIR',
+        os.environ.get('TEMPLATE_CACHE_DIR',
+                       os.path.join(app.instance_path, 'jinja-cache')))
+
+    if app.config['TEMPLATE_CACHE_DIR']:
+        app.jinja_env.bytecode_cache = SharedBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+
+    app.add_template_global(flush, 'flush')
+    app.cli.add_command(templates_cli)
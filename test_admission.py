@@ -0,0 +1,133 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_admission.py
+
+
+from unittest import TestCase, mock
+
+from sqlalchemy import exc
+
+from models import db, User
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from admission import (CRITICAL, EXEMPT, LOW, NORMAL, REQUESTS_SHED, Load,
+                       TimedQueuePool, get_load, route_class)
+
+
+class LoadTestCase(TestCase):
+    """Test tracking a worker's load."""
+
+    def test_pool_wait_decays(self):
+        load = Load(decay_seconds=10)
+        for _ in range(20):
+            load.record_wait(2.0, now=100)
+
+        self.assertAlmostEqual(load.pool_wait(now=100), 2.0, places=1)
+        self.assertLess(load.pool_wait(now=110), 1.0)
+        self.assertLess(load.pool_wait(now=200), 0.001)
+
+        # A time from before the last wait doesn't inflate it.
+        self.assertAlmostEqual(load.pool_wait(now=0), 2.0, places=1)
+
+    def test_in_flight(self):
+        load = Load(decay_seconds=10)
+        load.enter()
+        load.enter()
+        load.leave()
+        self.assertEqual(load.in_flight, 1)
+
+
+class AdmissionTestCase(DatabaseTestCase):
+    """Test shedding requests under load."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+        self.addCleanup(get_load().reset)
+
+        self.user = User.signup("busy", "busy@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def log_in(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def saturate(self, wait):
+        for _ in range(50):
+            get_load().record_wait(wait)
+
+    def test_route_classes(self):
+        with app.test_request_context():
+            self.assertEqual(route_class('warbler.login', False), CRITICAL)
+            self.assertEqual(route_class('warbler.list_users', True), LOW)
+            self.assertEqual(route_class('warbler.homepage', True), NORMAL)
+            self.assertEqual(route_class('warbler.homepage', False), LOW)
+            self.assertEqual(route_class('images.image_proxy', False),
+                             EXEMPT)
+
+    def test_idle_admits_everything(self):
+        self.assertEqual(self.client.get("/users").status_code, 200)
+        self.assertEqual(get_load().in_flight, 0)
+
+    def test_pool_wait_sheds_low_first(self):
+        shed = REQUESTS_SHED.value(route_class=LOW, reason='pool_wait')
+        self.saturate(0.5)
+        self.log_in()
+
+        resp = self.client.get("/users")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'],
+                         str(app.config['ADMISSION_RETRY_AFTER']))
+        self.assertEqual(
+            REQUESTS_SHED.value(route_class=LOW, reason='pool_wait'), shed + 1)
+
+        self.assertEqual(self.client.get(f"/users/{self.user_id}").status_code,
+                         200)
+
+        self.saturate(5.0)
+        self.assertEqual(self.client.get(f"/users/{self.user_id}").status_code,
+                         503)
+        self.assertEqual(self.client.get("/messages/new").status_code, 200)
+
+    def test_anonymous_pages_are_low(self):
+        self.saturate(0.5)
+
+        self.assertEqual(self.client.get("/").status_code, 503)
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_static_and_images_are_exempt(self):
+        self.saturate(5.0)
+        get_load().in_flight = app.config['ADMISSION_LIMITS'][LOW][0]
+
+        for url in ("/static/images/default-pic.png",
+                    f"/img/avatar/{'0' * 32}"):
+            self.assertNotEqual(self.client.get(url).status_code, 503)
+        self.assertEqual(get_load().in_flight,
+                         app.config['ADMISSION_LIMITS'][LOW][0])
+
+    def test_in_flight_limit(self):
+        self.log_in()
+        get_load().in_flight = app.config['ADMISSION_LIMITS'][LOW][0]
+
+        self.assertEqual(self.client.get("/users").status_code, 503)
+        self.assertEqual(self.client.get("/").status_code, 200)
+
+    def test_pool_timeout(self):
+        self.log_in()
+        with mock.patch.object(User, 'by_id',
+                               side_effect=exc.TimeoutError("pool")):
+            resp = self.client.get("/")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertEqual(get_load().in_flight, 0)
+
+    def test_pool_checkouts_are_timed(self):
+        self.assertIsInstance(db.engine.pool, TimedQueuePool)
+        self.assertEqual(db.engine.pool._timeout,
+                         app.config['ADMISSION_POOL_TIMEOUT'])
@@ -0,0 +1,101 @@
+"""App factory and worker boot tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_app_factory.py
+
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from models import db
+
+from app import create_app
+from fixtures import TEST_CONFIG, prepare_database
+
+# Seconds a worker may spend importing the app and calling create_app().
+# This runs well under half a second on a laptop; the slack is for slow CI.
+BOOT_BUDGET = 1.0
+
+# Only imported once a request actually needs them.
+OPTIONAL_MODULES = ('PIL', 'brotli', 'flask_debugtoolbar', 'numpy', 'scipy')
+
+BOOT = f"""
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app()
+print(json.dumps({{
+    'seconds': time.perf_counter() - start,
+    'loaded': [m for m in {OPTIONAL_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+class AppFactoryTestCase(TestCase):
+    """Test that creating an app is cheap and fork-safe."""
+
+    def boot(self):
+        out = subprocess.run([sys.executable, '-c', BOOT],
+                             check=True, stdout=subprocess.PIPE).stdout
+        return json.loads(out)
+
+    def test_boot_time_budget(self):
+        # Best of three, so one slow run on a busy machine doesn't fail it.
+        seconds = min(self.boot()['seconds'] for _ in range(3))
+        self.assertLess(seconds, BOOT_BUDGET)
+
+    def test_optional_extensions_not_imported(self):
+        self.assertEqual(self.boot()['loaded'], [])
+
+    def test_create_app_does_not_connect(self):
+        app = create_app({
+            **TEST_CONFIG,
+            'SQLALCHEMY_DATABASE_URI': "postgresql://nobody@127.0.0.1:1/none",
+        })
+
+        self.assertEqual(app.extensions['sqlalchemy'].connectors, {})
+
+    def test_config_overrides(self):
+        app = create_app({**TEST_CONFIG, 'STREAM_CHUNK_SIZE': 10})
+
+        self.assertTrue(app.config['TESTING'])
+        self.assertEqual(app.config['STREAM_CHUNK_SIZE'], 10)
+
+    def test_forked_worker_gets_own_connection(self):
+        prepare_database()
+        app = create_app(TEST_CONFIG)
+
+        with app.app_context():
+            parent_pid = db.session.execute(
+                "SELECT pg_backend_pid()").scalar()
+            db.session.commit()
+
+            read, write = os.pipe()
+            child = os.fork()
+            if child == 0:
+                # A forked worker: the pooled connection the parent just
+                # returned must not be reused here.
+                try:
+                    pid = db.session.execute(
+                        "SELECT pg_backend_pid()").scalar()
+                    os.write(write, str(pid).encode())
+                finally:
+                    os._exit(0)
+
+            os.close(write)
+            os.waitpid(child, 0)
+            child_pid = int(os.read(read, 32))
+            os.close(read)
+
+            self.assertNotEqual(child_pid, parent_pid)
+
+            # ...and the parent's connection is still usable.
+            self.assertEqual(
+                db.session.execute("SELECT pg_backend_pid()").scalar(),
+                parent_pid)
+            db.session.rollback()
+            db.engine.dispose()
@@ -0,0 +1,188 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_archive.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from bs4 import BeautifulSoup
+
+from models import db, User, Message, MessageTag, Like, MESSAGE_PARTITION_SIZE
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase, count_queries
+from archive import (_columns, archive_partition, archivable_partitions,
+                     archived_messages, ensure_partitions, maintain,
+                     partitions, read_index)
+
+
+class ArchiveTestCase(DatabaseTestCase):
+    """Test archiving old partitions and reading them back."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+        self.conn = db.session.connection()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = os.path.join(directory, 'archive')
+        self.addCleanup(app.config.update,
+                        MESSAGES_ARCHIVE_DIR=None,
+                        PAGE_SIZE=app.config['PAGE_SIZE'])
+        app.config['MESSAGES_ARCHIVE_DIR'] = self.directory
+
+        self.user = User.signup("archivist", "archivist@test.com",
+                                "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.user_id, self.fan_id = self.user.id, self.fan.id
+
+        ensure_partitions(self.conn, ahead=0, upto_id=2 * MESSAGE_PARTITION_SIZE)
+
+        # Old messages in partitions 0 and 1, a new one in partition 2.
+        self.ids = [11, 12, 13, MESSAGE_PARTITION_SIZE + 1,
+                    2 * MESSAGE_PARTITION_SIZE + 1]
+        days = [datetime(2019, 1, 1), datetime(2019, 1, 2),
+                datetime(2019, 1, 3), datetime(2019, 2, 1), datetime.utcnow()]
+        for i, (message_id, day) in enumerate(zip(self.ids, days)):
+            db.session.add(Message(id=message_id, text=f"warble{i} #old",
+                                   user_id=self.user_id, timestamp=day))
+        db.session.flush()
+        db.session.add(Like(user_id=self.fan_id, message_id=11))
+        db.session.add(MessageTag(tag='#old', message_id=11))
+        db.session.commit()
+
+    def get(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+            resp = c.get(url)
+            return resp.status_code, BeautifulSoup(resp.data, 'html.parser')
+
+    def texts(self, soup):
+        return [p.text for p in soup.select("#messages .message-area p")]
+
+    def test_ensure_partitions(self):
+        self.assertEqual(partitions(self.conn), [0, 1, 2])
+        self.assertEqual(ensure_partitions(self.conn, ahead=2), [3, 4])
+        self.assertEqual(ensure_partitions(self.conn, ahead=2), [])
+
+    def test_insert_past_last_partition(self):
+        past = 5 * MESSAGE_PARTITION_SIZE + 1
+        db.session.add(Message(id=past, text="overflow",
+                               user_id=self.user_id))
+        db.session.flush()
+        db.session.add(Like(user_id=self.fan_id, message_id=past))
+        db.session.commit()
+
+        # New ranges start above what the default partition holds.
+        self.assertEqual(ensure_partitions(self.conn, ahead=1), [6])
+        self.assertEqual(partitions(self.conn), [0, 1, 2, 6])
+        self.assertEqual(Message.query.get(past).text, "overflow")
+        self.assertEqual(Like.query.filter_by(message_id=past).count(), 1)
+
+        db.session.add(Message(id=past + MESSAGE_PARTITION_SIZE, text="next",
+                               user_id=self.user_id))
+        db.session.commit()
+        self.assertEqual(self.conn.execute(
+            "SELECT count(*) FROM messages_p6").scalar(), 1)
+
+    def test_archivable(self):
+        # Partition 2 is still filling up.
+        self.assertEqual(archivable_partitions(self.conn, 365), [0, 1])
+        self.assertEqual(archivable_partitions(self.conn, 365 * 100), [])
+
+    def test_archive_partition(self):
+        self.assertEqual(archive_partition(self.conn, 0, self.directory), 3)
+        db.session.expire_all()
+
+        self.assertEqual(partitions(self.conn), [1, 2])
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+
+        [entry] = read_index(self.directory)
+        self.assertEqual((entry['partition'], entry['rows']), (0, 3))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, entry['file'])))
+        self.assertIsInstance(_columns(self.directory, entry)['text'],
+                              np.memmap)
+
+    def test_read_old_npz_archive(self):
+        archive_partition(self.conn, 0, self.directory)
+        [entry] = read_index(self.directory)
+        path = os.path.join(self.directory, entry['file'])
+        np.savez_compressed(path + '.npz', **_columns(self.directory, entry))
+        shutil.rmtree(path)
+        entry['file'] += '.npz'
+        with open(os.path.join(self.directory, 'index.json'), 'w') as f:
+            json.dump([entry], f)
+
+        status, page = self.get("/messages/12")
+        self.assertEqual(status, 200)
+        self.assertEqual(page.select_one(".single-message").text,
+                         "warble1 #old")
+
+    def test_maintain(self):
+        created, archived = maintain(self.conn, self.directory, 365, 1)
+        self.assertEqual(created, [3])
+        self.assertEqual(archived, {0: 3, 1: 1})
+        self.assertEqual(partitions(self.conn), [2, 3])
+
+    def test_show_archived(self):
+        archive_partition(self.conn, 0, self.directory)
+
+        status, page = self.get("/messages/12")
+        self.assertEqual(status, 200)
+        self.assertEqual(page.select_one(".single-message").text,
+                         "warble1 #old")
+        self.assertIsNone(page.find("form", class_="messages-like-bottom"))
+
+        status, _ = self.get("/messages/14")
+        self.assertEqual(status, 404)
+
+    def test_page_into_archive(self):
+        maintain(self.conn, self.directory, 365, 0)
+        app.config['PAGE_SIZE'] = 2
+
+        status, page = self.get(f"/users/{self.user_id}")
+        self.assertEqual(status, 200)
+        self.assertEqual(self.texts(page), ["warble4 #old", "warble3 #old"])
+
+        _, page = self.get(page.find("a", rel="next")["href"])
+        self.assertEqual(self.texts(page), ["warble2 #old", "warble1 #old"])
+        self.assertIsNone(page.find("form", class_="messages-like"))
+
+        _, last = self.get(page.find("a", rel="next")["href"])
+        self.assertEqual(self.texts(last), ["warble0 #old"])
+        self.assertIsNone(last.find("a", rel="next"))
+
+        _, page = self.get(last.find("a", rel="prev")["href"])
+        self.assertEqual(self.texts(page), ["warble2 #old", "warble1 #old"])
+
+    def test_archived_page_loads_users_once(self):
+        maintain(self.conn, self.directory, 365, 0)
+
+        with count_queries() as queries:
+            rows = archived_messages([self.user_id, self.fan_id], None,
+                                     False, 10)
+        self.assertEqual([message.text for message, _, _ in rows],
+                         [f"warble{i} #old" for i in (3, 2, 1, 0)])
+        self.assertEqual(len([q for q in queries if 'FROM users' in q]), 1)
+
+    def test_deleted_user_hidden(self):
+        archive_partition(self.conn, 0, self.directory)
+        User.query.filter_by(id=self.user_id).delete()
+        db.session.commit()
+
+        status, _ = self.get("/messages/12")
+        self.assertEqual(status, 404)
@@ -0,0 +1,116 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+
+from fixtures import app
+import assets
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test building, resolving and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.config = dict(app.config)
+        self.build_dir = tempfile.mkdtemp()
+        app.config['ASSETS_BUILD_DIR'] = self.build_dir
+        self.manifest = assets.build_assets(app.static_folder, self.build_dir)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+    def read_built(self, relpath):
+        with open(os.path.join(self.build_dir, self.manifest[relpath]), 'rb') as f:
+            return f.read()
+
+    def test_build_fingerprints(self):
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertIn('images/warbler-logo.png', self.manifest)
+
+    def test_build_precompresses_text_only(self):
+        css = os.path.join(self.build_dir, self.manifest['stylesheets/style.css'])
+        self.assertTrue(os.path.exists(css + '.gz'))
+        self.assertTrue(os.path.exists(css + '.br'))
+
+        with open(css, 'rb') as f:
+            original = f.read()
+        with open(css + '.br', 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), original)
+        with open(css + '.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), original)
+
+        jpg = os.path.join(self.build_dir,
+                           self.manifest['images/signed-out-home.jpg'])
+        self.assertFalse(os.path.exists(jpg + '.gz'))
+        self.assertFalse(os.path.exists(jpg + '.br'))
+
+    def test_build_rewrites_css_urls(self):
+        css = self.read_built('stylesheets/style.css').decode('utf-8')
+
+        self.assertNotIn('/static/images/signed-out-home.jpg', css)
+        self.assertIn(
+            f"/assets/{self.manifest['images/signed-out-home.jpg']}", css)
+
+    def test_asset_helper(self):
+        with app.test_request_context():
+            self.assertEqual(
+                assets.asset_url('stylesheets/style.css'),
+                f"/assets/{self.manifest['stylesheets/style.css']}")
+
+        shutil.rmtree(self.build_dir)
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/style.css'),
+                             '/static/stylesheets/style.css')
+
+    def test_pages_link_built_assets(self):
+        resp = self.client.get('/login')
+        self.assertIn(self.manifest['stylesheets/style.css'], str(resp.data))
+
+    def test_serve_brotli(self):
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertEqual(brotli.decompress(resp.data),
+                         self.read_built('stylesheets/style.css'))
+        resp.close()
+
+    def test_serve_gzip(self):
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br;q=0'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data),
+                         self.read_built('stylesheets/style.css'))
+        resp.close()
+
+    def test_serve_identity(self):
+        url = f"/assets/{self.manifest['images/warbler-logo.png']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(resp.data, self.read_built('images/warbler-logo.png'))
+        resp.close()
+
+    def test_manifest_not_served(self):
+        self.assertEqual(self.client.get('/assets/manifest.json').status_code, 404)
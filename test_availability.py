@@ -0,0 +1,123 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_availability.py
+
+
+import time
+from unittest import TestCase, mock
+
+from models import db, User
+
+from fixtures import app, DatabaseTestCase, count_queries
+from availability import (AvailabilityIndex, BloomFilter,
+                          get_availability_index)
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter."""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        items = [f"user{i}" for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+
+        self.assertTrue(all(item in bloom for item in items))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(10000, 0.01)
+        for i in range(10000):
+            bloom.add(f"in{i}")
+
+        false_positives = sum(f"out{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    """Test the availability API and the signup checks."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+        get_availability_index().refresh_seconds = 10
+        self.addCleanup(setattr, get_availability_index(),
+                        'refresh_seconds', 10)
+
+        User.signup("taken", "taken@test.com", "password", None)
+        db.session.commit()
+
+    def check(self, **args):
+        resp = self.client.get("/api/availability", query_string=args)
+        return resp.status_code, resp.get_json()
+
+    def test_api(self):
+        status, data = self.check(username="taken", email="free@test.com")
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {
+            'username': {'value': "taken", 'available': False},
+            'email': {'value': "free@test.com", 'available': True}})
+
+        status, data = self.check(email="taken@test.com")
+        self.assertEqual(data, {
+            'email': {'value': "taken@test.com", 'available': False}})
+
+        status, _ = self.check()
+        self.assertEqual(status, 400)
+
+    def test_free_names_skip_the_database(self):
+        self.check(username="warmup")
+
+        with count_queries() as queries:
+            _, data = self.check(username="brand-new")
+        self.assertTrue(data['username']['available'])
+        self.assertFalse([q for q in queries if 'users' in q])
+
+    def test_refresh_picks_up_other_signups(self):
+        self.check(username="warmup")
+        db.session.add(User(username="elsewhere", email="elsewhere@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        # Not refreshed yet.
+        _, data = self.check(username="elsewhere")
+        self.assertTrue(data['username']['available'])
+
+        get_availability_index().refresh_seconds = 0
+        _, data = self.check(username="elsewhere")
+        self.assertFalse(data['username']['available'])
+
+    def test_signup_rejects_before_hashing(self):
+        with mock.patch.object(User, 'signup') as signup:
+            resp = self.client.post("/signup", data={
+                "username": "newbie", "email": "taken@test.com",
+                "password": "password"})
+
+        signup.assert_not_called()
+        page = resp.get_data(as_text=True)
+        self.assertIn("E-mail already registered", page)
+        self.assertNotIn("Username already taken", page)
+
+    def test_signup_updates_filter(self):
+        self.check(username="warmup")
+        self.client.post("/signup", data={
+            "username": "newbie", "email": "newbie@test.com",
+            "password": "password"})
+
+        _, data = self.check(username="newbie")
+        self.assertFalse(data['username']['available'])
+
+    def test_filter_built_in_the_background(self):
+        index = AvailabilityIndex(app, 0.01, refresh_seconds=3600,
+                                  rebuild_seconds=3600)
+
+        # While the thread is held up, every name needs the database.
+        with index._update_lock:
+            self.assertTrue(index.maybe_taken('username', "brand-new"))
+
+        deadline = time.monotonic() + 10
+        while index._filter is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(index.maybe_taken('username', "brand-new"))
@@ -0,0 +1,243 @@
+"""Shared cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_cache.py
+
+
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message
+
+from app import CURR_USER_KEY
+from cache import (Cache, LocalTier, SharedMemoryTier, NetworkTier, MISS,
+                   get_cache)
+from fixtures import app, DatabaseTestCase
+
+
+class StandInMemcached(socketserver.ThreadingTCPServer):
+    """Just enough of a memcached server: get, set, delete, flush_all."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.data = {}
+        super().__init__(('127.0.0.1', 0), MemcachedHandler)
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server_address
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        data = self.server.data
+        for line in self.rfile:
+            cmd, *args = line.split()
+            if cmd == b"get":
+                if args[0] in data:
+                    value = data[args[0]]
+                    self.wfile.write(b"VALUE %s 0 %d\r\n%s\r\n"
+                                     % (args[0], len(value), value))
+                self.wfile.write(b"END\r\n")
+            elif cmd == b"set":
+                value = self.rfile.read(int(args[3]) + 2)[:-2]
+                data[args[0]] = value
+                self.wfile.write(b"STORED\r\n")
+            elif cmd == b"delete":
+                found = data.pop(args[0], None) is not None
+                self.wfile.write(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+            elif cmd == b"flush_all":
+                data.clear()
+                self.wfile.write(b"OK\r\n")
+
+
+class CacheTierTestCase(TestCase):
+    """Test each tier on its own."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.mmap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_local_lru(self):
+        tier = LocalTier(max_items=2)
+        tier.set('a', 1, 60)
+        tier.set('b', 2, 60)
+        tier.get('a')
+        tier.set('c', 3, 60)
+
+        self.assertEqual(tier.get('a'), 1)
+        self.assertIs(tier.get('b'), MISS)
+        self.assertEqual(tier.evictions, 1)
+
+    def test_local_ttl_capped(self):
+        tier = LocalTier(max_ttl=0.05)
+        tier.set('a', 1, 60)
+        time.sleep(0.1)
+        self.assertIs(tier.get('a'), MISS)
+
+    def test_shared_between_processes(self):
+        tier = SharedMemoryTier(self.path, slots=64, slot_size=256)
+
+        child = os.fork()
+        if child == 0:
+            try:
+                SharedMemoryTier(self.path, slots=64, slot_size=256).set(
+                    'greeting', {'from': 'child'}, 60)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+
+        self.assertEqual(tier.get('greeting'), {'from': 'child'})
+
+    def test_shared_evicts_least_recently_used(self):
+        # One bucket of four slots.
+        tier = SharedMemoryTier(self.path, slots=4, slot_size=256)
+        for key in 'abcd':
+            tier.set(key, key, 60)
+        tier.get('a')
+        tier.set('e', 'e', 60)
+
+        self.assertEqual(tier.get('a'), 'a')
+        self.assertIs(tier.get('b'), MISS)
+        self.assertEqual(tier.evictions, 1)
+
+    def test_shared_expiry_and_size_limit(self):
+        tier = SharedMemoryTier(self.path, slots=16, slot_size=256)
+        tier.set('short', 1, 0.05)
+        tier.set('big', 'x' * 1000, 60)
+        time.sleep(0.1)
+
+        self.assertIs(tier.get('short'), MISS)
+        self.assertIs(tier.get('big'), MISS)
+
+    def test_shared_resized_file_starts_afresh(self):
+        SharedMemoryTier(self.path, slots=16, slot_size=256).set('a', 1, 60)
+
+        tier = SharedMemoryTier(self.path, slots=32, slot_size=256)
+        self.assertIs(tier.get('a'), MISS)
+
+    def test_network(self):
+        server = StandInMemcached()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        tier = NetworkTier(server.address)
+        tier.set('a key with spaces', [1, 2], 60)
+        self.assertEqual(tier.get('a key with spaces'), [1, 2])
+
+        tier.delete('a key with spaces')
+        self.assertIs(tier.get('a key with spaces'), MISS)
+
+
+class CacheTestCase(TestCase):
+    """Test tiered lookups, TTLs and tag invalidation."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.mmap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def worker_cache(self):
+        """A cache as one gunicorn worker would have it."""
+
+        return Cache([LocalTier(), SharedMemoryTier(self.path, slots=64)])
+
+    def test_get_or_set(self):
+        cache = self.worker_cache()
+        calls = []
+
+        def make():
+            calls.append(1)
+            return [1, 2, 3]
+
+        self.assertEqual(cache.get_or_set('ids', make), [1, 2, 3])
+        self.assertEqual(cache.get_or_set('ids', make), [1, 2, 3])
+        self.assertEqual(len(calls), 1)
+
+    def test_invalidated_while_making_value(self):
+        cache = self.worker_cache()
+
+        def make():
+            # Another request follows someone after this read its data.
+            cache.invalidate('follows:1')
+            return 'stale'
+
+        self.assertEqual(cache.get_or_set('feed:1', make,
+                                          tags=['follows:1']), 'stale')
+        self.assertIsNone(cache.get('feed:1'))
+
+    def test_shared_hit_fills_local(self):
+        one, two = self.worker_cache(), self.worker_cache()
+        one.set('k', 'v')
+
+        self.assertEqual(two.get('k'), 'v')
+        self.assertEqual(two.get('k'), 'v')
+        self.assertEqual(two.stats(), {
+            'local': {'hits': 1, 'misses': 1, 'evictions': 0},
+            'shared': {'hits': 1, 'misses': 0, 'evictions': 0},
+        })
+
+    def test_tag_invalidation_reaches_other_workers(self):
+        one, two = self.worker_cache(), self.worker_cache()
+        one.set('feed:1', 'old', tags=['follows:1'])
+        self.assertEqual(two.get('feed:1'), 'old')
+
+        # Both workers now hold it locally; one invalidation clears both.
+        one.invalidate('follows:1')
+        self.assertIsNone(one.get('feed:1'))
+        self.assertIsNone(two.get('feed:1'))
+
+    def test_failed_tier_is_a_miss(self):
+        cache = Cache([LocalTier(), NetworkTier("127.0.0.1:1")])
+        cache.set('k', 'v', tags=['t'])
+
+        cache.tiers[0].clear()
+        self.assertEqual(cache.get('k', 'default'), 'default')
+
+
+class CachedViewsTestCase(DatabaseTestCase):
+    """Test the cached lookups in the views."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Message(text="from u2", user_id=self.u2.id))
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+    def test_follow_invalidates_home_feed(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertNotIn("from u2", str(c.get("/").data))
+            self.assertEqual(get_cache().get(f"following-ids:{self.u1_id}"),
+                             [])
+
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertIn("from u2", str(c.get("/").data))
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertNotIn("from u2", str(c.get("/").data))
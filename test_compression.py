@@ -0,0 +1,108 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_compression.py
+
+
+import gzip
+import zlib
+from unittest import TestCase
+
+import brotli
+from flask import Flask, Response
+
+from fixtures import app
+from compression import Compress
+
+
+def make_toy_app():
+    """A bare app with routes for the edge cases Warbler doesn't have."""
+
+    toy = Flask(__name__)
+
+    @toy.route('/small')
+    def small():
+        return "tiny"
+
+    @toy.route('/png')
+    def png():
+        return Response(b"\x89PNG" + b"\x00" * 2000, mimetype='image/png')
+
+    @toy.route('/stream')
+    def stream():
+        def rows():
+            for i in range(3):
+                yield f"<p>row {i}</p>" * 100
+        return Response(rows(), mimetype='text/html')
+
+    toy.wsgi_app = Compress(toy.wsgi_app)
+    return toy
+
+
+class CompressionTestCase(TestCase):
+    """Test Accept-Encoding negotiation and streamed compression."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.toy = make_toy_app().test_client()
+
+    def test_gzip_page(self):
+        resp = self.client.get('/login', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertIn(b"Welcome back.", gzip.decompress(resp.data))
+
+    def test_brotli_preferred(self):
+        resp = self.client.get('/login',
+                               headers={'Accept-Encoding': 'gzip, deflate, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertIn(b"Welcome back.", brotli.decompress(resp.data))
+
+    def test_quality_values(self):
+        resp = self.client.get('/login',
+                               headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        resp = self.client.get('/login',
+                               headers={'Accept-Encoding': 'br;q=0, gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_no_accept_encoding(self):
+        resp = self.client.get('/login')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b"Welcome back.", resp.data)
+
+    def test_skips_small_responses(self):
+        resp = self.toy.get('/small', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b"tiny")
+
+    def test_skips_compressed_types(self):
+        resp = self.toy.get('/png', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertTrue(resp.data.startswith(b"\x89PNG"))
+
+    def test_streams_chunk_by_chunk(self):
+        resp = self.toy.get('/stream', headers={'Accept-Encoding': 'gzip'},
+                            buffered=False)
+        chunks = list(resp.response)
+        resp.close()
+
+        # One flushed chunk per row plus the gzip trailer.
+        self.assertEqual(len(chunks), 4)
+
+        # Each flushed prefix decodes on its own, so the client can render
+        # rows as they arrive.
+        partial = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(chunks[0])
+        self.assertEqual(partial, b"<p>row 0</p>" * 100)
+
+        self.assertEqual(gzip.decompress(b"".join(chunks)),
+                         b"".join(f"<p>row {i}</p>".encode() * 100
+                                  for i in range(3)))
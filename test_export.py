@@ -0,0 +1,99 @@
+"""User data export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+
+import gzip
+import json
+from datetime import datetime
+
+from models import db, User, Message, Follows, Like
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from export import export_chunks, export_records
+
+
+class ExportTestCase(DatabaseTestCase):
+    """Test exporting a user's data."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("exporter", "exporter@test.com",
+                                "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, self.other.id
+
+        for i in range(3):
+            db.session.add(Message(text=f"mine{i}", user_id=self.user_id,
+                                   timestamp=datetime(2020, 1, i + 1)))
+        theirs = Message(text="theirs", user_id=self.other_id)
+        db.session.add(theirs)
+        db.session.flush()
+        self.theirs_id = theirs.id
+        db.session.add(Like(user_id=self.user_id, message_id=theirs.id))
+        db.session.add(Follows(user_following_id=self.user_id,
+                               user_being_followed_id=self.other_id))
+        db.session.add(Follows(user_following_id=self.other_id,
+                               user_being_followed_id=self.user_id))
+        db.session.commit()
+
+    def test_records(self):
+        app.config['EXPORT_BATCH'] = 2
+        self.addCleanup(app.config.update, EXPORT_BATCH=10000)
+
+        records = list(export_records(self.user_id))
+        self.assertEqual([r['type'] for r in records],
+                         ['profile', 'message', 'message', 'message', 'like',
+                          'following', 'follower'])
+        self.assertEqual(records[0]['username'], "exporter")
+        self.assertEqual(records[1]['text'], "mine0")
+        self.assertEqual(records[1]['timestamp'], "2020-01-01T00:00:00")
+        self.assertEqual(records[4], {'type': 'like',
+                                      'message_id': self.theirs_id})
+        self.assertEqual(records[5], {'type': 'following',
+                                      'user_id': self.other_id})
+
+        self.assertEqual(list(export_records(0)), [])
+
+    def test_chunks(self):
+        app.config['EXPORT_CHUNK_SIZE'] = 100
+        self.addCleanup(app.config.update, EXPORT_CHUNK_SIZE=64 * 1024)
+
+        chunks = list(export_chunks(self.user_id))
+        self.assertGreater(len(chunks), 1)
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         list(export_records(self.user_id)))
+
+        compressed = b''.join(export_chunks(self.user_id, compress=True))
+        self.assertEqual(gzip.decompress(compressed), b''.join(chunks))
+
+    def test_endpoint(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(f"/users/{self.user_id}/export")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn('filename="warbler-exporter.ndjson"',
+                      resp.headers['Content-Disposition'])
+        self.assertEqual(len(resp.get_data().splitlines()), 7)
+
+        resp = self.client.get(f"/users/{self.user_id}/export?gzip=1")
+        self.assertEqual(resp.mimetype, "application/gzip")
+        self.assertEqual(len(gzip.decompress(resp.get_data()).splitlines()),
+                         7)
+
+    def test_endpoint_only_own_data(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.other_id
+
+        resp = self.client.get(f"/users/{self.user_id}/export")
+        self.assertEqual(resp.status_code, 302)
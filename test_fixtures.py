@@ -0,0 +1,44 @@
+"""Test database fixture tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_fixtures.py
+
+
+from models import db, User
+
+from fixtures import DatabaseTestCase
+
+
+class DatabaseFixtureTestCase(DatabaseTestCase):
+    """Test that tests are isolated without recreating tables."""
+
+    def add_user(self, username):
+        user = User(username=username, email=f"{username}@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_commit_stays_in_test(self):
+        self.add_user("committed")
+        self.assertEqual(User.query.count(), 1)
+
+        # Other connections never see the test's writes.
+        with db.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute("SELECT count(*) FROM users").scalar(), 0)
+
+    def test_rollback_keeps_earlier_commits(self):
+        self.add_user("kept")
+
+        db.session.add(User(username="dropped", email="dropped@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual([u.username for u in User.query.all()], ["kept"])
+
+        # The session is usable again after the rollback.
+        self.add_user("after")
+        self.assertEqual(User.query.count(), 2)
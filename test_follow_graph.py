@@ -0,0 +1,162 @@
+"""Follow graph snapshot tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_follow_graph.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from follow_graph import (Adjacency, DatabaseGraph, _apply, _edge_keys,
+                          follow_graph, load_graph, refresh_graph)
+
+
+def keys(*pairs):
+    src = np.array([a for a, _ in pairs], dtype=np.int64)
+    dst = np.array([b for _, b in pairs], dtype=np.int64)
+    return np.sort(_edge_keys(np, src, dst))
+
+
+class AdjacencyTestCase(TestCase):
+    """Test the CSR arrays and merging changes into them."""
+
+    def test_lookup(self):
+        adjacency = Adjacency.from_keys(keys((1, 3), (1, 2), (5, 1)))
+
+        self.assertEqual(adjacency[1].tolist(), [2, 3])
+        self.assertEqual(adjacency[5].tolist(), [1])
+        self.assertEqual(adjacency[4].tolist(), [])
+        self.assertEqual(adjacency[99].tolist(), [])
+        self.assertEqual(adjacency.keys().tolist(),
+                         keys((1, 2), (1, 3), (5, 1)).tolist())
+
+    def test_apply(self):
+        merged = _apply(np, keys((1, 2), (1, 3), (5, 1)),
+                        added=keys((1, 2), (2, 1), (9, 9)),
+                        removed=keys((1, 3), (7, 7)))
+
+        self.assertEqual(merged.tolist(),
+                         keys((1, 2), (2, 1), (5, 1), (9, 9)).tolist())
+
+
+class FollowGraphTestCase(DatabaseTestCase):
+    """Test snapshots, the change log and the profile badges."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.config = dict(app.config)
+        self.addCleanup(app.config.update, self.config)
+        app.config['FOLLOW_GRAPH_DIR'] = self.dir
+
+        users = [User(username=f"user{i}", email=f"u{i}@test.com",
+                      password="HASHED_PASSWORD") for i in range(4)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.ids = [u.id for u in users]
+
+        self.follow(0, 1)
+        self.follow(1, 0)
+        self.follow(1, 2)
+        self.follow(2, 0)
+
+    def follow(self, a, b):
+        db.session.add(Follows(user_following_id=self.ids[a],
+                               user_being_followed_id=self.ids[b]))
+        db.session.commit()
+
+    def unfollow(self, a, b):
+        Follows.query.filter_by(user_following_id=self.ids[a],
+                                user_being_followed_id=self.ids[b]).delete()
+        db.session.commit()
+
+    def refresh(self, **kwargs):
+        return refresh_graph([db.session.connection()], self.dir, **kwargs)
+
+    def assertSameGraph(self, graph, expected):
+        for user_id in self.ids:
+            self.assertEqual(graph.following(user_id).tolist(),
+                             expected.following(user_id).tolist())
+            self.assertEqual(graph.followers(user_id).tolist(),
+                             expected.followers(user_id).tolist())
+
+    def test_snapshot_queries(self):
+        self.refresh()
+        graph = load_graph()
+        a, b, c, d = self.ids
+
+        self.assertSameGraph(graph, DatabaseGraph())
+        self.assertTrue(graph.follows(b, a))
+        self.assertFalse(graph.follows(a, c))
+        self.assertEqual(graph.mutuals(a).tolist(), [b])
+        self.assertEqual(graph.followers_you_know(b, a).tolist(), [c])
+
+    def test_arrays_are_memory_mapped(self):
+        snapshot = self.refresh()
+        graph = load_graph()
+
+        self.assertIsInstance(graph.snapshot.following.neighbors, np.memmap)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['CURRENT', snapshot.version])
+
+    def test_changes_since_snapshot_are_overlaid(self):
+        self.refresh()
+        self.follow(0, 3)
+        self.unfollow(1, 0)
+
+        self.assertSameGraph(load_graph(), DatabaseGraph())
+
+    def test_incremental_refresh_matches_full(self):
+        first = self.refresh()
+        self.follow(3, 0)
+        self.unfollow(1, 2)
+        self.follow(1, 2)
+        self.unfollow(0, 1)
+        second = self.refresh()
+
+        self.assertSameGraph(load_graph(), DatabaseGraph())
+        self.assertEqual(second.following.keys().tolist(),
+                         self.refresh(full=True).following.keys().tolist())
+
+        # Two versions are kept: workers may still be reading the older.
+        self.assertNotIn(first.version, os.listdir(self.dir))
+        self.assertIn(second.version, os.listdir(self.dir))
+
+    def test_no_snapshot_reads_the_table(self):
+        self.assertIsInstance(load_graph(), DatabaseGraph)
+
+        app.config['FOLLOW_GRAPH_MAX_OVERLAY'] = 1
+        self.refresh()
+        self.follow(0, 3)
+        self.follow(3, 0)
+        self.assertIsInstance(load_graph(), DatabaseGraph)
+
+    def test_profile_badges(self):
+        self.refresh()
+        a, b, c, d = self.ids
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = b
+
+            page = client.get(f"/users/{a}").get_data(as_text=True)
+            self.assertIn("Follows you", page)
+            self.assertIn("Followed by 1 person you follow", page)
+            self.assertIn(f'action="/users/stop-following/{a}"', page)
+
+            # Seen straight away, before the next refresh.
+            client.post(f"/users/stop-following/{a}")
+            page = client.get(f"/users/{a}").get_data(as_text=True)
+            self.assertIn(f'action="/users/follow/{a}"', page)
+            self.assertNotIsInstance(follow_graph(), DatabaseGraph)
@@ -0,0 +1,253 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_images.py
+
+
+import http.server
+import io
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from fixtures import app
+import images
+
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    """Redirects /to/<url> to <url>; serves the default avatar otherwise."""
+
+    def do_GET(self):
+        if self.path.startswith('/to/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/to/'):])
+            self.end_headers()
+            return
+        path = os.path.join(app.static_folder, 'images', 'default-pic.png')
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test resizing, caching and serving of proxied images."""
+
+    def setUp(self):
+        self.config = dict(app.config)
+        self.cache_dir = tempfile.mkdtemp()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.cache_dir)
+
+    def proxied_url(self, source, variant):
+        with app.test_request_context():
+            return images.img_url(source, variant)
+
+    def test_img_filter(self):
+        url = self.proxied_url("/static/images/default-pic.png", "avatar")
+        key = images.image_key("/static/images/default-pic.png")
+
+        self.assertEqual(url, f"/img/avatar/{key}")
+        self.assertTrue(
+            os.path.exists(os.path.join(self.cache_dir, 'sources', key)))
+
+    def test_missing_image_uses_default(self):
+        self.assertEqual(self.proxied_url(None, "avatar"),
+                         self.proxied_url(images.DEFAULT_IMAGE, "avatar"))
+
+    def test_resize_avatar(self):
+        url = self.proxied_url("/static/images/warbler-hero.jpg", "avatar")
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+        self.assertNotIn("no-store", resp.headers['Cache-Control'])
+
+        image = Image.open(io.BytesIO(resp.data))
+        self.assertEqual(image.size, (48, 48))
+
+    def test_hero_keeps_aspect_ratio(self):
+        url = self.proxied_url("/static/images/warbler-hero.jpg", "hero")
+
+        resp = self.client.get(url)
+        image = Image.open(io.BytesIO(resp.data))
+
+        original = Image.open(
+            os.path.join(app.static_folder, "images", "warbler-hero.jpg"))
+        self.assertLessEqual(image.size[0], 1600)
+        self.assertAlmostEqual(image.size[0] / image.size[1],
+                               original.size[0] / original.size[1],
+                               places=1)
+
+    def test_cached_variant_served_from_disk(self):
+        url = self.proxied_url("/static/images/default-pic.png", "avatar")
+        first = self.client.get(url)
+
+        # With the source gone, only the cache can answer.
+        key = url.rsplit('/', 1)[1]
+        with open(os.path.join(self.cache_dir, 'sources', key), 'wb') as f:
+            f.write(b"/static/images/does-not-exist.png")
+
+        second = self.client.get(url)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.data, second.data)
+
+    def test_conditional_request(self):
+        url = self.proxied_url("/static/images/default-pic.png", "avatar")
+        etag = self.client.get(url).headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_unknown_key(self):
+        resp = self.client.get(f"/img/avatar/{'0' * 32}")
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(f"/img/huge/{'0' * 32}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_eviction(self):
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 1
+
+        for variant in ('avatar', 'profile', 'card'):
+            url = self.proxied_url("/static/images/warbler-hero.jpg", variant)
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        blobs = [name for _root, _dirs, files
+                 in os.walk(os.path.join(self.cache_dir, 'blobs'))
+                 for name in files]
+        self.assertEqual(blobs, [])
+
+        # An evicted variant is simply rendered again.
+        url = self.proxied_url("/static/images/warbler-hero.jpg", "avatar")
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_eviction_walks_only_past_the_limit(self):
+        url = self.proxied_url("/static/images/warbler-hero.jpg", "avatar")
+        self.client.get(url)
+
+        with mock.patch.object(images.os, 'walk', wraps=os.walk) as walk:
+            for variant in ('profile', 'card'):
+                url = self.proxied_url("/static/images/warbler-hero.jpg",
+                                       variant)
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(walk.call_count, 0)
+
+            app.config['IMAGE_CACHE_MAX_BYTES'] = 1
+            url = self.proxied_url("/static/images/warbler-hero.jpg", "hero")
+            self.assertEqual(self.client.get(url).status_code, 200)
+            # Once each for blobs and sources.
+            self.assertEqual(walk.call_count, 2)
+
+    def test_unreadable_source_renders_default(self):
+        default = self.client.get(
+            self.proxied_url(images.DEFAULT_IMAGE, "avatar")).data
+
+        for name, data in (("not-an-image.png", b"<html>hello</html>"),
+                           ("huge.png", self.huge_png())):
+            source = os.path.join(app.static_folder, "images", name)
+            with open(source, 'wb') as f:
+                f.write(data)
+            self.addCleanup(os.unlink, source)
+
+            resp = self.client.get(
+                self.proxied_url(f"/static/images/{name}", "avatar"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, default)
+
+    def huge_png(self):
+        """A PNG whose header claims more pixels than is allowed."""
+
+        out = io.BytesIO()
+        Image.new('L', (1, 1)).save(out, 'PNG')
+        app.config['IMAGE_MAX_SOURCE_PIXELS'] = 1000 * 1000
+        data = bytearray(out.getvalue())
+        # IHDR's width and height follow the 8-byte signature and the
+        # chunk's length and type; its CRC follows its 13 bytes of data.
+        data[16:24] = (5000).to_bytes(4, 'big') * 2
+        data[29:33] = zlib.crc32(data[12:29]).to_bytes(4, 'big')
+        return bytes(data)
+
+    def test_unreachable_source_serves_default(self):
+        default = self.client.get(
+            self.proxied_url(images.DEFAULT_IMAGE, "avatar")).data
+
+        url = self.proxied_url("http://127.0.0.1/a.png", "avatar")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, default)
+        self.assertEqual(resp.headers['Cache-Control'],
+                         f"public, max-age={images.RETRY_SECONDS}")
+
+        # Tried again next time, not cached as the default.
+        with mock.patch.object(images, 'fetch_source',
+                               wraps=images.fetch_source) as fetch:
+            self.client.get(url)
+        self.assertIn(mock.call("http://127.0.0.1/a.png"),
+                      fetch.call_args_list)
+
+    def test_eviction_takes_old_sources(self):
+        self.proxied_url("/static/images/warbler-hero.jpg", "avatar")
+        old = os.path.join(self.cache_dir, 'sources',
+                           images.image_key("/static/images/warbler-hero.jpg"))
+        an_hour_ago = os.stat(old).st_mtime - 3600
+        os.utime(old, (an_hour_ago, an_hour_ago))
+
+        app.config['IMAGE_CACHE_MAX_BYTES'] = 1
+        url = self.proxied_url(images.DEFAULT_IMAGE, "avatar")
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # The old source is gone; the one just registered is kept.
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'sources')),
+                         [images.image_key(images.DEFAULT_IMAGE)])
+
+    def test_private_sources_are_not_fetched(self):
+        for url in ("http://127.0.0.1/a.png", "http://localhost/a.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.1.2.3/a.png", "http://[::1]/a.png",
+                    "http://[::ffff:127.0.0.1]/a.png", "file:///etc/passwd"):
+            with app.app_context(), self.assertRaises(ValueError):
+                images.fetch_source(url)
+
+    def test_redirects_are_checked(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 RedirectHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f"http://warbler.test:{server.server_port}"
+
+        # Stands in for a public host: the test server is on loopback.
+        resolve = images._resolve
+
+        def public(host, port):
+            return '127.0.0.1' if host == 'warbler.test' else resolve(host,
+                                                                      port)
+
+        with app.app_context(), mock.patch.object(images, '_resolve', public):
+            self.assertTrue(images.fetch_source(f"{base}/to/{base}/a.png"))
+            with self.assertRaises(ValueError):
+                images.fetch_source(f"{base}/to/http://127.0.0.1:1/a.png")
+
+            app.config['IMAGE_MAX_REDIRECTS'] = 1
+            with self.assertRaises(ValueError):
+                images.fetch_source(f"{base}/to/{base}/to/{base}/a.png")
@@ -0,0 +1,138 @@
+"""Write-behind like count tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_counts.py
+
+
+import threading
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, User, Message, Like
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase, count_queries
+from like_counts import (FlushTimer, LikeCounter, flush, get_like_counter,
+                         reconcile, write_deltas)
+
+
+class LikeCounterTestCase(TestCase):
+    """Test buffering like count changes."""
+
+    def test_add_and_take(self):
+        counter = LikeCounter()
+        counter.add(1, 1)
+        counter.add(1, 1)
+        counter.add(2, 1)
+        counter.add(2, -1)
+
+        self.assertEqual(counter.pending(1), 2)
+        self.assertTrue(counter.due(0))
+        self.assertFalse(counter.due(60))
+
+        # Changes that cancel out aren't written.
+        self.assertEqual(counter.take(), {1: 2})
+        self.assertEqual(counter.pending(1), 0)
+        self.assertFalse(counter.due(0))
+
+        counter.restore({1: 2})
+        counter.add(1, 1)
+        self.assertEqual(counter.take(), {1: 3})
+
+
+class FlushTimerTestCase(TestCase):
+    """Test flushing from a background thread."""
+
+    def test_flushes_without_requests(self):
+        timer_app = Flask(__name__)
+        timer_app.config['FLUSH_SECONDS'] = 0
+        flushed = threading.Event()
+        timer = FlushTimer(timer_app, flushed.set, 'FLUSH_SECONDS',
+                           'test-flush')
+
+        timer.start()
+        timer.start()
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual([t.name for t in threading.enumerate()].count(
+            'test-flush'), 1)
+
+
+class LikeCountsTestCase(DatabaseTestCase):
+    """Test like counts on messages."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fans = [User.signup(f"fan{i}", f"fan{i}@test.com", "password",
+                                 None) for i in range(3)]
+        db.session.flush()
+        self.messages = [Message(text=f"warble{i}", user_id=self.author.id)
+                         for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.fan_ids = [fan.id for fan in self.fans]
+        self.message_ids = [msg.id for msg in self.messages]
+
+    def stored_counts(self):
+        db.session.expire_all()
+        return [db.session.query(Message.like_count)
+                .filter(Message.id == message_id).scalar()
+                for message_id in self.message_ids]
+
+    def like(self, fan_id, message_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fan_id
+        return self.client.post(f"/messages/{message_id}/like")
+
+    def test_write_deltas_in_batches(self):
+        a, b, c = self.message_ids
+        with count_queries() as queries:
+            write_deltas(db.session.connection(), {a: 5, b: -1, c: 2}, 2)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(self.stored_counts(), [5, -1, 2])
+
+    def test_likes_are_written_behind(self):
+        message_id = self.message_ids[0]
+        for fan_id in self.fan_ids:
+            self.like(fan_id, message_id)
+
+        # Not flushed yet, but this worker shows them.
+        self.assertEqual(self.stored_counts()[0], 0)
+        self.assertEqual(get_like_counter().pending(message_id), 3)
+        page = self.client.get(f"/messages/{message_id}")
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 3</span>',
+                      page.get_data(as_text=True))
+
+        self.assertEqual(flush(db.session.connection()), 1)
+        self.assertEqual(self.stored_counts()[0], 3)
+
+        # Unliking.
+        self.like(self.fan_ids[0], message_id)
+        flush(db.session.connection())
+        self.assertEqual(self.stored_counts()[0], 2)
+
+    def test_flush_when_due(self):
+        app.config['LIKE_COUNT_FLUSH_SECONDS'] = 0
+        self.addCleanup(app.config.update, LIKE_COUNT_FLUSH_SECONDS=1.0)
+
+        self.like(self.fan_ids[0], self.message_ids[1])
+        self.assertEqual(self.stored_counts(), [0, 1, 0])
+        self.assertEqual(get_like_counter().pending(self.message_ids[1]), 0)
+
+    def test_reconcile(self):
+        a, b, c = self.message_ids
+        db.session.add_all([Like(user_id=self.fan_ids[0], message_id=a),
+                            Like(user_id=self.fan_ids[1], message_id=a)])
+        db.session.commit()
+        write_deltas(db.session.connection(), {b: 4}, 10)
+
+        self.assertEqual(reconcile(db.session.connection(), 2), 2)
+        self.assertEqual(self.stored_counts(), [2, 0, 0])
+        self.assertEqual(reconcile(db.session.connection(), 2), 0)
@@ -5,26 +5,19 @@
 #    python -m unittest test_message_model.py
 
 
-import os
-from unittest import TestCase
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows, Like
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from fixtures import app, DatabaseTestCase
 
-from app import app
 
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.uid = 94566
         u = User.signup("testing", "testing@test.com", "password", None)
@@ -35,11 +28,6 @@ class UserModelTestCase(TestCase):
 
         self.client = app.test_client()
 
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-
     def test_message_model(self):
         """Does basic model work?"""
         
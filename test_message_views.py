@@ -5,30 +5,20 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+from models import db, connect_db, Message, User, Follows, Like, MessageTag
 
-from models import db, connect_db, Message, User
+from app import CURR_USER_KEY
+from cache import get_cache
+from fixtures import app, count_queries, DatabaseTestCase
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
-
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-db.create_all()
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -121,6 +111,26 @@ class MessageViewTestCase(TestCase):
             m = Message.query.get(1234)
             self.assertIsNone(m)
 
+    def test_message_author_is_cached_until_delete(self):
+        db.session.add(Message(id=1234, text="a test message",
+                               user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/messages/1234')
+            with count_queries() as queries:
+                resp = c.get('/messages/1234')
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse([q for q in queries
+                              if q.startswith('SELECT messages.user_id')])
+
+            c.post("/messages/1234/delete")
+            resp = c.get('/messages/1234')
+            self.assertEqual(resp.status_code, 404)
+
     def test_unauthorized_message_delete(self):
 
         # A second user that will try to delete the message
@@ -167,3 +177,71 @@ class MessageViewTestCase(TestCase):
 
             m = Message.query.get(1234)
             self.assertIsNotNone(m)
+
+
+class MessageListQueriesTestCase(DatabaseTestCase):
+    """Test that message lists don't query once per message or author."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.viewer = User(username="viewer", email="viewer@test.com",
+                           password="HASHED_PASSWORD")
+        db.session.add(self.viewer)
+        db.session.commit()
+        self.viewer_id = self.viewer.id
+        self.authors = 0
+
+    def add_authors(self, count):
+        """Add `count` followed authors with a tagged, liked message each."""
+
+        for _ in range(count):
+            self.authors += 1
+            author = User(username=f"author{self.authors}",
+                          email=f"author{self.authors}@test.com",
+                          password="HASHED_PASSWORD")
+            author.messages.append(Message(text="hi #all"))
+            db.session.add(author)
+            db.session.flush()
+
+            msg = author.messages[0]
+            db.session.add_all([
+                Follows(user_following_id=self.viewer_id,
+                        user_being_followed_id=author.id),
+                Like(user_id=self.viewer_id, message_id=msg.id),
+                MessageTag(tag="#all", message_id=msg.id),
+            ])
+        db.session.commit()
+        db.session.expunge_all()
+        get_cache().clear()
+
+    def queries_for(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            # Streamed pages query as they're read.
+            with count_queries() as queries:
+                resp = c.get(url)
+                page = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(page.count("@author"), self.authors)
+            db.session.expunge_all()
+            return len(queries)
+
+    def assertQueriesIndependentOfPageSize(self, url):
+        self.add_authors(2)
+        few = self.queries_for(url)
+        self.add_authors(8)
+        self.assertEqual(self.queries_for(url), few)
+
+    def test_home(self):
+        self.assertQueriesIndependentOfPageSize("/")
+
+    def test_likes(self):
+        self.assertQueriesIndependentOfPageSize(f"/users/{self.viewer_id}/likes")
+
+    def test_tag_feed(self):
+        self.assertQueriesIndependentOfPageSize("/tags/all")
@@ -0,0 +1,224 @@
+"""Grouped notification tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_notifications.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase, count_queries
+from notifications import (EXACT_ACTORS, FOLLOW, LIKE, NotificationBuffer,
+                           flush_notifications, notify)
+
+
+class NotificationBufferTestCase(TestCase):
+    """Test grouping events in memory."""
+
+    def test_groups(self):
+        buffer = NotificationBuffer()
+        early, late = datetime(2020, 1, 1, 1), datetime(2020, 1, 1, 2)
+        buffer.add((1, LIKE, 7, 0), 10, early)
+        buffer.add((1, LIKE, 7, 0), 11, late)
+        buffer.add((1, LIKE, 7, 0), 10, early)
+        buffer.add((1, FOLLOW, 1, 0), 12, early)
+
+        self.assertTrue(buffer.due(0))
+        groups = buffer.take()
+        self.assertEqual(groups, {(1, LIKE, 7, 0): ({10, 11}, 11, late),
+                                  (1, FOLLOW, 1, 0): ({12}, 12, early)})
+        self.assertFalse(buffer.due(0))
+
+        # A restored group keeps its latest actor.
+        buffer.add((1, LIKE, 7, 0), 13, early)
+        buffer.restore(groups)
+        self.assertEqual(buffer.take()[(1, LIKE, 7, 0)],
+                         ({10, 11, 13}, 11, late))
+
+
+class NotificationsTestCase(DatabaseTestCase):
+    """Test notifications of likes and follows."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fans = [User.signup(f"fan{i}", f"fan{i}@test.com", "password",
+                                 None) for i in range(3)]
+        db.session.flush()
+        self.message = Message(text="warble", user_id=self.author.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.fan_ids = [fan.id for fan in self.fans]
+        self.message_id = self.message.id
+
+    def as_user(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def unread(self):
+        db.session.expire_all()
+        return User.query.get(self.author_id).unread_notifications
+
+    def groups(self):
+        return [(n.kind, n.subject_id, n.actor_count, n.last_actor_id)
+                for n in Notification.query.order_by(Notification.id)]
+
+    def test_likes_are_grouped(self):
+        for fan_id in self.fan_ids:
+            self.as_user(fan_id)
+            self.client.post(f"/messages/{self.message_id}/like")
+
+        with count_queries() as queries:
+            self.assertEqual(flush_notifications(db.session.connection()), 1)
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(self.groups(),
+                         [(LIKE, self.message_id, 3, self.fan_ids[2])])
+        self.assertEqual(self.unread(), 1)
+
+    def test_unlike_doesnt_notify(self):
+        self.as_user(self.fan_ids[0])
+        self.client.post(f"/messages/{self.message_id}/like")
+        self.client.post(f"/messages/{self.message_id}/like")
+
+        flush_notifications(db.session.connection())
+        self.assertEqual(self.groups(),
+                         [(LIKE, self.message_id, 1, self.fan_ids[0])])
+
+    def test_actors_are_counted_once(self):
+        self.as_user(self.fan_ids[0])
+        for _ in range(3):
+            self.client.post(f"/messages/{self.message_id}/like")
+            flush_notifications(db.session.connection())
+        self.client.post(f"/users/follow/{self.author_id}")
+        self.client.post(f"/users/follow/{self.author_id}")
+        flush_notifications(db.session.connection())
+        self.client.post(f"/users/stop-following/{self.author_id}")
+        self.client.post(f"/users/follow/{self.author_id}")
+        flush_notifications(db.session.connection())
+
+        self.assertEqual(self.groups(),
+                         [(LIKE, self.message_id, 1, self.fan_ids[0]),
+                          (FOLLOW, self.author_id, 1, self.fan_ids[0])])
+        self.assertEqual(self.unread(), 2)
+
+    def test_follows(self):
+        for fan_id in self.fan_ids[:2]:
+            self.as_user(fan_id)
+            self.client.post(f"/users/follow/{self.author_id}")
+
+        flush_notifications(db.session.connection())
+        self.assertEqual(self.groups(),
+                         [(FOLLOW, self.author_id, 2, self.fan_ids[1])])
+
+    def test_notify_starts_flush_thread(self):
+        started = []
+
+        class Timer:
+            def start(self):
+                started.append(True)
+
+        app.extensions['notification_timer'] = Timer()
+        self.addCleanup(app.extensions.pop, 'notification_timer')
+        notify(self.author_id, LIKE, self.message_id, self.fan_ids[0])
+        self.assertEqual(started, [True])
+
+    def test_buckets(self):
+        now = datetime(2020, 6, 1, 12)
+        notify(self.author_id, LIKE, self.message_id, self.fan_ids[0], now)
+        notify(self.author_id, LIKE, self.message_id, self.fan_ids[1],
+               now + timedelta(days=1))
+        flush_notifications(db.session.connection())
+
+        self.assertEqual([count for _, _, count, _ in self.groups()], [1, 1])
+        self.assertEqual(self.unread(), 2)
+
+    def test_page_marks_seen(self):
+        for fan_id in self.fan_ids:
+            notify(self.author_id, LIKE, self.message_id, fan_id)
+        flush_notifications(db.session.connection())
+
+        self.as_user(self.author_id)
+        page = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan2", page)
+        self.assertIn("and 2 others", page)
+        self.assertIn("liked your", page)
+        self.assertIn("notification unread", page)
+        self.assertEqual(self.unread(), 0)
+
+        # Seen, and nothing new: no badge, nothing highlighted.
+        page = self.client.get("/notifications").get_data(as_text=True)
+        self.assertNotIn("notification unread", page)
+        self.assertNotIn('id="unread-notifications"', page)
+
+        # News for a group already seen makes it unread again.
+        late = [User.signup(f"late{i}", f"late{i}@test.com", "password",
+                            None) for i in range(2)]
+        db.session.commit()
+        late_ids = [user.id for user in late]
+        notify(self.author_id, LIKE, self.message_id, late_ids[0],
+               datetime.utcnow() + timedelta(seconds=1))
+        flush_notifications(db.session.connection())
+        self.assertEqual(self.unread(), 1)
+
+        # A liker counted already isn't news.
+        notify(self.author_id, LIKE, self.message_id, self.fan_ids[0],
+               datetime.utcnow() + timedelta(seconds=2))
+        flush_notifications(db.session.connection())
+        self.assertEqual(self.groups()[0][2], 4)
+
+        # More news for the same unread group doesn't count twice.
+        notify(self.author_id, LIKE, self.message_id, late_ids[1],
+               datetime.utcnow() + timedelta(seconds=3))
+        flush_notifications(db.session.connection())
+        self.assertEqual(self.unread(), 1)
+
+    def test_many_likers_are_one_row(self):
+        # Actors are only ever counted, so ids needn't be users.
+        likers = range(10 ** 6, 10 ** 6 + 1000)
+        for start in range(0, 1000, 250):
+            for actor_id in likers[start:start + 250]:
+                notify(self.author_id, LIKE, self.message_id, actor_id)
+            # Half again: people already counted.
+            for actor_id in likers[:start // 2]:
+                notify(self.author_id, LIKE, self.message_id, actor_id)
+            with count_queries() as queries:
+                flush_notifications(db.session.connection())
+            self.assertEqual(len(queries), 1)
+
+        [notification] = Notification.query.all()
+        self.assertIsNone(notification.actor_ids)
+        self.assertEqual(len(notification.actor_sketch), 256)
+        self.assertAlmostEqual(notification.actor_count, 1000, delta=100)
+
+    def test_count_is_exact_while_small(self):
+        likers = list(range(10 ** 6, 10 ** 6 + EXACT_ACTORS))
+        for actor_id in likers + likers[:3]:
+            notify(self.author_id, LIKE, self.message_id, actor_id)
+            flush_notifications(db.session.connection())
+
+        [notification] = Notification.query.all()
+        self.assertEqual(notification.actor_ids, likers)
+        self.assertEqual(notification.actor_count, EXACT_ACTORS)
+
+        # One more, and the sketch takes over.
+        notify(self.author_id, LIKE, self.message_id, 1)
+        flush_notifications(db.session.connection())
+        db.session.expire_all()
+        [notification] = Notification.query.all()
+        self.assertIsNone(notification.actor_ids)
+        self.assertAlmostEqual(notification.actor_count, EXACT_ACTORS + 1,
+                               delta=3)
+
+    def test_requires_login(self):
+        resp = self.client.get("/notifications")
+        self.assertEqual(resp.status_code, 302)
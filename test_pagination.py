@@ -0,0 +1,140 @@
+"""Keyset pagination tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_pagination.py
+
+
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+from models import db, bakery, User, Message, Follows
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+
+
+class PaginationTestCase(DatabaseTestCase):
+    """Test paging through lists with cursors."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+        self.page_size = app.config['PAGE_SIZE']
+        app.config['PAGE_SIZE'] = 3
+
+        self.user = User(username="pager", email="pager@test.com",
+                         password="HASHED_PASSWORD")
+        db.session.add(self.user)
+        db.session.flush()
+        self.user_id = self.user.id
+
+        # Two share a timestamp; the id breaks the tie.
+        days = [1, 2, 3, 3, 4, 5, 6]
+        for i, day in enumerate(days):
+            db.session.add(Message(text=f"warble{i}", user_id=self.user_id,
+                                   timestamp=datetime(2020, 1, day)))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['PAGE_SIZE'] = self.page_size
+
+    def get(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get(url)
+            return resp.status_code, BeautifulSoup(resp.data, 'html.parser')
+
+    def texts(self, soup):
+        return [p.text for p in soup.select("#messages .message-area p")]
+
+    def link(self, soup, rel):
+        link = soup.find("a", rel=rel)
+        return link and link["href"]
+
+    def test_walk_forwards_and_back(self):
+        status, page = self.get(f"/users/{self.user_id}")
+        self.assertEqual(status, 200)
+        self.assertEqual(self.texts(page), ["warble6", "warble5", "warble4"])
+        self.assertIsNone(self.link(page, "prev"))
+
+        _, page = self.get(self.link(page, "next"))
+        self.assertEqual(self.texts(page), ["warble3", "warble2", "warble1"])
+
+        _, last = self.get(self.link(page, "next"))
+        self.assertEqual(self.texts(last), ["warble0"])
+        self.assertIsNone(self.link(last, "next"))
+
+        _, page = self.get(self.link(last, "prev"))
+        self.assertEqual(self.texts(page), ["warble3", "warble2", "warble1"])
+
+        _, first = self.get(self.link(page, "prev"))
+        self.assertEqual(self.texts(first), ["warble6", "warble5", "warble4"])
+        self.assertIsNone(self.link(first, "prev"))
+
+    def test_baked_pages_compile_once(self):
+        def walk():
+            _, page = self.get(f"/users/{self.user_id}")
+            _, page = self.get(self.link(page, "next"))
+            _, page = self.get(self.link(page, "prev"))
+            return self.texts(page)
+
+        self.assertEqual(walk(), ["warble6", "warble5", "warble4"])
+        baked = len(bakery.cache)
+
+        # Other values, same statements.
+        self.assertEqual(walk(), ["warble6", "warble5", "warble4"])
+        self.assertEqual(len(bakery.cache), baked)
+
+    def test_fragment(self):
+        _, page = self.get(f"/users/{self.user_id}")
+        fragment_url = page.find("a", rel="next")["data-fragment"]
+
+        status, fragment = self.get(fragment_url)
+        self.assertEqual(status, 200)
+        self.assertIsNone(fragment.find("nav"))
+        self.assertEqual([p.text for p in fragment.select(".message-area p")],
+                         ["warble3", "warble2", "warble1"])
+        self.assertIsNotNone(self.link(fragment, "next"))
+        self.assertIsNone(self.link(fragment, "prev"))
+
+    def test_bad_cursor(self):
+        _, page = self.get(f"/users/{self.user_id}")
+        tampered = self.link(page, "next").replace("after=", "after=x")
+
+        status, _ = self.get(tampered)
+        self.assertEqual(status, 400)
+
+    def test_user_list_keeps_search(self):
+        for i in range(4):
+            db.session.add(User(username=f"findme{i}",
+                                email=f"findme{i}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        _, page = self.get("/users?q=findme")
+        self.assertIn("q=findme", self.link(page, "next"))
+
+        _, page = self.get(self.link(page, "next"))
+        self.assertEqual([p.text for p in page.select(".card-link p")],
+                         ["@findme3"])
+
+    def test_following(self):
+        others = [User(username=f"other{i}", email=f"other{i}@test.com",
+                       password="HASHED_PASSWORD") for i in range(4)]
+        db.session.add_all(others)
+        db.session.flush()
+        db.session.add_all(Follows(user_following_id=self.user_id,
+                                   user_being_followed_id=other.id)
+                           for other in others)
+        db.session.commit()
+
+        _, page = self.get(f"/users/{self.user_id}/following")
+        names = [p.text for p in page.select(".card-link p")]
+
+        _, page = self.get(self.link(page, "next"))
+        names += [p.text for p in page.select(".card-link p")]
+        self.assertEqual(names, [f"@other{i}" for i in range(4)])
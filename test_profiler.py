@@ -0,0 +1,97 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiler.py
+
+
+import json
+import os
+import shutil
+import tempfile
+
+from models import db, User
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from profiler import HEADER, make_token
+
+
+class ProfilerTestCase(DatabaseTestCase):
+    """Test triggering and saving request profiles."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings = {key: app.config[key] for key in (
+            'PROFILE_DIR', 'PROFILE_ADMINS', 'PROFILE_SAMPLE_RATE',
+            'PROFILE_INTERVAL', 'PROFILE_KEEP')}
+        self.addCleanup(app.config.update, settings)
+        app.config.update(PROFILE_DIR=self.directory,
+                          PROFILE_ADMINS=('admin',),
+                          PROFILE_INTERVAL=0.001)
+
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.user = User.signup("user", "user@test.com", "password", None)
+        db.session.commit()
+        self.admin_id, self.user_id = self.admin.id, self.user.id
+
+    def get(self, url, user_id=None, **kwargs):
+        with self.client.session_transaction() as sess:
+            if user_id:
+                sess[CURR_USER_KEY] = user_id
+            else:
+                sess.pop(CURR_USER_KEY, None)
+        resp = self.client.get(url, **kwargs)
+        resp.get_data()
+        resp.close()
+        return resp
+
+    def profiles(self):
+        return sorted(name[:-len('.json')] for name in os.listdir(self.directory)
+                      if name.endswith('.json'))
+
+    def load(self, name):
+        with open(os.path.join(self.directory, name + '.json')) as f:
+            summary = json.load(f)
+        with open(os.path.join(self.directory, name + '.collapsed')) as f:
+            stacks = f.read().splitlines()
+        return summary, stacks
+
+    def test_not_profiled(self):
+        self.get("/users")
+        self.get("/users", headers={HEADER: "forged"})
+        self.get("/users?profile=1", user_id=self.user_id)
+        self.assertEqual(self.profiles(), [])
+
+    def test_header(self):
+        resp = self.get("/users?q=a", headers={HEADER: make_token()})
+        self.assertEqual(resp.status_code, 200)
+
+        [name] = self.profiles()
+        self.assertIn("warbler-list_users", name)
+        summary, stacks = self.load(name)
+        self.assertEqual(summary['path'], "/users?q=a")
+        self.assertEqual(summary['status'], 200)
+        self.assertEqual(summary['trigger'], "header")
+        self.assertGreater(summary['sql_count'], 0)
+        self.assertGreater(summary['duration'], 0)
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in stacks),
+                         summary['samples'])
+
+    def test_admin(self):
+        self.get("/users?profile=1", user_id=self.admin_id)
+        [name] = self.profiles()
+        self.assertEqual(self.load(name)[0]['trigger'], "admin")
+
+    def test_sampled_and_rotated(self):
+        app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_KEEP=2)
+        for _ in range(3):
+            self.get("/users")
+
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
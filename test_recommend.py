@@ -0,0 +1,137 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommend.py
+
+
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows, Recommendation
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from recommend import build_recommendations, friends_of_friends, load_follows
+
+
+def recommendations_of(follows, **kwargs):
+    """{user id: [(recommended id, score), ...]} for a list of follows."""
+
+    follower = np.array([f for f, _ in follows], dtype=np.int32)
+    followed = np.array([f for _, f in follows], dtype=np.int32)
+
+    result = {}
+    for users, ranks, recommended, scores in friends_of_friends(
+            follower, followed, **kwargs):
+        for user, rank, other, score in zip(users, ranks, recommended, scores):
+            result.setdefault(int(user), []).append(
+                (int(rank), int(other), int(score)))
+
+    return {user: [(other, score) for _rank, other, score in sorted(recs)]
+            for user, recs in result.items()}
+
+
+class FriendsOfFriendsTestCase(TestCase):
+    """Test the sparse-matrix scoring."""
+
+    def test_scores_paths(self):
+        recs = recommendations_of([
+            (1, 2), (1, 5),
+            (2, 3), (2, 4), (5, 3),
+        ])
+
+        # 3 is followed by both of 1's friends, 4 by one of them.
+        self.assertEqual(recs[1], [(3, 2), (4, 1)])
+
+    def test_excludes_followed_and_self(self):
+        recs = recommendations_of([
+            (1, 2), (1, 3),
+            (2, 1), (2, 3), (2, 4),
+        ])
+
+        self.assertEqual(recs[1], [(4, 1)])
+        self.assertNotIn(2, recs)
+
+    def test_top_k_with_ties_to_lower_id(self):
+        follows = [(1, 2)] + [(2, other) for other in (30, 10, 20, 40)]
+
+        recs = recommendations_of(follows, k=2)
+        self.assertEqual(recs[1], [(10, 1), (20, 1)])
+
+    def test_blocks_and_sparse_ids(self):
+        follows = [(1, 99222224), (99222224, 7), (7, 1), (7, 8)]
+
+        whole = recommendations_of(follows)
+        self.assertEqual(recommendations_of(follows, block_size=1), whole)
+        self.assertEqual(whole[1], [(7, 1)])
+        self.assertEqual(whole[99222224], [(1, 1), (8, 1)])
+
+
+class RecommendationsTestCase(DatabaseTestCase):
+    """Test the batch job and the home page widget."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        users = [User(username=f"user{i}", email=f"u{i}@test.com",
+                      password="HASHED_PASSWORD") for i in range(4)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.ids = [u.id for u in users]
+
+        a, b, c, d = self.ids
+        db.session.add_all([
+            Follows(user_following_id=a, user_being_followed_id=b),
+            Follows(user_following_id=b, user_being_followed_id=c),
+            Follows(user_following_id=b, user_being_followed_id=d),
+        ])
+        db.session.commit()
+
+    def test_load_follows(self):
+        follower, followed = load_follows(db.session.connection())
+
+        a, b, c, d = self.ids
+        self.assertEqual(sorted(zip(follower.tolist(), followed.tolist())),
+                         sorted([(a, b), (b, c), (b, d)]))
+
+    def test_build(self):
+        total = build_recommendations(db.session.connection())
+
+        a, b, c, d = self.ids
+        self.assertEqual(total, 2)
+        self.assertEqual(
+            [(r.rank, r.recommended_id) for r in
+             Recommendation.query.filter_by(user_id=a).order_by('rank')],
+            [(1, c), (2, d)])
+
+        # Rebuilding replaces the table.
+        self.assertEqual(build_recommendations(db.session.connection()), 2)
+
+    def test_home_widget(self):
+        build_recommendations(db.session.connection())
+        a, b, c, d = self.ids
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = a
+
+            page = client.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", page)
+            self.assertIn(f'action="/users/follow/{c}"', page)
+
+            # Followed since the build: not suggested any more.
+            client.post(f"/users/follow/{c}")
+            page = client.get("/").get_data(as_text=True)
+            self.assertNotIn(f'action="/users/follow/{c}"', page)
+            self.assertIn(f'action="/users/follow/{d}"', page)
+
+    def test_no_widget_without_recommendations(self):
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            self.assertNotIn("Who to follow", str(client.get("/").data))
@@ -0,0 +1,477 @@
+"""Sharding tests, against three local databases."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_shards.py
+
+
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
+
+from bs4 import BeautifulSoup
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, ShardBucket, MESSAGE_PARTITION_SIZE
+
+from app import CURR_USER_KEY
+from archive import (archive_partition, archived_message, finish_archiving,
+                     read_index)
+from export import export_records
+from fixtures import app, DatabaseTestCase, prepare_shard_databases
+from follow_graph import DatabaseGraph, load_graph, refresh_graph
+from like_counts import (_each_shard, get_like_counter, write_deltas,
+                         write_to_shards)
+from notifications import flush_notifications
+from shards import (_close_sessions, copy_user, get_router, id_floors,
+                    init_shard, move_bucket, plan_rebalance, shard_of)
+
+
+class PlanRebalanceTestCase(TestCase):
+    """Test planning which buckets to move."""
+
+    def spread(self, current, moves):
+        placed = dict(current)
+        placed.update(moves)
+        held = {}
+        for shard in placed.values():
+            held[shard] = held.get(shard, 0) + 1
+        return held
+
+    def test_from_one_shard(self):
+        current = dict.fromkeys(range(8), 0)
+        moves = plan_rebalance(current, 3)
+        self.assertEqual(len(moves), 5)
+        self.assertEqual(self.spread(current, moves), {0: 3, 1: 3, 2: 2})
+
+    def test_adding_a_shard_only_fills_it(self):
+        current = {bucket: bucket % 2 for bucket in range(8)}
+        moves = plan_rebalance(current, 3)
+        self.assertEqual([shard for _, shard in moves], [2, 2])
+        self.assertEqual(sorted(self.spread(current, moves).values()),
+                         [2, 3, 3])
+
+    def test_balanced(self):
+        current = {bucket: bucket % 3 for bucket in range(9)}
+        self.assertEqual(plan_rebalance(current, 3), [])
+
+
+class ShardsTestCase(DatabaseTestCase):
+    """Test routing users' data to shards, and reading it back."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.shard_urls = prepare_shard_databases(2)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+        self.router = get_router()
+
+        saved = {key: app.config[key] for key in
+                 ('SHARD_URIS', 'SHARD_MAP_REFRESH_SECONDS', 'PAGE_SIZE',
+                  'LIKE_COUNT_FLUSH_SECONDS', 'FOLLOW_GRAPH_DIR',
+                  'MESSAGES_ARCHIVE_DIR')}
+        self.addCleanup(app.config.update, saved)
+        app.config['SHARD_URIS'] = self.shard_urls
+        app.config['SHARD_MAP_REFRESH_SECONDS'] = 0
+        self.addCleanup(self.router.dispose)
+        self.addCleanup(self.empty_shards)
+        # Sessions the tests open outside requests, which would block that.
+        self.addCleanup(_close_sessions)
+
+        # Shard 0 is readied inside the test's transaction, so it's undone.
+        stride = app.config['SHARD_ID_STRIDE']
+        main = db.session.connection()
+        with self.engine(1).connect() as one, self.engine(2).connect() as two:
+            floors = id_floors([main, one, two])
+        init_shard(main, 0, stride, floors)
+        for number in (1, 2):
+            with self.engine(number).begin() as conn:
+                init_shard(conn, number, stride, floors)
+
+    def engine(self, number):
+        return self.router.engine(number)
+
+    def empty_shards(self):
+        for number in (1, 2):
+            self.engine(number).execute(
+                "TRUNCATE users, messages, message_tags, likes, follows, "
+                "follow_changes, shard_buckets CASCADE")
+
+    def make_user(self, name, shard):
+        user = User(username=name, email=f"{name}@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(ShardBucket(
+            bucket=user.id % app.config['SHARD_BUCKETS'], shard=shard))
+        db.session.commit()
+        copy_user(user)
+        return user.id
+
+    def session(self, number):
+        if number == 0:
+            return db.session()
+        session = self.router.sessionmaker(number)()
+        self.addCleanup(session.close)
+        return session
+
+    def as_user(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.as_user(user_id)
+        resp = self.client.post("/messages/new", data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+
+    def rows(self, number, table, **where):
+        sql = f"SELECT * FROM {table}"
+        if where:
+            sql += " WHERE " + " AND ".join(f"{key} = %({key})s"
+                                             for key in where)
+        if number == 0:
+            return db.session.connection().execute(sql, where).fetchall()
+        return self.engine(number).execute(sql, where).fetchall()
+
+    def test_placement(self):
+        ids = [self.make_user(f"user{shard}", shard) for shard in range(3)]
+        self.assertEqual([shard_of(user_id) for user_id in ids], [0, 1, 2])
+
+        # Every shard has every user.
+        for number in (1, 2):
+            self.assertEqual(len(self.rows(number, "users")), 3)
+
+    def test_posts_go_to_home_shard(self):
+        author_id = self.make_user("author", 1)
+        self.post(author_id, "hello #shards")
+
+        self.assertEqual(self.rows(0, "messages"), [])
+        [message] = self.rows(1, "messages")
+        self.assertEqual(message.text, "hello #shards")
+        self.assertEqual(message.id % app.config['SHARD_ID_STRIDE'], 1)
+        self.assertEqual(len(self.rows(1, "message_tags")), 1)
+
+        for url in (f"/users/{author_id}", "/tags/shards"):
+            page = self.client.get(url).get_data(as_text=True)
+            self.assertIn(f'href="/messages/{message.id}"', page)
+
+    def test_homepage_merges_shards(self):
+        app.config['PAGE_SIZE'] = 2
+        viewer_id = self.make_user("viewer", 0)
+        author_ids = [self.make_user(f"author{shard}", shard)
+                      for shard in range(3)]
+        for author_id in author_ids:
+            self.as_user(viewer_id)
+            self.client.post(f"/users/follow/{author_id}")
+        self.assertEqual(len(self.rows(0, "follows")), 3)
+
+        # Taking turns between the shards, a day apart.
+        for day in range(1, 7):
+            author_id = author_ids[day % 3]
+            self.post(author_id, f"day{day}")
+            session = self.session(shard_of(author_id))
+            session.query(Message).filter(Message.text == f"day{day}").update(
+                {Message.timestamp: datetime(2020, 1, day)})
+            session.commit()
+
+        self.as_user(viewer_id)
+        shown, url = [], "/"
+        while url:
+            page = BeautifulSoup(self.client.get(url).data, 'html.parser')
+            texts = [p.text for p in page.select("#messages .message-area p")]
+            self.assertLessEqual(len(texts), 2)
+            shown += texts
+            link = page.find("a", rel="next")
+            url = link and link["href"]
+        self.assertEqual(shown, [f"day{day}" for day in range(6, 0, -1)])
+
+    def test_followers_across_shards(self):
+        author_id = self.make_user("author", 1)
+        fan_ids = [self.make_user(f"fan{shard}", shard) for shard in range(3)]
+        for fan_id in fan_ids:
+            self.as_user(fan_id)
+            self.client.post(f"/users/follow/{author_id}")
+
+        # Each follow is with its follower.
+        for shard in range(3):
+            self.assertEqual(len(self.rows(shard, "follows")), 1)
+
+        page = self.client.get(f"/users/{author_id}/followers").get_data(
+            as_text=True)
+        for shard in range(3):
+            self.assertIn(f"@fan{shard}", page)
+
+        page = self.client.get(f"/users/{fan_ids[2]}/following").get_data(
+            as_text=True)
+        self.assertIn("@author", page)
+
+    def test_follow_badges_across_shards(self):
+        author_id = self.make_user("author", 2)
+        fan_id = self.make_user("fan", 1)
+        self.as_user(fan_id)
+        self.client.post(f"/users/follow/{author_id}")
+        self.as_user(author_id)
+        self.client.post(f"/users/follow/{fan_id}")
+
+        self.as_user(fan_id)
+        page = self.client.get(f"/users/{author_id}").get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{author_id}"', page)
+        self.assertIn("Follows you", page)
+
+    def test_follow_graph_snapshot_across_shards(self):
+        app.config['FOLLOW_GRAPH_DIR'] = directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ids = [self.make_user(f"user{shard}", shard) for shard in range(3)]
+
+        def follow(a, b):
+            self.as_user(ids[a])
+            self.client.post(f"/users/follow/{ids[b]}")
+
+        def refresh(**kwargs):
+            with self.engine(1).connect() as one, \
+                    self.engine(2).connect() as two:
+                return refresh_graph([db.session.connection(), one, two],
+                                     directory, **kwargs)
+
+        def assertSameGraph():
+            graph, expected = load_graph(), DatabaseGraph()
+            self.assertNotIsInstance(graph, DatabaseGraph)
+            for user_id in ids:
+                self.assertEqual(graph.following(user_id).tolist(),
+                                 expected.following(user_id).tolist())
+                self.assertEqual(graph.followers(user_id).tolist(),
+                                 expected.followers(user_id).tolist())
+
+        follow(0, 1)
+        follow(1, 2)
+        refresh()
+        follow(2, 0)
+        self.as_user(ids[1])
+        self.client.post(f"/users/stop-following/{ids[2]}")
+        assertSameGraph()
+        self.assertEqual(DatabaseGraph().followers(ids[0]).tolist(),
+                         [ids[2]])
+
+        # Moving a bucket isn't logged as unfollows and follows.
+        move_bucket(ids[0] % app.config['SHARD_BUCKETS'], 2)
+        self.assertEqual(self.rows(2, "follow_changes",
+                                   follower_id=ids[0]), [])
+        full = refresh(full=True)
+        self.assertEqual(refresh().following.keys().tolist(),
+                         full.following.keys().tolist())
+        assertSameGraph()
+
+    def test_likes_across_shards(self):
+        app.config['LIKE_COUNT_FLUSH_SECONDS'] = 0
+        author_id = self.make_user("author", 1)
+        fan_id = self.make_user("fan", 2)
+        self.post(author_id, "likable")
+        [message] = self.rows(1, "messages")
+
+        self.as_user(fan_id)
+        self.client.post(f"/messages/{message.id}/like")
+        self.assertEqual(len(self.rows(2, "likes", message_id=message.id)), 1)
+        self.assertEqual(
+            self.rows(1, "messages")[0].like_count, 1)
+        get_like_counter().clear()
+
+        page = self.client.get(f"/users/{fan_id}/likes").get_data(
+            as_text=True)
+        self.assertIn("likable", page)
+
+        # Deleting the message deletes its likes, wherever they are.
+        self.as_user(author_id)
+        self.client.post(f"/messages/{message.id}/delete")
+        self.assertEqual(self.rows(1, "messages"), [])
+        self.assertEqual(self.rows(2, "likes"), [])
+
+    def test_like_counts_retry_a_failed_shard(self):
+        author_id = self.make_user("author", 2)
+        self.post(author_id, "countable")
+        [message] = self.rows(2, "messages")
+        counter = get_like_counter()
+        shard_two = self.engine(2)
+
+        def fail_on_shard_two(conn, deltas, batch_size):
+            if conn.engine is shard_two:
+                raise RuntimeError("shard 2 is down")
+            return write_deltas(conn, deltas, batch_size)
+
+        counter.add(message.id, 1)
+        with mock.patch('like_counts.write_deltas', fail_on_shard_two):
+            write_to_shards(counter, counter.take())
+        self.assertEqual(self.rows(2, "messages")[0].like_count, 0)
+        self.assertTrue(counter.due(0))
+
+        # The retry goes to shard 2 alone; as at exit, one shard at a time.
+        counter.add(message.id, 1)
+        write_to_shards(counter, counter.take(), run=_each_shard)
+        self.assertEqual(self.rows(2, "messages")[0].like_count, 2)
+        self.assertFalse(counter.due(0))
+
+    def test_notifications_show_messages_from_their_shard(self):
+        author_id = self.make_user("author", 2)
+        fan_id = self.make_user("fan", 1)
+        self.post(author_id, "notable")
+        [message] = self.rows(2, "messages")
+
+        self.as_user(fan_id)
+        self.client.post(f"/messages/{message.id}/like")
+        flush_notifications(db.session.connection())
+
+        self.as_user(author_id)
+        page = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@fan", page)
+        self.assertIn(f'href="/messages/{message.id}"', page)
+        self.assertIn("notable", page)
+
+    def test_export_reads_home_shard(self):
+        user_id = self.make_user("exporter", 1)
+        other_id = self.make_user("other", 2)
+        self.post(other_id, "liked")
+        [liked] = self.rows(2, "messages")
+        self.post(user_id, "mine")
+        self.as_user(user_id)
+        self.client.post(f"/users/follow/{other_id}")
+        self.client.post(f"/messages/{liked.id}/like")
+        self.as_user(other_id)
+        self.client.post(f"/users/follow/{user_id}")
+
+        records = list(export_records(user_id))
+        self.assertEqual([r['type'] for r in records],
+                         ['profile', 'message', 'like', 'following',
+                          'follower'])
+        self.assertEqual(records[1]['text'], "mine")
+        self.assertEqual(records[2]['message_id'], liked.id)
+        self.assertEqual(records[3]['user_id'], other_id)
+        self.assertEqual(records[4]['user_id'], other_id)
+
+    def test_archive_takes_likes_from_other_shards(self):
+        app.config['LIKE_COUNT_FLUSH_SECONDS'] = 0
+        app.config['MESSAGES_ARCHIVE_DIR'] = directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        author_id = self.make_user("author", 1)
+        fan_id = self.make_user("fan", 2)
+        self.post(author_id, "old")
+        [message] = self.rows(1, "messages")
+        self.as_user(fan_id)
+        self.client.post(f"/messages/{message.id}/like")
+        get_like_counter().clear()
+
+        self.addCleanup(
+            self.engine(1).execute,
+            f"CREATE TABLE messages_p0 PARTITION OF messages "
+            f"FOR VALUES FROM (0) TO ({MESSAGE_PARTITION_SIZE})")
+        with self.engine(1).connect() as one, self.engine(2).connect() as two:
+            self.assertEqual(archive_partition(one, 0, directory, 1, {2: two}),
+                             1)
+        self.assertEqual(self.rows(1, "messages"), [])
+        self.assertEqual(self.rows(2, "likes"), [])
+        self.assertEqual(archived_message(message.id).like_count, 1)
+
+    def test_archive_resumes_deleting_likes(self):
+        app.config['LIKE_COUNT_FLUSH_SECONDS'] = 0
+        app.config['MESSAGES_ARCHIVE_DIR'] = directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        author_id = self.make_user("author", 1)
+        fan_ids = [self.make_user("fan0", 0), self.make_user("fan2", 2)]
+        self.post(author_id, "old")
+        [message] = self.rows(1, "messages")
+        for fan_id in fan_ids:
+            self.as_user(fan_id)
+            self.client.post(f"/messages/{message.id}/like")
+        get_like_counter().clear()
+
+        class DeletesFail:
+            """Shard 2's connection, down once the archive is written."""
+
+            def __init__(self, conn):
+                self.conn = conn
+
+            def begin(self):
+                return self.conn.begin()
+
+            def execute(self, statement, *args):
+                if str(statement).startswith("DELETE"):
+                    raise OperationalError(str(statement), {}, None)
+                return self.conn.execute(statement, *args)
+
+        self.addCleanup(
+            self.engine(1).execute,
+            f"CREATE TABLE messages_p0 PARTITION OF messages "
+            f"FOR VALUES FROM (0) TO ({MESSAGE_PARTITION_SIZE})")
+        main = db.session.connection()
+        with self.engine(1).connect() as one, self.engine(2).connect() as two:
+            with self.assertRaises(OperationalError):
+                archive_partition(one, 0, directory, 1,
+                                  {0: main, 2: DeletesFail(two)})
+
+            # Archived, and shard 0's like deleted; shard 2's is left.
+            self.assertEqual(self.rows(1, "messages"), [])
+            self.assertEqual(self.rows(0, "likes"), [])
+            self.assertEqual(len(self.rows(2, "likes")), 1)
+            [entry] = read_index(directory)
+            self.assertEqual(entry['likes_left_on'], [2])
+            self.assertEqual(archived_message(message.id).like_count, 2)
+
+            self.assertEqual(
+                finish_archiving(one, directory, 1, {0: main, 2: two}), 1)
+            self.assertEqual(self.rows(2, "likes"), [])
+            self.assertEqual(read_index(directory)[0]['likes_left_on'], [])
+            self.assertEqual(
+                finish_archiving(one, directory, 1, {0: main, 2: two}), 0)
+
+    def test_move_bucket(self):
+        user_id = self.make_user("mover", 0)
+        other_id = self.make_user("other", 1)
+        self.post(other_id, "liked")
+        [liked] = self.rows(1, "messages")
+        self.post(user_id, "moving")
+        self.as_user(user_id)
+        self.client.post(f"/users/follow/{other_id}")
+        self.client.post(f"/messages/{liked.id}/like")
+
+        bucket = user_id % app.config['SHARD_BUCKETS']
+        self.assertEqual(move_bucket(bucket, 2), 3)
+
+        self.assertEqual(shard_of(user_id), 2)
+        for table, where in (("messages", {'user_id': user_id}),
+                             ("likes", {'user_id': user_id}),
+                             ("follows", {'user_following_id': user_id})):
+            self.assertEqual(self.rows(0, table, **where), [])
+            self.assertEqual(len(self.rows(2, table, **where)), 1)
+
+        page = self.client.get(f"/users/{user_id}").get_data(as_text=True)
+        self.assertIn("moving", page)
+        self.assertEqual(len(self.rows(2, "users", id=user_id)), 1)
+
+    def test_writes_refused_while_moving(self):
+        user_id = self.make_user("mover", 1)
+        bucket = user_id % app.config['SHARD_BUCKETS']
+        db.session.query(ShardBucket).filter(
+            ShardBucket.bucket == bucket).update({ShardBucket.moving: True})
+        db.session.commit()
+
+        self.as_user(user_id)
+        resp = self.client.post("/messages/new", data={"text": "wait"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+        # Reads still work.
+        resp = self.client.get(f"/users/{user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_deleting_user_deletes_copies(self):
+        user_id = self.make_user("leaver", 2)
+        self.post(user_id, "bye")
+
+        self.as_user(user_id)
+        self.client.post("/users/delete")
+        for number in (1, 2):
+            self.assertEqual(self.rows(number, "users"), [])
+        self.assertEqual(self.rows(2, "messages"), [])
@@ -0,0 +1,121 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_slow_queries.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User
+
+from fixtures import app, DatabaseTestCase
+from slow_queries import SlowQueryLog, normalize_sql, parameter_shape
+
+
+class NormalizeTestCase(TestCase):
+    """Test taking the values out of statements."""
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM messages\n WHERE user_id IN "
+                          "(%(user_id_1)s, %(user_id_2)s, %(user_id_3)s) "
+                          "AND text = 'it''s' LIMIT 51"),
+            "SELECT * FROM messages WHERE user_id IN (?) "
+            "AND text = ? LIMIT ?")
+        self.assertEqual(normalize_sql("SELECT id FROM t2 WHERE a = %(a_1)s"),
+                         "SELECT id FROM t2 WHERE a = %(a_1)s")
+
+    def test_parameter_shape(self):
+        self.assertEqual(
+            parameter_shape({'user_id_1': 1, 'user_id_2': 2,
+                             'username_1': '%a%', 'param_1': 51}),
+            {'user_id': 'int x 2', 'username': 'str', 'param': 'int'})
+        self.assertEqual(parameter_shape([{'a': 1}, {'a': 2}], True),
+                         {'rows': 2, 'each': {'a': 'int'}})
+
+    def test_rate_limit(self):
+        log = SlowQueryLog(None, interval=10, max_per_minute=3)
+        self.assertEqual(log.allow('a', now=0), 0)
+        self.assertIsNone(log.allow('a', now=5))
+        self.assertIsNone(log.allow('a', now=6))
+        self.assertEqual(log.allow('a', now=10), 2)
+
+        self.assertEqual(log.allow('b', now=11), 0)
+        # Three written this minute already.
+        self.assertIsNone(log.allow('c', now=12))
+        self.assertEqual(log.allow('c', now=60), 1)
+
+
+class SlowQueryLogTestCase(DatabaseTestCase):
+    """Test logging slow statements from the app."""
+
+    def setUp(self):
+        super().setUp()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'slow.log')
+
+        self.addCleanup(app.extensions.__setitem__, 'slow_queries',
+                        app.extensions['slow_queries'])
+        self.addCleanup(app.config.update, SLOW_QUERY_THRESHOLD=None)
+        log = app.extensions['slow_queries'] = SlowQueryLog(
+            self.path, interval=60, max_per_minute=100)
+        self.addCleanup(log.close)
+        # Everything is slow.
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+
+        db.session.add(User(username="slowpoke", email="slow@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+    def records(self):
+        app.extensions['slow_query_explainer'].join()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_logs_route_caller_and_plan(self):
+        client = app.test_client()
+        client.get("/users?q=slow").get_data()
+        client.get("/users?q=other").get_data()
+
+        [record] = [r for r in self.records()
+                    if r['route'] == 'warbler.list_users'
+                    and 'LIKE' in r['sql']]
+        self.assertEqual(record['params']['username'], 'str')
+        self.assertTrue(record['caller'].startswith('templating.py:')
+                        or record['caller'].startswith('pagination.py:'),
+                        record['caller'])
+        self.assertEqual(record['skipped'], 0)
+        self.assertIn('Plan', record['plan'][0])
+        self.assertIn('Actual Total Time', record['plan'][0]['Plan'])
+
+    def test_writes_are_explained_not_run(self):
+        User.query.filter_by(username="slowpoke").update({'bio': 'hi'})
+        db.session.commit()
+
+        [record] = [r for r in self.records() if r['sql'].startswith('UPDATE')]
+        self.assertEqual(record['route'], 'cli')
+        self.assertTrue(record['caller'].startswith('test_slow_queries.py:'))
+        self.assertNotIn('Actual Total Time', record['plan'][0]['Plan'])
+
+    def test_explained_outside_the_pool(self):
+        checkouts = []
+
+        def checkout(dbapi_connection, record, proxy):
+            checkouts.append(record)
+
+        event.listen(db.engine, 'checkout', checkout)
+        self.addCleanup(event.remove, db.engine, 'checkout', checkout)
+        app.test_client().get("/users?q=slow").get_data()
+
+        self.assertEqual(checkouts, [])
+        self.assertTrue(any(isinstance(r['plan'], list)
+                            for r in self.records()))
@@ -0,0 +1,151 @@
+"""Hashtag, mention and trending tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_tags.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, MessageTag
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from tags import TrendingSketch, extract_tags, get_trending, linkify_tags
+
+
+class ExtractTagsTestCase(TestCase):
+    """Test finding and linking tags in message text."""
+
+    def test_extract(self):
+        self.assertEqual(
+            extract_tags("#Flask and @Alice, #flask again; x@y.com #a#b"),
+            ['#flask', '@alice', '#a'])
+
+    def test_linkify_escapes(self):
+        with app.test_request_context():
+            html = linkify_tags("<b>#Hi</b> @bob")
+
+        self.assertEqual(
+            html, '&lt;b&gt;<a href="/tags/hi" class="tag">#Hi</a>&lt;/b&gt; '
+                  '<a href="/tags/%40bob" class="tag">@bob</a>')
+
+
+class TrendingSketchTestCase(TestCase):
+    """Test the sliding-window sketch."""
+
+    def sketch(self, **kwargs):
+        kwargs.setdefault('slices', 4)
+        kwargs.setdefault('slice_seconds', 10)
+        return TrendingSketch(**kwargs)
+
+    def test_counts(self):
+        sketch = self.sketch()
+        for _ in range(3):
+            sketch.add(['#a', '#b'], now=100)
+        sketch.add(['#a'], now=115)
+
+        self.assertEqual(sketch.count('#a', now=115), 4)
+        self.assertEqual(sketch.count('#a', seconds=10, now=115), 1)
+        self.assertEqual(sketch.count('#b', now=115), 3)
+        self.assertEqual(sketch.count('#c', now=115), 0)
+
+    def test_window_slides(self):
+        sketch = self.sketch()
+        sketch.add(['#old'], now=100)
+        sketch.add(['#new'], now=125)
+
+        self.assertEqual(sketch.top(now=125), [('#new', 1), ('#old', 1)])
+        self.assertEqual(sketch.top(now=145), [('#new', 1)])
+        self.assertEqual(sketch.top(now=200), [])
+
+    def test_top_k(self):
+        sketch = self.sketch(capacity=2)
+        for tag, uses in [('#a', 1), ('#b', 3), ('#c', 2)]:
+            for _ in range(uses):
+                sketch.add([tag], now=100)
+
+        # '#a' lost its candidate slot to '#c'.
+        self.assertEqual(sketch.top(k=5, now=100), [('#b', 3), ('#c', 2)])
+        self.assertEqual(sketch.top(k=1, now=100), [('#b', 3)])
+
+    def test_overcounts_never_undercounts(self):
+        sketch = self.sketch(depth=2, width=8)
+        tags = [f'#t{i}' for i in range(50)]
+        sketch.add(tags, now=100)
+
+        self.assertTrue(all(sketch.count(t, now=100) >= 1 for t in tags))
+
+    def test_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'trending.mmap')
+        sketch = self.sketch(path=path)
+
+        child = os.fork()
+        if child == 0:
+            try:
+                self.sketch(path=path).add(['#fork'], now=100)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+        sketch.add(['#fork'], now=100)
+
+        self.assertEqual(sketch.top(now=100), [('#fork', 2)])
+
+
+class TagViewsTestCase(DatabaseTestCase):
+    """Test storing tags and the tag feeds."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("tagger", "tagger@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def post(self, text):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_post_stores_tags(self):
+        self.post("Hello #Warbler, says @tagger")
+
+        msg = Message.query.one()
+        tags = MessageTag.query.filter_by(message_id=msg.id)
+        self.assertEqual(sorted(t.tag for t in tags), ['#warbler', '@tagger'])
+        self.assertEqual(get_trending().top(),
+                         [('#warbler', 1), ('@tagger', 1)])
+
+        # Deleting the message deletes its tags.
+        self.client.post(f"/messages/{msg.id}/delete")
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def test_tag_feed(self):
+        self.post("first #flask")
+        self.post("second #Flask")
+        self.post("not tagged")
+
+        page = self.client.get("/tags/FLASK").get_data(as_text=True)
+        self.assertIn("#flask", page)
+        self.assertLess(page.index("second"), page.index("first"))
+        self.assertNotIn("not tagged", page)
+        self.assertIn("2 warbles recently", page)
+
+        page = self.client.get("/tags/@tagger").get_data(as_text=True)
+        self.assertIn("No warbles with @tagger yet", page)
+
+    def test_trending_on_home_page(self):
+        self.post("#one #two")
+        self.post("#two")
+
+        page = self.client.get("/").get_data(as_text=True)
+        self.assertIn("Trending", page)
+        self.assertLess(page.index('href="/tags/two"'),
+                        page.index('href="/tags/one"'))
@@ -0,0 +1,168 @@
+"""Streaming template rendering tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_templating.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import flash, session
+from jinja2 import Environment, FileSystemLoader
+
+from models import db, User, Follows
+
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
+from templating import (SharedBytecodeCache, compile_templates,
+                        stream_template)
+
+
+class StreamingTestCase(DatabaseTestCase):
+    """Test that long list pages stream in bounded chunks."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.user_ids = []
+        for i in range(30):
+            u = User(username=f"streamer{i}", email=f"s{i}@test.com",
+                     password="HASHED_PASSWORD")
+            db.session.add(u)
+            db.session.flush()
+            self.user_ids.append(u.id)
+
+        self.uid = self.user_ids[0]
+        db.session.add_all(
+            Follows(user_following_id=self.uid, user_being_followed_id=other)
+            for other in self.user_ids[1:])
+        db.session.commit()
+
+        app.config['STREAM_CHUNK_SIZE'] = 1024
+
+    def tearDown(self):
+        app.config['STREAM_CHUNK_SIZE'] = 8192
+        db.session.rollback()
+
+    def get_chunks(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.get(url, buffered=False)
+            chunks = [chunk.decode('utf-8') for chunk in resp.response]
+            resp.close()
+
+        return chunks
+
+    def test_head_flushed_first(self):
+        chunks = self.get_chunks("/users")
+
+        # The navbar ends a chunk of its own, before any rows are fetched.
+        head = next(i for i, chunk in enumerate(chunks)
+                    if chunk.rstrip().endswith("</nav>"))
+        self.assertNotIn("@streamer", "".join(chunks[:head + 1]))
+
+    def test_rows_in_bounded_chunks(self):
+        chunks = self.get_chunks("/users")
+        page = "".join(chunks)
+
+        for i in range(30):
+            self.assertIn(f"@streamer{i}<", page)
+
+        self.assertGreater(len(chunks), 5)
+        for chunk in chunks[1:-1]:
+            # A chunk closes as soon as it passes the size, so it can only
+            # overrun by one template event.
+            self.assertLess(len(chunk), 2048)
+
+    def test_following_streams(self):
+        page = "".join(self.get_chunks(f"/users/{self.uid}/following"))
+
+        for i in range(1, 30):
+            self.assertIn(f"@streamer{i}<", page)
+
+    def test_no_results(self):
+        page = "".join(self.get_chunks("/users?q=nobody"))
+        self.assertIn("Sorry, no users found", page)
+
+    def test_flashes_not_repeated(self):
+        with app.test_request_context():
+            flash("Shown once", "success")
+            session_flashes = list(session['_flashes'])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+                sess['_flashes'] = session_flashes
+
+            resp = c.get("/users")
+            self.assertIn("Shown once", str(resp.data))
+
+            resp = c.get("/users")
+            self.assertNotIn("Shown once", str(resp.data))
+
+    def test_stream_template(self):
+        with app.test_request_context():
+            resp = stream_template('404.html')
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("that page doesn", resp.get_data(as_text=True))
+
+
+class BytecodeCacheTestCase(TestCase):
+    """Test precompiling templates into the shared bytecode cache."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.source_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.source_dir)
+
+    def fresh_env(self, **kwargs):
+        """A new environment, like a freshly started worker would have."""
+
+        return app.jinja_env.overlay(
+            cache_size=0,
+            bytecode_cache=SharedBytecodeCache(self.cache_dir),
+            **kwargs)
+
+    def test_compile_all_templates(self):
+        count = compile_templates(self.fresh_env())
+
+        self.assertEqual(count, len(app.jinja_env.list_templates()))
+        self.assertEqual(len(os.listdir(self.cache_dir)), count)
+
+    def test_precompiled_templates_not_recompiled(self):
+        compile_templates(self.fresh_env())
+
+        env = self.fresh_env()
+
+        def fail(*args, **kwargs):
+            raise AssertionError("template was compiled again")
+
+        env.compile = fail
+        env.get_template('home.html')
+        env.get_template('users/detail.html')
+
+    def test_changed_source_recompiled(self):
+        path = os.path.join(self.source_dir, 'page.html')
+        with open(path, 'w') as f:
+            f.write("old {{ x }}")
+
+        def env():
+            return Environment(loader=FileSystemLoader(self.source_dir),
+                               bytecode_cache=SharedBytecodeCache(self.cache_dir))
+
+        self.assertEqual(env().get_template('page.html').render(x=1), "old 1")
+
+        with open(path, 'w') as f:
+            f.write("new {{ x }}")
+
+        self.assertEqual(env().get_template('page.html').render(x=1), "new 1")
@@ -0,0 +1,209 @@
+"""Login and signup throttling tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_throttle.py
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from models import db, bcrypt, User
+
+from fixtures import app, DatabaseTestCase
+import metrics
+
+
+class ThrottleTestCase(DatabaseTestCase):
+    """Test rate limiting of the password endpoints."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.config = dict(app.config)
+        app.config['THROTTLE_ENABLED'] = True
+        app.config['THROTTLE_LOGIN_IP'] = (10, 60)
+        app.config['THROTTLE_LOGIN_USER'] = (3, 60)
+        app.config['THROTTLE_SIGNUP_IP'] = (2, 60)
+
+        User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+
+        # Buckets are committed on their own connection, outside the test's
+        # transaction.
+        with db.engine.begin() as conn:
+            conn.execute("DELETE FROM throttle_buckets")
+
+    def login(self, username="testuser", password="wrongpass", **kwargs):
+        return self.client.post("/login", data={"username": username,
+                                                "password": password},
+                                **kwargs)
+
+    def signup(self, username):
+        return self.client.post("/signup", data={
+            "username": username,
+            "email": f"{username}@test.com",
+            "password": "password",
+        })
+
+    def test_login_throttled_by_username(self):
+        for _ in range(3):
+            self.assertEqual(self.login().status_code, 200)
+
+        resp = self.login()
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("Too many attempts", str(resp.data))
+        self.assertGreater(int(resp.headers['Retry-After']), 0)
+
+        # Even the right password is refused now, and never checked.
+        with mock.patch.object(bcrypt, 'check_password_hash') as check:
+            resp = self.login(password="password")
+        self.assertEqual(resp.status_code, 429)
+        check.assert_not_called()
+
+        # Other usernames still have their own bucket.
+        self.assertEqual(self.login(username="someoneelse").status_code, 200)
+
+    def test_login_throttled_by_ip(self):
+        for i in range(10):
+            self.login(username=f"guess{i}")
+
+        resp = self.login(username="fresh")
+        self.assertEqual(resp.status_code, 429)
+
+        other_ip = {'environ_base': {'REMOTE_ADDR': '10.1.2.3'}}
+        self.assertEqual(self.login(username="fresh2", **other_ip).status_code,
+                         200)
+
+    def test_signup_throttled_before_hashing(self):
+        self.assertEqual(self.signup("new1").status_code, 302)
+        self.assertEqual(self.signup("new2").status_code, 302)
+
+        with mock.patch.object(bcrypt, 'generate_password_hash') as hash_pw:
+            resp = self.signup("new3")
+        self.assertEqual(resp.status_code, 429)
+        hash_pw.assert_not_called()
+
+    def test_bucket_refills(self):
+        for _ in range(4):
+            self.login()
+        self.assertEqual(self.login().status_code, 429)
+
+        # Age the bucket by a minute: it is full again.
+        with db.engine.begin() as conn:
+            conn.execute("UPDATE throttle_buckets "
+                         "SET updated_at = updated_at - interval '61 seconds'")
+
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_throttle_metrics(self):
+        app.config['METRICS_TOKEN'] = "sekrit"
+        for _ in range(4):
+            self.login()
+
+        page = self.client.get(
+            "/metrics", headers={'Authorization': "Bearer sekrit"}
+        ).get_data(as_text=True)
+        self.assertIn("# TYPE warbler_throttle_checks_total counter", page)
+        self.assertIn('warbler_throttle_checks_total{bucket="login_user",'
+                      'result="throttled"}', page)
+
+    def test_metrics_token(self):
+        # Off until there's a token.
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        app.config['METRICS_TOKEN'] = "sekrit"
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        resp = self.client.get("/metrics",
+                               headers={'Authorization': "Bearer sekrit"})
+        self.assertEqual(resp.status_code, 200)
+
+
+class AuthenticateTimingTestCase(DatabaseTestCase):
+    """Test that unknown usernames cost as much as wrong passwords."""
+
+    def test_unknown_user_checks_a_hash(self):
+        with mock.patch.object(bcrypt, 'check_password_hash',
+                               return_value=True) as check:
+            self.assertFalse(User.authenticate("nobody", "password"))
+
+        check.assert_called_once()
+        dummy_hash = check.call_args[0][0]
+        self.assertTrue(dummy_hash.startswith("$2b$"))
+
+
+class CounterTestCase(TestCase):
+    """Test the metrics registry."""
+
+    def test_counter(self):
+        c = metrics.counter('test_things_total', "Things.", ('kind',))
+        c.inc(kind='a')
+        c.inc(2, kind='a')
+
+        self.assertIs(metrics.counter('test_things_total', "Things."), c)
+        self.assertEqual(c.value(kind='a'), 3)
+        self.assertIn('test_things_total{kind="a"} 3', metrics.render_metrics())
+
+    def test_counter_file_grows_under_threads(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        counters = metrics.CounterFile(os.path.join(directory, '1.counters'))
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+        errors = []
+
+        def write(thread):
+            # Each thread's new keys grow the file while the others write.
+            try:
+                for i in range(2000):
+                    counters.set(json.dumps([thread, i, "x" * 500]), i)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        values = counters.values()
+        self.assertEqual(len(values), 8000)
+        self.assertEqual(values[json.dumps([3, 1999, "x" * 500])], 1999)
+
+    def test_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(metrics._shared.update, dict(metrics._shared))
+        metrics._shared.update(directory=directory, owner=None)
+
+        c = metrics.counter('test_shared_total', "Shared things.", ('kind',))
+        c.inc(kind='a')
+        c.inc(2, kind='a')
+
+        # Another worker's file, as it would write it.
+        other = metrics.CounterFile(os.path.join(directory, '1.counters'))
+        other.set(json.dumps(['test_shared_total', 'a']), 4)
+        other.set(json.dumps(['test_shared_total', 'b']), 1)
+
+        page = metrics.render_metrics()
+        self.assertIn('test_shared_total{kind="a"} 7', page)
+        self.assertIn('test_shared_total{kind="b"} 1', page)
+        self.assertEqual(c.value(kind='a'), 3)
+
+        # A process reusing a pid carries on from its file.
+        self.assertEqual(metrics.CounterFile(os.path.join(
+            directory, '1.counters')).values()[
+                json.dumps(['test_shared_total', 'a'])], 4)
@@ -5,26 +5,19 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from fixtures import app, DatabaseTestCase
 
-from app import app
 
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         u1 = User.signup("test1", "email1@email.com", "password", None)
         uid1 = 1111
@@ -47,12 +40,6 @@ class UserModelTestCase(TestCase):
 
         self.client = app.test_client()
 
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-
-
     def test_user_model(self):
         """Does basic model work?"""
 
@@ -150,6 +137,12 @@ class UserModelTestCase(TestCase):
         self.assertIsNotNone(u)
         self.assertEqual(u.id, self.uid1)
     
+    def test_lookups(self):
+        self.assertEqual(User.by_id(self.uid1), self.u1)
+        self.assertIsNone(User.by_id(9999))
+        self.assertEqual(User.by_username("test2"), self.u2)
+        self.assertIsNone(User.by_username("nobody"))
+
     def test_invalid_username(self):
         self.assertFalse(User.authenticate("badusername", "password"))
 
@@ -157,12 +150,8 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
 
 
-
-
         
 
 
-
-
         
 
@@ -5,29 +5,20 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
-
 from models import db, Message, User, Follows, Like
 from bs4 import BeautifulSoup
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-from app import app, CURR_USER_KEY
-
-db.create_all()
+from app import CURR_USER_KEY
+from fixtures import app, DatabaseTestCase
 
-app.config['WTF_CSRF_ENABLED'] = False
 
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -49,11 +40,6 @@ class MessageViewTestCase(TestCase):
 
         db.session.commit()
 
-    def tearDown(self):
-        resp = super().tearDown()
-        db.session.rollback()
-        return resp
-
     def test_users_index(self):
         with self.client as c:
             resp = c.get("/users")
@@ -106,7 +92,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn("@testuser", str(resp.data))
             soup = BeautifulSoup(str(resp.data), 'html.parser')
             found = soup.find_all("li", {"class": "stat"})
-            self.assertEqual(len(found), 4)
+            self.assertEqual(len(found), 5)
 
             # test for a count of 2 messages
             self.assertIn("2", found[0].text)
@@ -117,8 +103,11 @@ class MessageViewTestCase(TestCase):
             # Test for a count of 0 following
             self.assertIn("0", found[2].text)
 
+            # Test for a count of 0 mutuals
+            self.assertIn("0", found[3].text)
+
             # Test for a count of 1 like
-            self.assertIn("1", found[3].text)
+            self.assertIn("1", found[4].text)
 
     def test_add_like(self):
         m = Message(id=1984, text="The earth is round", user_id=self.u1_id)
@@ -198,7 +187,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn("@testuser", str(resp.data))
             soup = BeautifulSoup(str(resp.data), 'html.parser')
             found = soup.find_all("li", {"class": "stat"})
-            self.assertEqual(len(found), 4)
+            self.assertEqual(len(found), 5)
 
             # test for a count of 0 messages
             self.assertIn("0", found[0].text)
@@ -209,8 +198,11 @@ class MessageViewTestCase(TestCase):
             # Test for a count of 1 follower
             self.assertIn("1", found[2].text)
 
+            # Test for 1 mutual (u1)
+            self.assertIn("1", found[3].text)
+
             # Test for a count of 0 likes
-            self.assertIn("0", found[3].text)
+            self.assertIn("0", found[4].text)
 
     def test_show_following(self):
 
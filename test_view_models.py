@@ -0,0 +1,53 @@
+"""Read-only view model tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_view_models.py
+
+
+from datetime import datetime
+
+from models import db, User, Message
+
+from fixtures import DatabaseTestCase
+from view_models import (Author, MessageItem, UserCard, message_items,
+                         user_cards)
+
+
+class ViewModelsTestCase(DatabaseTestCase):
+    """Test loading list rows as view models."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User(username="viewer", email="viewer@test.com",
+                         password="HASHED_PASSWORD", bio="Hello")
+        db.session.add(self.user)
+        db.session.flush()
+        self.message = Message(text="warble", user_id=self.user.id,
+                               timestamp=datetime(2020, 1, 1))
+        db.session.add(self.message)
+        db.session.commit()
+
+    def test_message_items(self):
+        items = (message_items(db.session)
+                 .filter(Message.user_id == self.user.id).all())
+
+        self.assertEqual(items, [MessageItem(
+            self.message.id, "warble", datetime(2020, 1, 1), self.user.id, 0,
+            Author(self.user.id, "viewer", self.user.image_url))])
+        self.assertFalse(items[0].archived)
+
+    def test_user_cards(self):
+        cards = user_cards(db.session).filter(User.id == self.user.id).all()
+
+        self.assertEqual(cards, [UserCard(
+            self.user.id, "viewer", self.user.image_url,
+            self.user.header_image_url, "Hello")])
+
+    def test_no_orm_instances(self):
+        db.session.expunge_all()
+        message_items(db.session).all()
+        user_cards(db.session).all()
+
+        self.assertEqual(len(db.session.identity_map), 0)
@@ -0,0 +1,144 @@
+"""Rate limiting for Warbler's password endpoints.
+
+Logging in and signing up both run bcrypt, which is deliberately slow; a burst
+of guesses could keep every worker busy hashing. Attempts are counted in
+token buckets, one per client IP and one per username, and refused before any
+hashing once a bucket is empty. Username/email availability checks
+(availability.py) are limited per IP too, as they reveal who's registered.
+
+Buckets are rows in Postgres, so all workers share them. Taking a token is a
+single UPSERT on its own connection, committed at once: it counts even when
+the request that took it fails and rolls back.
+
+Limits are (burst, seconds): up to `burst` attempts at once, refilling at
+`burst` per `seconds`. A refused attempt still costs a token (down to -1), so
+clients that keep hammering stay locked out.
+"""
+
+import math
+
+import click
+from flask import current_app, request
+from flask.cli import AppGroup
+
+from metrics import counter
+from models import db
+
+THROTTLE_CHECKS = counter(
+    'warbler_throttle_checks_total',
+    "Attempts counted against a rate limit bucket.",
+    ('bucket', 'result'))
+
+TAKE_TOKEN = db.text("""
+    INSERT INTO throttle_buckets AS b (key, tokens, updated_at)
+    VALUES (:key, :burst - 1, now())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = GREATEST(
+            LEAST(:burst, b.tokens
+                  + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate) - 1,
+            -1),
+        updated_at = now()
+    RETURNING tokens
+""")
+
+PRUNE = db.text("""
+    DELETE FROM throttle_buckets
+    WHERE updated_at < now() - make_interval(secs => :seconds)
+""")
+
+LIMITS = ('THROTTLE_LOGIN_IP', 'THROTTLE_LOGIN_USER', 'THROTTLE_SIGNUP_IP',
+          'THROTTLE_AVAILABILITY_IP')
+
+throttle_cli = AppGroup('throttle', help="Manage login/signup rate limits.")
+
+
+def client_ip():
+    """The client's address, allowing for THROTTLE_TRUSTED_PROXIES."""
+
+    proxies = current_app.config['THROTTLE_TRUSTED_PROXIES']
+    route = request.access_route
+    if proxies and len(route) >= proxies:
+        # Each trusted proxy appends the address it got the request from.
+        return route[-proxies]
+    return request.remote_addr
+
+
+def take_token(bucket, key, limit):
+    """Take a token from a bucket.
+
+    Returns 0 if the attempt may go ahead, or else the seconds to wait.
+    """
+
+    burst, seconds = limit
+    rate = burst / seconds
+
+    with db.engine.begin() as conn:
+        tokens = conn.execute(TAKE_TOKEN, key=f"{bucket}:{key}",
+                              burst=burst, rate=rate).scalar()
+
+    if tokens >= 0:
+        THROTTLE_CHECKS.inc(bucket=bucket, result='allowed')
+        return 0
+
+    THROTTLE_CHECKS.inc(bucket=bucket, result='throttled')
+    # Time until the next attempt would find a whole token.
+    return math.ceil((1 - tokens) / rate)
+
+
+def check(**buckets):
+    """Take a token from each bucket (name=key); return the longest wait.
+
+    Every bucket is charged, even once one is empty, so an attacker spreading
+    guesses over usernames still drains their IP's bucket.
+    """
+
+    config = current_app.config
+    if not config['THROTTLE_ENABLED']:
+        return 0
+
+    return max(take_token(bucket, key, config[f"THROTTLE_{bucket.upper()}"])
+               for bucket, key in buckets.items())
+
+
+def check_login(username):
+    return check(login_ip=client_ip(),
+                 login_user=username.strip().lower()[:200])
+
+
+def check_signup():
+    return check(signup_ip=client_ip())
+
+
+def check_availability():
+    return check(availability_ip=client_ip())
+
+
+@throttle_cli.command('prune')
+def prune_command():
+    """Delete buckets that have refilled completely."""
+
+    config = current_app.config
+    # A bucket left alone for its window (plus one token's worth) is full,
+    # which is the same as having no row at all.
+    seconds = max(config[name][1] * (1 + 1 / config[name][0])
+                  for name in LIMITS)
+
+    with db.engine.begin() as conn:
+        deleted = conn.execute(PRUNE, seconds=seconds).rowcount
+
+    click.echo(f"Deleted {deleted} idle buckets.")
+
+
+def connect_throttle(app):
+    """Rate limit the password endpoints of the provided Flask app."""
+
+    app.config.setdefault('THROTTLE_ENABLED', True)
+    app.config.setdefault('THROTTLE_LOGIN_IP', (30, 300))
+    app.config.setdefault('THROTTLE_LOGIN_USER', (5, 300))
+    app.config.setdefault('THROTTLE_SIGNUP_IP', (5, 3600))
+    # Availability checks are cheap, but each tells the asker whether an
+    # email is registered.
+    app.config.setdefault('THROTTLE_AVAILABILITY_IP', (120, 60))
+    app.config.setdefault('THROTTLE_TRUSTED_PROXIES', 0)
+
+    app.cli.add_command(throttle_cli)
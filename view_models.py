@@ -0,0 +1,98 @@
+"""Read-only view models for Warbler's list pages.
+
+A list page shows a page of messages or users and changes none of them, so
+ORM instances (identity map entries, change tracking, lazy-load hooks, a
+User for each author) are wasted on it. The list queries select only the
+columns their templates use and turn each row straight into a namedtuple
+with a Bundle: MessageItem (its author as an Author), UserCard and
+NotificationItem.
+
+Messages from the archive (archive.py) are still transient Messages; they
+have the same attributes, so a page can hold both.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy.orm import Bundle, aliased
+
+from models import User, Message, Notification
+
+Author = namedtuple('Author', 'id username image_url')
+
+MessageItem = namedtuple(
+    'MessageItem', 'id text timestamp user_id like_count user archived',
+    defaults=(False,))
+
+UserCard = namedtuple('UserCard', 'id username image_url header_image_url bio')
+
+# `actor` is the username of the latest actor, `text` the liked message's,
+# filled in from the message's shard (app.notification_texts()).
+NotificationItem = namedtuple(
+    'NotificationItem', 'id kind subject_id actor_count updated_at actor text',
+    defaults=(None,))
+
+
+class MessageBundle(Bundle):
+    """Message and author columns, loaded as a MessageItem."""
+
+    def create_row_processor(self, query, procs, labels):
+        def proc(row):
+            (id, text, timestamp, user_id, like_count,
+             username, image_url) = [load(row) for load in procs]
+            return MessageItem(id, text, timestamp, user_id, like_count,
+                               Author(user_id, username, image_url))
+        return proc
+
+
+class ViewBundle(Bundle):
+    """Columns loaded as a `view` namedtuple, in order."""
+
+    def __init__(self, name, view, *exprs, **kw):
+        super().__init__(name, *exprs, **kw)
+        self.view = view
+
+    def create_row_processor(self, query, procs, labels):
+        view = self.view
+
+        def proc(row):
+            return view(*[load(row) for load in procs])
+        return proc
+
+
+MESSAGE_ITEM = MessageBundle(
+    'message', Message.id, Message.text, Message.timestamp, Message.user_id,
+    Message.like_count, User.username, User.image_url, single_entity=True)
+
+USER_CARD = ViewBundle(
+    'user', UserCard, User.id, User.username, User.image_url,
+    User.header_image_url, User.bio, single_entity=True)
+
+_actor = aliased(User, name='actor')
+
+NOTIFICATION_ITEM = ViewBundle(
+    'notification', NotificationItem, Notification.id, Notification.kind,
+    Notification.subject_id, Notification.actor_count,
+    Notification.updated_at, _actor.username, single_entity=True)
+
+
+def message_items(session):
+    """A query for MessageItems, their authors joined in."""
+
+    return session.query(MESSAGE_ITEM).select_from(Message).join(Message.user)
+
+
+def user_cards(session):
+    """A query for UserCards."""
+
+    return session.query(USER_CARD).select_from(User)
+
+
+def notification_items(session):
+    """A query for NotificationItems, with their actors.
+
+    Messages are on their authors' shards, so their text isn't joined here.
+    """
+
+    return (session.query(NOTIFICATION_ITEM)
+            .select_from(Notification)
+            .outerjoin(_actor, _actor.id == Notification.last_actor_id))